@@ -4,9 +4,15 @@
 
 import streamlit as st
 import json
+import csv
 import os
 import time
-from datetime import datetime, timedelta
+import bisect
+import heapq
+import math
+import tempfile
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
 import pandas as pd
 import numpy as np
 
@@ -15,6 +21,9 @@ OPENWEATHER_API_KEY = os.environ.get('OPENWEATHER_API_KEY', '')
 USDA_API_KEY = os.environ.get('USDA_API_KEY', '')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', '')
 
+# Teacher emails that are always school admins (comma separated)
+SCHOOL_ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get('FITTRACK_SCHOOL_ADMINS', '').split(',') if e.strip()}
+
 # Website Colour Palette
 COLOURS = {
     'red': '#d32f2f',
@@ -191,6 +200,12 @@ st.markdown(f"""
 
 # Data storage file
 DATA_FILE = 'fittrack_users.json'
+# School-wide data (precomputed reports shared by all teachers)
+SCHOOL_DATA_FILE = 'fittrack_school.json'
+# Groups and their member index
+GROUPS_FILE = 'fittrack_groups.json'
+# Append-only log of house point transactions (one JSON object per line)
+HOUSE_LEDGER_FILE = 'fittrack_house_ledger.jsonl'
 
 # Initialize session state
 if 'logged_in' not in st.session_state:
@@ -212,8 +227,34 @@ def save_users(users_data):
     with open(DATA_FILE, 'w') as f:
         json.dump(users_data, f, indent=2)
 
+# Load school-wide data
+def load_school_data():
+    if os.path.exists(SCHOOL_DATA_FILE):
+        with open(SCHOOL_DATA_FILE, 'r') as f:
+            return json.load(f)
+    return {}
+
+# Save school-wide data
+def save_school_data(school_data):
+    with open(SCHOOL_DATA_FILE, 'w') as f:
+        json.dump(school_data, f, indent=2)
+
+# Load groups
+def load_groups():
+    if os.path.exists(GROUPS_FILE):
+        with open(GROUPS_FILE, 'r') as f:
+            return json.load(f)
+    return {'groups': {}, 'member_index': {}}
+
+# Save groups
+def save_groups(groups_data):
+    with open(GROUPS_FILE, 'w') as f:
+        json.dump(groups_data, f, indent=2)
+
 # Load data on startup
 st.session_state.users_data = load_users()
+st.session_state.school_data = load_school_data()
+st.session_state.groups_data = load_groups()
 
 # Get current user data
 def get_user_data():
@@ -226,6 +267,32 @@ def update_user_data(data):
     st.session_state.users_data[st.session_state.username] = data
     save_users(st.session_state.users_data)
 
+# Cached indexes over user data
+def _data_stamp():
+    return os.stat(DATA_FILE).st_mtime_ns if os.path.exists(DATA_FILE) else None
+
+def get_cached_index(name, builder):
+    """Return a derived index over users_data, rebuilt only when the data file changed since it was built."""
+    cache = st.session_state.setdefault('index_cache', {})
+    stamp = _data_stamp()
+    entry = cache.get(name)
+    if entry is None or entry['stamp'] != stamp:
+        entry = {'stamp': stamp, 'index': builder(st.session_state.users_data)}
+        cache[name] = entry
+    return entry['index']
+
+def mark_indexes_current(*names):
+    """Call after a save whose changes were already applied to these indexes, so they are not rebuilt."""
+    stamp = _data_stamp()
+    cache = st.session_state.get('index_cache', {})
+    for name in names:
+        if name in cache:
+            cache[name]['stamp'] = stamp
+
+
+def new_id():
+    """A time-based id for stored records (workouts, sleep, goals, schedule entries)."""
+    return datetime.now().strftime('%Y%m%d%H%M%S%f')
 
 def get_user_age(user_data):
     """Return current age, computed from birthday if stored, else fall back to stored age."""
@@ -236,7 +303,7 @@ def get_user_age(user_data):
             return today.year - dob.year - ((today.month, today.day) < (dob.month, dob.day))
         except Exception:
             pass
-    return get_user_age(user_data) if user_data else 14
+    return user_data.get('age', 14) if user_data else 14
 
 # verifitcation of workout by AI
 
@@ -529,6 +596,161 @@ def calc_grade(score, cutoffs, reverse):
                 return 5 - i
     return 0
 
+# NAPFA Forecasting (batch job for teachers)
+NAPFA_GOLD_TOTAL = 21
+FORECAST_HORIZON_DAYS = 180
+FORECAST_MAX_AGE_HOURS = 24
+
+def napfa_medal(test):
+    """The test's medal: the stored one, or total plus lowest grade for tests saved without it."""
+    if test.get('medal'):
+        return test['medal']
+    min_grade = min(test.get('grades', {}).values(), default=0)
+    if test['total'] >= 21 and min_grade >= 3:
+        return "Gold"
+    if test['total'] >= 15 and min_grade >= 2:
+        return "Silver"
+    if test['total'] >= 9 and min_grade >= 1:
+        return "Bronze"
+    return "No Medal"
+
+def forecast_napfa_cohort(users_data, usernames=None, today=None):
+    """Fit a linear trend to every student's NAPFA totals in one vectorized pass.
+    Returns {username: forecast} with the predicted gold date and an at-risk flag."""
+    today = today or datetime.now().date()
+    if usernames is None:
+        usernames = [u for u, d in users_data.items() if isinstance(d, dict) and d.get('role') == 'student']
+
+    # Flatten every student's history into parallel arrays tagged with a student index
+    names, idx, dates, totals, medals = [], [], [], [], []
+    for username in usernames:
+        history = users_data.get(username, {}).get('napfa_history') or []
+        if not history:
+            continue
+        for test in history:
+            idx.append(len(names))
+            dates.append(test['date'])
+            totals.append(test['total'])
+        names.append(username)
+        medals.append(napfa_medal(history[-1]))
+
+    if not names:
+        return {}
+
+    idx = np.asarray(idx)
+    today_day = np.datetime64(today.isoformat(), 'D').astype(np.int64)
+    x = np.asarray(dates, dtype='datetime64[D]').astype(np.int64) - today_day  # days relative to today
+    x = x.astype(float)
+    y = np.asarray(totals, dtype=float)
+
+    # Least squares slope per student from grouped sums
+    count = np.bincount(idx, minlength=len(names)).astype(float)
+    sum_x = np.bincount(idx, weights=x, minlength=len(names))
+    sum_y = np.bincount(idx, weights=y, minlength=len(names))
+    sum_xx = np.bincount(idx, weights=x * x, minlength=len(names))
+    sum_xy = np.bincount(idx, weights=x * y, minlength=len(names))
+    denom = count * sum_xx - sum_x * sum_x
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(denom > 0, (count * sum_xy - sum_x * sum_y) / denom, np.nan)
+
+    # History is stored oldest first, so each student's last row is their latest test
+    last = np.r_[np.flatnonzero(np.diff(idx)), len(idx) - 1]
+    latest_total = y[last]
+    latest_day = x[last]
+
+    # Medals need a minimum grade on every station as well as the total
+    medals = np.asarray(medals)
+    is_gold = medals == "Gold"
+    grade_limited = ~is_gold & (latest_total >= NAPFA_GOLD_TOTAL)
+    improving = ~is_gold & ~grade_limited & (slope > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gold_day = np.where(is_gold, latest_day,
+                            np.where(improving, latest_day + (NAPFA_GOLD_TOTAL - latest_total) / slope, np.nan))
+
+    declining = ~is_gold & ~grade_limited & (slope <= 0)
+    off_track = (improving & (gold_day > FORECAST_HORIZON_DAYS)) | grade_limited
+    low_score = medals == "No Medal"
+    at_risk = declining | off_track | low_score
+
+    forecasts = {}
+    for i, username in enumerate(names):
+        if is_gold[i]:
+            status = 'gold'
+        elif grade_limited[i]:
+            status = 'off_track'
+        elif np.isnan(slope[i]):
+            status = 'insufficient_data'
+        elif declining[i]:
+            status = 'declining'
+        elif off_track[i]:
+            status = 'off_track'
+        else:
+            status = 'on_track'
+
+        reasons = []
+        if declining[i]:
+            reasons.append("Score not improving")
+        if grade_limited[i]:
+            reasons.append("Gold-level total, but a station is below Grade 3")
+        elif off_track[i]:
+            reasons.append(f"Gold more than {FORECAST_HORIZON_DAYS // 30} months away")
+        if low_score[i]:
+            reasons.append("Below Bronze level")
+
+        gold_date = None
+        if not np.isnan(gold_day[i]):
+            gold_date = (today + timedelta(days=int(np.ceil(gold_day[i])))).isoformat()
+
+        forecasts[username] = {
+            'latest_total': int(latest_total[i]),
+            'latest_date': (today + timedelta(days=int(latest_day[i]))).isoformat(),
+            'tests': int(count[i]),
+            'slope_per_month': None if np.isnan(slope[i]) else round(float(slope[i]) * 30, 2),
+            'gold_date': gold_date,
+            'status': status,
+            'at_risk': bool(at_risk[i]),
+            'reasons': reasons
+        }
+
+    return forecasts
+
+def run_napfa_forecast_job(usernames=None):
+    """Recompute NAPFA forecasts (the whole school by default) and store them in the school data file."""
+    started = time.time()
+    forecasts = forecast_napfa_cohort(st.session_state.users_data, usernames)
+
+    store = st.session_state.school_data.setdefault('napfa_forecasts', {'generated': None, 'students': {}})
+    if usernames is None:
+        store['students'] = forecasts
+        store['generated'] = datetime.now().isoformat()
+        store['duration_s'] = round(time.time() - started, 3)
+    else:
+        for username in usernames:
+            if username in forecasts:
+                store['students'][username] = forecasts[username]
+            else:
+                store['students'].pop(username, None)
+
+    save_school_data(st.session_state.school_data)
+    return store
+
+def ensure_napfa_forecasts_fresh():
+    """Scheduled run: refresh the stored forecasts when they are missing or older than FORECAST_MAX_AGE_HOURS."""
+    store = st.session_state.school_data.get('napfa_forecasts', {})
+    generated = store.get('generated')
+    if not generated or datetime.now() - datetime.fromisoformat(generated) > timedelta(hours=FORECAST_MAX_AGE_HOURS):
+        store = run_napfa_forecast_job()
+    return store
+
+def on_napfa_saved(username, user_data):
+    """Keep derived NAPFA data up to date after a new test is saved."""
+    update_class_rollup(st.session_state.users_data, username, user_data, 'napfa', user_data['napfa_history'][-1])
+    record_friend_challenge_activity(username, 'napfa', user_data['napfa_history'][-1])
+    record_napfa_analytics(username, user_data, user_data['napfa_history'][-1])
+    reschedule_after(user_data, 'napfa', user_data['napfa_history'][-1]['date'])
+    update_goals(user_data, 'napfa', user_data['napfa_history'][-1])
+    run_napfa_forecast_job([username])  # also saves the challenge scores and analytics above
+
 # Body Type Calculator
 def calculate_body_type(weight, height):
     """Calculate body type based on BMI and frame"""
@@ -546,6 +768,302 @@ def calculate_body_type(weight, height):
         return "Mesomorph", "Athletic build, gains muscle easily, responds well to training"
     else:
         return "Endomorph", "Larger bone structure, gains weight easily, slower metabolism"
+# Classes
+# A teacher owns several classes (teacher_data['classes'] by id). Each student stores its
+# class_id and teacher_class (the owning teacher), so both directions are O(1) lookups.
+DEFAULT_CLASS_CAPACITY = 30
+MAX_CLASS_CAPACITY = 500
+
+def generate_class_code(users_data):
+    import random as _rand, string as _str
+    taken = build_class_index(users_data)['by_code']
+    while True:
+        code = ''.join(_rand.choices(_str.ascii_uppercase + _str.digits, k=6))
+        if code not in taken:
+            return code
+
+def new_class(teacher_username, label, code, capacity=DEFAULT_CLASS_CAPACITY):
+    return {
+        'id': f"class_{teacher_username}_{new_id()}",
+        'teacher': teacher_username,
+        'label': label,
+        'code': code,
+        'capacity': capacity,
+        'students': [],
+        'created': datetime.now().isoformat(),
+        'rollup': None
+    }
+
+def build_class_index(users_data):
+    """Class code -> class id and class id -> teacher username, across all teachers."""
+    by_code, by_id = {}, {}
+    for username, data in users_data.items():
+        for class_id, cls in data.get('classes', {}).items():
+            by_code[cls['code'].upper()] = class_id
+            by_id[class_id] = username
+    return {'by_code': by_code, 'by_id': by_id}
+
+def get_class_index():
+    return get_cached_index('class_index', build_class_index)
+
+def get_class(users_data, class_id):
+    teacher_username = get_class_index()['by_id'].get(class_id)
+    if teacher_username is None or teacher_username not in users_data:
+        return None
+    return users_data[teacher_username].get('classes', {}).get(class_id)
+
+def get_student_class(users_data, student_data):
+    """The student's class, found through the owning teacher without any index."""
+    teacher_data = users_data.get(student_data.get('teacher_class') or '', {})
+    return teacher_data.get('classes', {}).get(student_data.get('class_id'))
+
+def find_class_by_code(class_code):
+    """Returns the class id for a join code, or None."""
+    return get_class_index()['by_code'].get(class_code.strip().upper())
+
+def teacher_classes(teacher_data):
+    return sorted(teacher_data.get('classes', {}).values(), key=lambda c: c['created'])
+
+def get_class_label(cls, users_data):
+    return cls.get('label') or f"{users_data.get(cls['teacher'], {}).get('name', 'Teacher')}'s class"
+
+def class_capacity(cls):
+    return cls.get('capacity', DEFAULT_CLASS_CAPACITY)
+
+def assign_student_to_class(users_data, student_username, cls):
+    """Put a student in a class. Returns False if the class is full. Does not save."""
+    students = cls['students']
+    if student_username not in students:
+        if len(students) >= class_capacity(cls):
+            return False
+        students.append(student_username)
+    student = users_data[student_username]
+    student['class_id'] = cls['id']
+    student['teacher_class'] = cls['teacher']
+    if cls.get('rollup') is not None:
+        rebuild_class_rollup(users_data, cls)
+    return True
+
+def remove_student_from_class(users_data, student_username, cls):
+    if student_username in cls['students']:
+        cls['students'].remove(student_username)
+    student = users_data.get(student_username, {})
+    student['class_id'] = None
+    student['teacher_class'] = None
+    if cls.get('rollup') is not None:
+        rebuild_class_rollup(users_data, cls)
+
+def migrate_teacher_classes():
+    """Turn the old single class_code/class_label/students fields on teachers into class entities."""
+    users_data = st.session_state.users_data
+    changed = False
+    for username, data in list(users_data.items()):
+        if data.get('role') != 'teacher' or 'classes' in data:
+            continue
+        cls = new_class(username, data.pop('class_label', ''), data.pop('class_code', None) or generate_class_code(users_data),
+                        data.pop('class_capacity', DEFAULT_CLASS_CAPACITY))
+        cls['students'] = [u for u in data.pop('students', []) if u in users_data]
+        for student_username in cls['students']:
+            users_data[student_username]['class_id'] = cls['id']
+        data['classes'] = {cls['id']: cls}
+        changed = True
+    if changed:
+        save_users(users_data)
+
+# Class rollups: precomputed per-class stats, refreshed when a member writes
+def rebuild_class_rollup(users_data, cls, today=None):
+    today = today or datetime.now().date().toordinal()
+    window = {'last_day': today, 'series': {'workouts': [0] * ACTIVITY_WINDOW_DAYS}}
+    rollup = {'napfa': {}, 'last_workout': {}, 'window': window,
+              'houses': {house: {'points': 0, 'workouts': 0, 'members': []} for house in ROSTER_HOUSES}}
+    for student_username in cls['students']:
+        student = users_data.get(student_username, {})
+        if student.get('house') in rollup['houses']:
+            house = rollup['houses'][student['house']]
+            house['points'] += student.get('house_points_contributed', 0)
+            house['workouts'] += len(student.get('exercises', []))
+            house['members'].append(student_username)
+        if student.get('napfa_history'):
+            latest = student['napfa_history'][-1]
+            rollup['napfa'][student_username] = {'total': latest['total'], 'medal': napfa_medal(latest)}
+        if student.get('exercises'):
+            rollup['last_workout'][student_username] = student['exercises'][0]['date']
+            student_window = get_activity_window(student)
+            for day in range(today - ACTIVITY_WINDOW_DAYS + 1, today + 1):
+                window['series']['workouts'][day % ACTIVITY_WINDOW_DAYS] += window_sum(student_window, 'workouts', 1, day)
+    cls['rollup'] = rollup
+    return rollup
+
+def get_class_rollup(users_data, cls):
+    return cls.get('rollup') or rebuild_class_rollup(users_data, cls)
+
+def update_class_rollup(users_data, student_username, student_data, kind, entry, house_pts=0):
+    """O(1) refresh of the student's class rollup after a workout or NAPFA test. Does not save."""
+    cls = get_student_class(users_data, student_data)
+    if cls is None or cls.get('rollup') is None:
+        return
+    rollup = cls['rollup']
+    if kind == 'workout':
+        day = datetime.strptime(entry['date'], '%Y-%m-%d').toordinal()
+        roll_activity_window(rollup['window'], day)
+        rollup['window']['series']['workouts'][day % ACTIVITY_WINDOW_DAYS] += 1
+        rollup['last_workout'][student_username] = max(entry['date'], rollup['last_workout'].get(student_username, ''))
+        if student_data.get('house') in rollup.get('houses', {}):
+            rollup['houses'][student_data['house']]['points'] += house_pts
+            rollup['houses'][student_data['house']]['workouts'] += 1
+    elif kind == 'napfa':
+        rollup['napfa'][student_username] = {'total': entry['total'], 'medal': napfa_medal(entry)}
+
+def class_overview_stats(users_data, cls, today=None):
+    """Headline numbers for the class overview, read from the rollup."""
+    today = today or datetime.now().date().toordinal()
+    rollup = get_class_rollup(users_data, cls)
+    week_start = datetime.fromordinal(today - 6).strftime('%Y-%m-%d')
+    scores = [n['total'] for n in rollup['napfa'].values()]
+    medal_counts = {'Gold': 0, 'Silver': 0, 'Bronze': 0, 'No Medal': 0}
+    for n in rollup['napfa'].values():
+        medal_counts[n['medal'] if n['medal'] in medal_counts else 'No Medal'] += 1
+    return {
+        'students': len(cls['students']),
+        'napfa_scores': scores,
+        'avg_napfa': sum(scores) / len(scores) if scores else None,
+        'active_this_week': sum(1 for d in rollup['last_workout'].values() if d >= week_start),
+        'workouts_this_week': window_sum(rollup['window'], 'workouts', 7, today),
+        'medal_counts': medal_counts,
+        'top': sorted(rollup['napfa'].items(), key=lambda x: x[1]['total'], reverse=True)
+    }
+
+# Class Roster
+ROSTER_HOUSES = ['yellow', 'red', 'blue', 'green', 'black']
+
+def new_student_record(email, password, name, gender='m', birthday=None, age=None, school='',
+                       house=None, show_on_leaderboards=False):
+    """A fresh student account, shared by sign-up and roster import."""
+    return {
+        'email': email.lower(),
+        'password': password,
+        'role': 'student',
+        'name': name,
+        'birthday': birthday,
+        'age': age,
+        'gender': gender,
+        'school': school,
+        'house': house,
+        'house_points_contributed': 0,
+        'total_workout_hours': 0,
+        'show_on_leaderboards': show_on_leaderboards,
+        'created': datetime.now().isoformat(),
+        'bmi_history': [],
+        'napfa_history': [],
+        'sleep_history': [],
+        'exercises': [],
+        'goals': [],
+        'schedule': [],
+        'saved_workout_plan': None,
+        'friends': [],
+        'friend_requests': [],
+        'badges': [],
+        'level': 'Novice',
+        'total_points': 0,
+        'last_login': datetime.now().isoformat(),
+        'login_streak': 0,
+        'active_challenges': [],
+        'completed_challenges': [],
+        'teacher_class': None,
+        'class_id': None,
+        'email_verified': True
+    }
+
+def unique_username(email, taken):
+    un = email.split('@')[0].replace('.', '_')
+    orig = un; c2 = 1
+    while un in taken:
+        un = f"{orig}{c2}"; c2 += 1
+    return un
+
+def build_email_index(users_data):
+    return {data['email'].lower(): username for username, data in users_data.items() if data.get('email')}
+
+def get_email_index():
+    return get_cached_index('email_index', build_email_index)
+
+def parse_roster_csv(text):
+    """Read roster rows (email, name, optional gender/house/birthday) from CSV text. Returns (rows, errors)."""
+    reader = csv.DictReader(text.splitlines())
+    if not reader.fieldnames:
+        return [], ["The file is empty."]
+    reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+    if 'email' not in reader.fieldnames or 'name' not in reader.fieldnames:
+        return [], ["The CSV needs 'email' and 'name' columns."]
+
+    rows, errors, seen = [], [], set()
+    for line_no, raw in enumerate(reader, start=2):
+        email = (raw.get('email') or '').strip().lower()
+        name = (raw.get('name') or '').strip()
+        if '@' not in email or not name:
+            errors.append(f"Line {line_no}: missing or invalid email/name")
+            continue
+        if email in seen:
+            errors.append(f"Line {line_no}: duplicate email {email}")
+            continue
+        seen.add(email)
+        gender = (raw.get('gender') or 'm').strip().lower()[:1]
+        house = (raw.get('house') or '').strip().lower()
+        rows.append({
+            'email': email,
+            'name': name,
+            'gender': 'f' if gender == 'f' else 'm',
+            'house': house if house in ROSTER_HOUSES else None,
+            'birthday': (raw.get('birthday') or '').strip() or None
+        })
+    return rows, errors
+
+def import_roster(users_data, cls, rows, email_index):
+    """Create missing accounts and assign everyone to the class, all or nothing.
+    Mutates users_data and email_index only if the whole roster fits; the caller saves once."""
+    import random as _rand, string as _str
+    teacher_data = users_data[cls['teacher']]
+    current = set(cls['students'])
+
+    created, added, skipped = [], [], []
+    new_members = []
+    for row in rows:
+        username = email_index.get(row['email'])
+        if username is None:
+            new_members.append((None, row))
+        elif users_data[username].get('role') != 'student':
+            skipped.append((row['email'], "not a student account"))
+        elif users_data[username].get('class_id') not in (None, cls['id']):
+            skipped.append((row['email'], "already in another class"))
+        elif username in current:
+            skipped.append((row['email'], "already in this class"))
+        else:
+            new_members.append((username, row))
+
+    free = class_capacity(cls) - len(current)
+    if len(new_members) > free:
+        return {'ok': False, 'error': f"Roster needs {len(new_members)} places but the class only has {free} free.",
+                'created': [], 'added': [], 'skipped': skipped}
+
+    school = teacher_data.get('school', '')
+    for username, row in new_members:
+        if username is None:
+            username = unique_username(row['email'], users_data)
+            password = ''.join(_rand.choices(_str.ascii_letters + _str.digits, k=8))
+            users_data[username] = new_student_record(row['email'], password, row['name'], gender=row['gender'],
+                                                      birthday=row['birthday'], school=school, house=row['house'])
+            email_index[row['email']] = username
+            created.append({'username': username, 'email': row['email'], 'name': row['name'], 'password': password})
+        else:
+            added.append(username)
+        cls['students'].append(username)
+        users_data[username]['class_id'] = cls['id']
+        users_data[username]['teacher_class'] = cls['teacher']
+    if cls.get('rollup') is not None:
+        rebuild_class_rollup(users_data, cls)
+
+    return {'ok': True, 'error': None, 'created': created, 'added': added, 'skipped': skipped}
+
 # Login Page
 def login_page():
     st.markdown('<div class="main-header"><h1>FitTrack</h1><p>School of Science and Technology Singapore</p><p>Your Personal Fitness Companion</p></div>', unsafe_allow_html=True)
@@ -747,64 +1265,28 @@ def login_page():
 
         def create_account():
             """Create the account and reset verification state."""
-            un = new_email.split('@')[0].replace('.', '_')
-            orig = un; c2 = 1
-            while un in st.session_state.users_data:
-                un = f"{orig}{c2}"; c2 += 1
+            un = unique_username(new_email, st.session_state.users_data)
 
             if role == "Student":
-                st.session_state.users_data[un] = {
-                    'email': new_email.lower(),
-                    'password': new_password,
-                    'role': 'student',
-                    'name': full_name,
-                    'birthday': birthday.isoformat(),
-                    'age': age,
-                    'gender': 'm' if gender == "Male" else 'f',
-                    'school': school,
-                    'house': selected_house,
-                    'house_points_contributed': 0,
-                    'total_workout_hours': 0,
-                    'show_on_leaderboards': show_on_leaderboards,
-                    'created': datetime.now().isoformat(),
-                    'bmi_history': [],
-                    'napfa_history': [],
-                    'sleep_history': [],
-                    'exercises': [],
-                    'goals': [],
-                    'schedule': [],
-                    'saved_workout_plan': None,
-                    'friends': [],
-                    'friend_requests': [],
-                    'badges': [],
-                    'level': 'Novice',
-                    'total_points': 0,
-                    'last_login': datetime.now().isoformat(),
-                    'login_streak': 0,
-                    'active_challenges': [],
-                    'completed_challenges': [],
-                    'teacher_class': None,
-                    'email_verified': True
-                }
+                st.session_state.users_data[un] = new_student_record(
+                    new_email, new_password, full_name,
+                    gender='m' if gender == "Male" else 'f',
+                    birthday=birthday.isoformat(), age=age, school=school,
+                    house=selected_house, show_on_leaderboards=show_on_leaderboards
+                )
+                add_house_member(un, selected_house)
                 if class_code:
-                    for t_un, t_data in st.session_state.users_data.items():
-                        if t_data.get('role') == 'teacher' and t_data.get('class_code') == class_code:
-                            cur = t_data.get('students', [])
-                            if len(cur) >= 30:
-                                st.warning("Class is full. Contact your teacher.")
-                            else:
-                                st.session_state.users_data[un]['teacher_class'] = t_un
-                                cur.append(un)
-                                st.session_state.users_data[t_un]['students'] = cur
-                                lbl = t_data.get('class_label') or f"{t_data['name']}'s class"
-                                st.success(f"Joined **{lbl}**!")
-                            break
-                    else:
+                    joined_class = get_class(st.session_state.users_data, find_class_by_code(class_code))
+                    if joined_class is None:
                         st.warning("Invalid class code. You can join a class later.")
+                    elif not assign_student_to_class(st.session_state.users_data, un, joined_class):
+                        st.warning("Class is full. Contact your teacher.")
+                    else:
+                        st.success(f"Joined **{get_class_label(joined_class, st.session_state.users_data)}**!")
 
             else:  # Teacher
-                import random as _rand2, string as _str
-                gen_code = ''.join(_rand2.choices(_str.ascii_uppercase + _str.digits, k=6))
+                gen_code = generate_class_code(st.session_state.users_data)
+                first_class = new_class(un, class_label, gen_code)
                 st.session_state.users_data[un] = {
                     'email': new_email.lower(),
                     'password': new_password,
@@ -816,9 +1298,7 @@ def login_page():
                     'school': school,
                     'department': department,
                     'created': datetime.now().isoformat(),
-                    'class_code': gen_code,
-                    'class_label': class_label,
-                    'students': [],
+                    'classes': {first_class['id']: first_class},
                     'classes_created': [],
                     'last_login': datetime.now().isoformat(),
                     'house': None,
@@ -838,14 +1318,16 @@ def login_page():
                     'level': 'Novice',
                     'total_points': 0,
                     'login_streak': 0,
-                    'groups': [],
                     'group_invites': [],
                     'smart_goals': [],
                     'email_verified': True
                 }
                 st.info(f"Your Class Code: **{gen_code}** — Share this with your students!")
+                if ensure_school_admin(st.session_state.users_data, un):
+                    st.info("You are listed as a school admin, so you can also open School Analytics.")
 
             save_users(st.session_state.users_data)
+            save_school_data(st.session_state.school_data)
             st.session_state.verify_otp = None
             st.session_state.verify_email = None
             st.session_state.verify_pending = False
@@ -859,8 +1341,7 @@ def login_page():
                     st.error("Passwords do not match.")
                 elif len(new_password) < 6:
                     st.error("Password must be at least 6 characters.")
-                elif any(data.get('email', '').lower() == new_email.lower()
-                         for data in st.session_state.users_data.values()):
+                elif new_email.lower() in get_email_index():
                     st.error("Email already registered.")
                 else:
                     import random as _rand
@@ -996,6 +1477,7 @@ def bmi_calculator():
             'height': height,
             'category': category
         })
+        reschedule_after(user_data, 'bmi', user_data['bmi_history'][-1]['date'])
         update_user_data(user_data)
 
         # Display results
@@ -1113,6 +1595,7 @@ def napfa_calculator():
                 'total': total,
                 'medal': medal
             })
+            on_napfa_saved(st.session_state.username, user_data)
             update_user_data(user_data)
 
             # Display results
@@ -1144,54 +1627,53 @@ def napfa_calculator():
 def sleep_tracker():
     st.header("Sleep Tracker")
 
-    col1, col2 = st.columns(2)
+    col1, col2, col3 = st.columns(3)
     with col1:
         sleep_start = st.time_input("Sleep Start Time", value=None)
     with col2:
         sleep_end = st.time_input("Wake Up Time", value=None)
+    with col3:
+        wake_date = st.date_input("Woke Up On", value=datetime.now().date(), max_value=datetime.now().date())
+    overlap_action = "Replace it"
+    if sleep_start and sleep_end:
+        # Overnight sleep started the day before waking
+        end = datetime.combine(wake_date, sleep_end)
+        start = datetime.combine(wake_date, sleep_start)
+        if start > end:
+            start -= timedelta(days=1)
+        overlapping = sleep_overlaps(get_user_data(), start, end) if start < end else []
+        if overlapping:
+            st.warning("This overlaps sleep you already saved: " +
+                       ", ".join(f"{r['start']} → {r['end'][11:]}" for r in overlapping))
+            overlap_action = st.radio("What should happen to it?", ["Replace it", "Merge them into one session"],
+                                      horizontal=True, key="sleep_overlap_action")
 
     if st.button("Calculate Sleep"):
-        if sleep_start and sleep_end:
-            # Convert to datetime for calculation
-            start = datetime.combine(datetime.today(), sleep_start)
-            end = datetime.combine(datetime.today(), sleep_end)
-
-            # Handle overnight sleep
-            if end < start:
-                end += timedelta(days=1)
-
-            diff = end - start
-            hours = diff.seconds // 3600
-            minutes = (diff.seconds % 3600) // 60
+        if sleep_start and sleep_end and start == end:
+            st.error("Sleep start and wake up times are the same. Please check them.")
+        elif sleep_start and sleep_end:
+            user_data = get_user_data()
+            sleep_entry, replaced = log_sleep_session(user_data, start, end, merge=overlap_action.startswith("Merge"))
+            update_user_data(user_data)
 
-            if hours >= 8:
-                quality = "Excellent"
+            hours, minutes = sleep_entry['hours'], sleep_entry['minutes']
+            quality = sleep_entry['quality']
+            if quality == "Excellent":
                 color = "#4caf50"
                 advice = "Great job! You're getting enough sleep."
-            elif hours >= 7:
-                quality = "Good"
+            elif quality == "Good":
                 color = "#8bc34a"
                 advice = "Good sleep duration. Try to get a bit more."
-            elif hours >= 6:
-                quality = "Fair"
+            elif quality == "Fair":
                 color = "#ff9800"
                 advice = "You need more sleep. Aim for 8-10 hours per night."
             else:
-                quality = "Poor"
                 color = "#f44336"
                 advice = "You need more sleep. Aim for 8-10 hours per night."
-
-            # Save to history
-            user_data = get_user_data()
-            user_data['sleep_history'].append({
-                'date': datetime.now().strftime('%Y-%m-%d'),
-                'sleep_start': str(sleep_start),
-                'sleep_end': str(sleep_end),
-                'hours': hours,
-                'minutes': minutes,
-                'quality': quality
-            })
-            update_user_data(user_data)
+            if replaced:
+                verb = "Merged with" if overlap_action.startswith("Merge") else "Replaced"
+                st.info(f"{verb} {len(replaced)} overlapping session(s): " +
+                        ", ".join(f"{r['start']} → {r['end'][11:]}" for r in replaced))
 
             # Display results
             col1, col2 = st.columns(2)
@@ -1205,14 +1687,508 @@ def sleep_tracker():
 
             # Show history chart if there's data
             if len(user_data['sleep_history']) > 1:
-                df = pd.DataFrame(user_data['sleep_history'])
-                df['total_hours'] = df['hours'] + df['minutes'] / 60
-                df_chart = df.set_index('date')['total_hours']
                 st.subheader("Sleep Duration History (hours)")
-                st.line_chart(df_chart)
+                st.line_chart(sleep_chart_frame(user_data, days=90))
         else:
             st.error("Please enter both sleep start and end times")
 
+# Sleep Sessions
+# A sleep entry is a session with start/end timestamps ('YYYY-MM-DD HH:MM') and a stored duration_min;
+# 'date' is the day it ended. sleep_history is kept sorted by start with no overlaps, and
+# user_data['sleep_index'] holds the matching [start, end, id] rows, so both starts and ends are sorted
+# and the sessions touching a new one are found with bisect.
+SLEEP_TIME_FORMAT = '%Y-%m-%d %H:%M'
+
+def sleep_hours(entry):
+    """Hours slept in a sleep_history entry."""
+    if 'duration_min' in entry:
+        return entry['duration_min'] / 60
+    return entry['hours'] + entry['minutes'] / 60
+
+def make_sleep_entry(start, end):
+    """A sleep_history entry for start..end (datetimes)."""
+    duration = int((end - start).total_seconds() // 60)
+    return {
+        'id': new_id(),
+        'date': end.strftime('%Y-%m-%d'),
+        'start': start.strftime(SLEEP_TIME_FORMAT),
+        'end': end.strftime(SLEEP_TIME_FORMAT),
+        'duration_min': duration,
+        'sleep_start': start.strftime('%H:%M:%S'),
+        'sleep_end': end.strftime('%H:%M:%S'),
+        'hours': duration // 60,
+        'minutes': duration % 60,
+        'quality': sleep_quality(duration / 60)
+    }
+
+def _session_from_legacy(entry):
+    """Entries from before sessions were stored as a wake time on 'date' plus hours/minutes."""
+    end_time = entry.get('sleep_end') if entry.get('sleep_end') not in (None, 'None') else '07:00'
+    end = datetime.strptime(f"{entry['date']} {end_time[:5]}", SLEEP_TIME_FORMAT)
+    start = end - timedelta(minutes=entry['hours'] * 60 + entry['minutes'])
+    session = make_sleep_entry(start, end)
+    session['date'] = entry['date']
+    return session
+
+def _sleep_touching(index, start, end):
+    """Positions of sessions overlapping start..end. Rows are disjoint, so ends are sorted like starts."""
+    lo = bisect.bisect_right(index, start, key=lambda row: row[1])
+    hi = bisect.bisect_left(index, end, key=lambda row: row[0])
+    return range(lo, max(lo, hi))
+
+def _insert_session(user_data, index, entry, merge):
+    """Insert entry, replacing (or with merge=True, absorbing) any sessions it overlaps.
+    Returns (entry stored, removed entries, position)."""
+    history = user_data['sleep_history']
+    touching = _sleep_touching(index, entry['start'], entry['end'])
+    removed = [history[i] for i in touching]
+    if removed and merge:
+        start = min([entry['start']] + [r['start'] for r in removed])
+        end = max([entry['end']] + [r['end'] for r in removed])
+        merged = make_sleep_entry(datetime.strptime(start, SLEEP_TIME_FORMAT), datetime.strptime(end, SLEEP_TIME_FORMAT))
+        entry = dict(merged, id=entry['id'])
+    if removed:
+        del history[touching.start:touching.stop]
+        del index[touching.start:touching.stop]
+    position = bisect.bisect_left(index, entry['start'], key=lambda row: row[0])
+    history.insert(position, entry)
+    index.insert(position, [entry['start'], entry['end'], entry['id']])
+    return entry, removed, position
+
+def build_sleep_index(user_data):
+    """Convert legacy entries to sessions, sort them, and let later entries replace overlapping earlier ones.
+    Does not save."""
+    legacy = user_data.get('sleep_history', [])
+    user_data['sleep_history'] = []
+    index = []
+    for entry in legacy:
+        session = entry if 'start' in entry else _session_from_legacy(entry)
+        session.setdefault('id', new_id())
+        _insert_session(user_data, index, session, merge=False)
+    user_data['sleep_index'] = index
+    return index
+
+def get_sleep_index(user_data):
+    index = user_data.get('sleep_index')
+    if index is None or len(index) != len(user_data.get('sleep_history', [])):
+        index = build_sleep_index(user_data)
+    return index
+
+def sleep_overlaps(user_data, start, end):
+    """Saved sessions overlapping start..end (datetimes)."""
+    index = get_sleep_index(user_data)
+    positions = _sleep_touching(index, start.strftime(SLEEP_TIME_FORMAT), end.strftime(SLEEP_TIME_FORMAT))
+    return [user_data['sleep_history'][i] for i in positions]
+
+def night_sessions(user_data, date_str):
+    """Sessions that ended on date_str."""
+    index = get_sleep_index(user_data)
+    lo = bisect.bisect_left(index, date_str, key=lambda row: row[1])
+    hi = bisect.bisect_left(index, _shift_date(date_str, 1), key=lambda row: row[1])
+    return user_data['sleep_history'][lo:hi]
+
+def log_sleep_session(user_data, start, end, merge=False):
+    """Save a sleep session, replacing or merging the sessions it overlaps, and update everything derived
+    from sleep_history. Returns (entry, removed entries). Does not save."""
+    index = get_sleep_index(user_data)
+    entry, removed, position = _insert_session(user_data, index, make_sleep_entry(start, end), merge)
+    if removed or position != len(index) - 1:
+        rebuild_sleep_derived(user_data)
+    else:
+        on_sleep_logged(user_data, entry)
+    return entry, removed
+
+def rebuild_sleep_derived(user_data):
+    """Recompute the sleep stats, activity window, nightly series and reminder after history changed in place."""
+    rebuild_personal_sleep_stats(user_data)
+    build_activity_window(user_data)
+    build_sleep_series(user_data)
+    if user_data.get('sleep_history'):
+        reschedule_after(user_data, 'sleep', user_data['sleep_history'][-1]['date'])
+        update_goals(user_data, 'sleep', user_data['sleep_history'][-1])
+
+# Sleep Analytics
+# One slot per night (keyed by the day its sessions ended) holding hours slept and bed/wake times as minutes
+# after noon, so an overnight sleep is one unbroken interval. All-time totals, quality counts and best/worst
+# nights are updated on each write; the rolling figures only ever look at the last SLEEP_REGULARITY_NIGHTS.
+SLEEP_FIELDS = ('hours', 'bed', 'wake')
+SLEEP_QUALITY_BANDS = [(8, 'Excellent'), (7, 'Good'), (6, 'Fair'), (0, 'Poor')]
+SLEEP_TARGET_HOURS = 8
+SLEEP_ROLLING_NIGHTS = 7
+SLEEP_REGULARITY_NIGHTS = 14
+SLEEP_CHART_POINTS = 120
+
+def sleep_quality(hours):
+    return next(label for floor, label in SLEEP_QUALITY_BANDS if hours >= floor)
+
+def new_sleep_series():
+    return {'origin': None, **{field: [] for field in SLEEP_FIELDS},
+            'summary': {'nights': 0, 'total_hours': 0.0, 'quality': {label: 0 for _, label in SLEEP_QUALITY_BANDS},
+                        'best': None, 'worst': None, 'rolling': {}}}
+
+def _sleep_night(sessions):
+    """(day ordinal, hours, bed, wake) for the sessions ending on one day. Hours are summed; bed/wake are
+    the longest session's, in minutes after noon."""
+    main = max(sessions, key=lambda entry: entry['duration_min'])
+    bed = (_minutes(main['start'][11:]) - 12 * 60) % (24 * 60)
+    hours = sum(sleep_hours(entry) for entry in sessions)
+    return _day_ordinal(main['date']), round(hours, 2), bed, bed + main['duration_min']
+
+def _sleep_extremes(series):
+    hours = np.array([np.nan if h is None else h for h in series['hours']])
+    if np.isnan(hours).all():
+        return None, None
+    day = lambda i: datetime.fromordinal(series['origin'] + int(i)).strftime('%Y-%m-%d')
+    best, worst = np.nanargmax(hours), np.nanargmin(hours)
+    return [day(best), float(hours[best])], [day(worst), float(hours[worst])]
+
+def _put_sleep_night(series, ordinal, hours, bed, wake):
+    """Write one night's totals over any earlier ones for the same day, and update the all-time summary."""
+    index = _day_slot(series, SLEEP_FIELDS, ordinal, fill=None)
+    summary = series['summary']
+    previous = series['hours'][index]
+    series['hours'][index], series['bed'][index], series['wake'][index] = hours, bed, wake
+    if previous is None:
+        summary['nights'] += 1
+    else:
+        summary['total_hours'] -= previous
+        summary['quality'][sleep_quality(previous)] -= 1
+    summary['total_hours'] = round(summary['total_hours'] + hours, 2)
+    summary['quality'][sleep_quality(hours)] += 1
+    date_str = datetime.fromordinal(ordinal).strftime('%Y-%m-%d')
+    best, worst = summary['best'], summary['worst']
+    if previous is not None and (best and best[0] == date_str or worst and worst[0] == date_str):
+        summary['best'], summary['worst'] = _sleep_extremes(series)
+    else:
+        if best is None or hours > best[1]:
+            summary['best'] = [date_str, hours]
+        if worst is None or hours < worst[1]:
+            summary['worst'] = [date_str, hours]
+
+def sleep_rolling_stats(series, end=None):
+    """7-night average and debt, sleep regularity index and bedtime drift for the nights up to end (ordinal)."""
+    if series['origin'] is None:
+        return {}
+    end = series['origin'] + len(series['hours']) - 1 if end is None else end
+    lo = max(end - SLEEP_REGULARITY_NIGHTS + 1 - series['origin'], 0)
+    hi = max(end + 1 - series['origin'], 0)
+    as_array = lambda field: np.array([np.nan if v is None else v for v in series[field][lo:hi]], dtype=float)
+    hours, bed, wake = as_array('hours'), as_array('bed'), as_array('wake')
+    recent = hours[-SLEEP_ROLLING_NIGHTS:]
+    recent = recent[~np.isnan(recent)]
+    stats = {'end': end, 'nights': int(len(recent)),
+             'avg_hours': round(float(recent.mean()), 2) if len(recent) else None,
+             'debt_hours': round(float(np.clip(SLEEP_TARGET_HOURS - recent, 0, None).sum()), 2),
+             'regularity': None, 'bedtime_drift_min': None}
+    # Sleep Regularity Index: chance of being in the same state (asleep/awake) at the same minute on
+    # consecutive days, scaled to -100..100. Each night covers noon..noon, so minutes 0..1439.
+    minute = np.arange(24 * 60)
+    asleep = (minute >= bed[:, None]) & (minute < wake[:, None])
+    pairs = ~np.isnan(bed[:-1]) & ~np.isnan(bed[1:])
+    if pairs.any():
+        same = (asleep[:-1][pairs] == asleep[1:][pairs]).mean()
+        stats['regularity'] = round(float(200 * same - 100), 1)
+    known = ~np.isnan(bed)
+    if known.sum() >= 3:
+        stats['bedtime_drift_min'] = round(float(np.polyfit(np.flatnonzero(known), bed[known], 1)[0]), 1) + 0.0
+    return stats
+
+def build_sleep_series(user_data):
+    """Rebuild the nightly series from sleep_history. Does not save."""
+    from itertools import groupby
+    get_sleep_index(user_data)
+    series = new_sleep_series()
+    for _, sessions in groupby(user_data.get('sleep_history', []), key=lambda entry: entry['date']):
+        _put_sleep_night(series, *_sleep_night(list(sessions)))
+    series['summary']['rolling'] = sleep_rolling_stats(series)
+    user_data['sleep_series'] = series
+    return series
+
+def get_sleep_series(user_data):
+    return user_data.get('sleep_series') or build_sleep_series(user_data)
+
+def record_sleep_night(user_data, entry):
+    """Rewrite the night of a new sleep_history entry in the series, after it is stored. Does not save."""
+    if not user_data.get('sleep_series'):
+        build_sleep_series(user_data)  # already includes the new entry
+        return
+    series = user_data['sleep_series']
+    _put_sleep_night(series, *_sleep_night(night_sessions(user_data, entry['date'])))
+    series['summary']['rolling'] = sleep_rolling_stats(series)
+
+def sleep_summary(user_data, today=None):
+    """The all-time summary with rolling stats as of today (recomputed only if nights were missed since)."""
+    series = get_sleep_series(user_data)
+    summary = dict(series['summary'])
+    today = (today or datetime.now().date()).toordinal()
+    if summary['rolling'].get('end') != today and series['origin'] is not None:
+        summary['rolling'] = sleep_rolling_stats(series, today)
+    summary['avg_hours'] = round(summary['total_hours'] / summary['nights'], 2) if summary['nights'] else None
+    return summary
+
+def sleep_chart_frame(user_data, days=None, max_points=SLEEP_CHART_POINTS, today=None):
+    """Nightly hours and the 7-night rolling average up to today, averaged into equal-width buckets when
+    there are more than max_points nights. Missing nights are gaps."""
+    series = get_sleep_series(user_data)
+    if series['origin'] is None:
+        return pd.DataFrame(columns=['Hours', '7-Night Avg'])
+    end = (today or datetime.now().date()).toordinal()
+    start = series['origin'] if days is None else max(series['origin'], end - days + 1)
+    lead = min(SLEEP_ROLLING_NIGHTS - 1, start - series['origin'])
+    hours = np.full(max(end - start + 1 + lead, 0), np.nan)
+    column = [np.nan if h is None else h for h in series['hours'][start - lead - series['origin']:end - series['origin'] + 1]]
+    hours[:len(column)] = column
+    frame = pd.DataFrame({'Hours': hours})
+    frame['7-Night Avg'] = frame['Hours'].rolling(SLEEP_ROLLING_NIGHTS, min_periods=1).mean()
+    frame = frame.iloc[lead:].reset_index(drop=True)
+    width = -(-len(frame) // max_points) if len(frame) > max_points else 1
+    if width > 1:
+        frame = frame.groupby(frame.index // width).mean()
+    frame.index = pd.to_datetime([datetime.fromordinal(start + i * width) for i in range(len(frame))])
+    return frame
+
+# GPS Tracks
+# Trackpoints are streamed from GPX/TCX (iterparse) or FIT (fitdecode, optional) into arrays, and
+# every statistic is computed on the whole array at once. The raw track is kept as a compressed
+# .npz under TRACKS_DIR; the workout only stores the summary and the file path.
+TRACKS_DIR = 'tracks'
+EARTH_RADIUS_M = 6371008.8
+TRACK_MAX_GAP_S = 30        # longer gaps (auto-pause) are not moving time
+TRACK_MOVING_SPEED = 0.5    # m/s
+STEPS_PER_MIN = {"Walk": 100, "Jog": 140, "Run": 170, "Sprint": 200}
+
+def iter_track_points_xml(source):
+    """Yield (time text, lat, lon, elevation or nan) from GPX trkpt or TCX Trackpoint elements. Only fields
+    inside a point count, so waypoint, route and metadata values are ignored; empty fields are skipped."""
+    import xml.etree.ElementTree as ET
+    point, in_point = {}, False
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        name = _local_name(elem.tag)
+        if name in ('trkpt', 'Trackpoint'):
+            if event == 'start':
+                point, in_point = {}, True
+                continue
+            if name == 'trkpt' and elem.get('lat') and elem.get('lon'):
+                point['lat'], point['lon'] = float(elem.get('lat')), float(elem.get('lon'))
+            if 'lat' in point and 'lon' in point and point.get('time'):
+                yield point['time'], point['lat'], point['lon'], point.get('ele', np.nan)
+            point, in_point = {}, False
+            elem.clear()
+        elif event == 'end' and in_point:
+            text = (elem.text or '').strip()
+            if not text:
+                continue
+            if name in ('time', 'Time'):
+                point['time'] = text
+            elif name in ('ele', 'AltitudeMeters'):
+                point['ele'] = float(text)
+            elif name == 'LatitudeDegrees':
+                point['lat'] = float(text)
+            elif name == 'LongitudeDegrees':
+                point['lon'] = float(text)
+
+def iter_track_points_fit(source):
+    """Yield (datetime, lat, lon, elevation or nan) from FIT record messages. Needs the fitdecode package."""
+    import fitdecode
+    semicircle = 180 / 2 ** 31
+    try:
+        with fitdecode.FitReader(source) as fit:
+            for frame in fit:
+                if frame.frame_type != fitdecode.FIT_FRAME_DATA or frame.name != 'record':
+                    continue
+                if not (frame.has_field('position_lat') and frame.has_field('timestamp')):
+                    continue
+                lat, lon = frame.get_value('position_lat'), frame.get_value('position_long')
+                if lat is None or lon is None:
+                    continue
+                ele = next((frame.get_value(f) for f in ('enhanced_altitude', 'altitude') if frame.has_field(f)), None)
+                yield frame.get_value('timestamp'), lat * semicircle, lon * semicircle, np.nan if ele is None else ele
+    except fitdecode.FitError as e:
+        raise ValueError(f"not a valid FIT file ({e})") from e
+
+def read_track(file, filename):
+    """(start as local datetime, {'t', 'lat', 'lon', 'ele'} arrays) from an uploaded GPX/TCX/FIT file."""
+    from array import array
+    points = iter_track_points_fit(file) if filename.lower().endswith('.fit') else iter_track_points_xml(file)
+    stamps, lat, lon, ele = [], array('d'), array('d'), array('d')
+    for stamp, y, x, z in points:
+        stamps.append(stamp)
+        lat.append(y)
+        lon.append(x)
+        ele.append(z)
+    if len(stamps) < 2:
+        return None, None
+    parsed = pd.to_datetime(pd.Index(stamps), utc=True, format='ISO8601' if isinstance(stamps[0], str) else None)
+    track = {
+        't': np.asarray((parsed - parsed[0]) / pd.Timedelta(seconds=1), dtype=float),
+        'lat': np.frombuffer(lat, dtype=float),
+        'lon': np.frombuffer(lon, dtype=float),
+        'ele': np.frombuffer(ele, dtype=float)
+    }
+    start = parsed[0].tz_convert(datetime.now().astimezone().tzinfo).tz_localize(None).to_pydatetime()
+    return start, track
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in metres between arrays of points (degrees)."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def track_summary(track):
+    """Distance, moving time, elevation gain and per-km pace splits for a track."""
+    t, lat, lon, ele = track['t'], track['lat'], track['lon'], track['ele']
+    seg = haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    dt = np.diff(t)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        moving = (dt > 0) & (dt <= TRACK_MAX_GAP_S) & (seg / dt >= TRACK_MOVING_SPEED)
+    distance = float(seg.sum())
+    moving_s = float(dt[moving].sum())
+
+    # Elevation gain on a 5-point moving average so GPS noise does not add up
+    valid = ele[~np.isnan(ele)]
+    if len(valid) >= 5:
+        smooth = np.convolve(valid, np.ones(5) / 5, mode='valid')
+        gain = float(np.clip(np.diff(smooth), 0, None).sum())
+    else:
+        gain = 0.0
+
+    # Split times by interpolating elapsed moving time at each whole kilometre
+    moving_clock = np.r_[0, np.cumsum(np.where(moving, dt, 0))]
+    cum_km = np.r_[0, np.cumsum(seg)] / 1000
+    marks = np.arange(1, int(cum_km[-1]) + 1)
+    split_times = np.interp(marks, cum_km, moving_clock)
+    splits = np.diff(np.r_[0, split_times]) / 60
+
+    return {
+        'distance_km': round(distance / 1000, 2),
+        'elapsed_min': round(float(t[-1] - t[0]) / 60, 1),
+        'moving_min': round(moving_s / 60, 1),
+        'avg_speed_kmh': round(distance / moving_s * 3.6, 1) if moving_s else 0.0,
+        'avg_pace_min_km': round(moving_s / 60 / (distance / 1000), 2) if distance else None,
+        'elevation_gain_m': round(gain, 1),
+        'splits_min_km': [round(float(x), 2) for x in splits],
+        'points': int(len(t))
+    }
+
+def save_track(username, workout_id, track):
+    """Write the raw track compressed: positions as int32 1e-7 degrees (~1 cm), time and elevation as float32.
+    Returns the file path."""
+    folder = os.path.join(TRACKS_DIR, username)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{workout_id}.npz")
+    np.savez_compressed(path, t=track['t'].astype(np.float32), ele=track['ele'].astype(np.float32),
+                        lat_e7=np.round(track['lat'] * 1e7).astype(np.int32),
+                        lon_e7=np.round(track['lon'] * 1e7).astype(np.int32))
+    return path
+
+def load_track(path):
+    with np.load(path) as data:
+        return {'t': data['t'].astype(float), 'lat': data['lat_e7'] / 1e7, 'lon': data['lon_e7'] / 1e7,
+                'ele': data['ele'].astype(float)}
+
+def track_profile(track, max_points=500):
+    """Route points and an elevation-by-distance profile, thinned to at most max_points for charting."""
+    step = max(1, -(-len(track['t']) // max_points))
+    cum_km = np.r_[0, np.cumsum(haversine_m(track['lat'][:-1], track['lon'][:-1], track['lat'][1:], track['lon'][1:]))] / 1000
+    route = pd.DataFrame({'lat': track['lat'][::step], 'lon': track['lon'][::step]})
+    elevation = pd.Series(track['ele'][::step], index=np.round(cum_km[::step], 3), name="Elevation (m)")
+    return route, elevation.dropna()
+
+def delete_track(workout):
+    """Remove a workout's stored track file; the GPS summary stays on the workout. Does not save."""
+    path = workout.pop('track_file', None)
+    if path and os.path.exists(path):
+        os.remove(path)
+
+# Step Series
+# Daily step totals live in fixed-width columns indexed by day ordinal minus 'origin', so logging a
+# day is an index write and any date range is a slice. Replaces the ever-growing steps_data list.
+STEP_FIELDS = ('steps', 'distance_km', 'minutes')
+STEP_CHART_POINTS = 120
+
+def new_step_series():
+    return {'origin': None, **{field: [] for field in STEP_FIELDS}}
+
+def _day_ordinal(date_str):
+    return datetime.strptime(date_str, '%Y-%m-%d').toordinal()
+
+def _day_slot(series, fields, ordinal, fill=0):
+    """Index for ordinal in a day-indexed series, growing its columns with fill days as needed."""
+    if series['origin'] is None:
+        series['origin'] = ordinal
+    if ordinal < series['origin']:
+        pad = series['origin'] - ordinal
+        for field in fields:
+            series[field][:0] = [fill] * pad
+        series['origin'] = ordinal
+    index = ordinal - series['origin']
+    length = len(series[fields[0]])
+    if index >= length:
+        for field in fields:
+            series[field].extend([fill] * (index + 1 - length))
+    return index
+
+def record_steps(user_data, date_str, steps, distance_km=0, minutes=0, replace=False):
+    """Add to (or with replace=True, overwrite) one day's totals. Does not save."""
+    series = get_step_series(user_data)
+    index = _day_slot(series, STEP_FIELDS, _day_ordinal(date_str))
+    for field, value in zip(STEP_FIELDS, (steps, distance_km, minutes)):
+        total = value if replace else series[field][index] + value
+        series[field][index] = round(total, 2) if field == 'distance_km' else int(total)
+
+def build_step_series(user_data):
+    """Fold any legacy steps_data entries into a new series and drop the list. Does not save."""
+    series = new_step_series()
+    user_data['step_series'] = series
+    for entry in user_data.pop('steps_data', []):
+        if entry.get('date'):
+            record_steps(user_data, entry['date'], entry.get('steps', 0),
+                         entry.get('distance_km', 0), entry.get('duration_min', 0))
+    return series
+
+def get_step_series(user_data):
+    series = user_data.get('step_series')
+    if series is None:
+        series = build_step_series(user_data)
+    return series
+
+def step_totals(user_data, start, end):
+    """Sums of every field for start..end inclusive ('YYYY-MM-DD')."""
+    series = get_step_series(user_data)
+    if series['origin'] is None:
+        return {field: 0 for field in STEP_FIELDS}
+    lo = max(_day_ordinal(start) - series['origin'], 0)
+    hi = max(_day_ordinal(end) - series['origin'] + 1, 0)
+    return {field: round(float(np.sum(series[field][lo:hi])), 2) for field in STEP_FIELDS}
+
+def step_period_totals(user_data, today=None):
+    """Step totals for the current week (Mon-), month and school term."""
+    today = today or datetime.now().date()
+    end = today.strftime('%Y-%m-%d')
+    starts = {
+        'week': today - timedelta(days=today.weekday()),
+        'month': today.replace(day=1),
+        'term': today.replace(month=(today.month - 1) // 3 * 3 + 1, day=1),
+    }
+    return {period: step_totals(user_data, start.strftime('%Y-%m-%d'), end) for period, start in starts.items()}
+
+def step_chart_series(user_data, field='steps', days=None, max_points=STEP_CHART_POINTS, today=None):
+    """Daily totals up to today as a date-indexed Series, summed into equal-width buckets when there are
+    more than max_points days."""
+    series = get_step_series(user_data)
+    if series['origin'] is None:
+        return pd.Series(dtype=float, name=field)
+    end = (today or datetime.now().date()).toordinal()
+    start = series['origin'] if days is None else max(series['origin'], end - days + 1)
+    values = np.zeros(max(end - start + 1, 0))
+    column = np.asarray(series[field][start - series['origin']:end - series['origin'] + 1], dtype=float)
+    values[:len(column)] = column
+    width = -(-len(values) // max_points) if len(values) > max_points else 1
+    if width > 1:
+        values = np.pad(values, (0, -len(values) % width)).reshape(-1, width).sum(axis=1)
+    index = pd.to_datetime([datetime.fromordinal(start + i * width) for i in range(len(values))])
+    return pd.Series(values, index=index, name=field)
+
 # Exercise Logger
 def exercise_logger():
     st.header("Workout Logger")
@@ -1408,6 +2384,7 @@ def exercise_logger():
                         'intensity': intensity,
                         'sets': sets_done,
                         'total_reps': total_reps,
+                        'best_set': max((r for _, r in st.session_state.set_log), default=0),
                         'reps_unit': unit,
                         'notes': notes,
                         'points_earned': points_earned,
@@ -1416,23 +2393,21 @@ def exercise_logger():
                         'has_photo': photo_b64 is not None,
                         'photo_b64': photo_b64,
                         'teacher_override': False,
-                        'workout_type': 'counter'
+                        'workout_type': 'counter',
+                        'id': new_id()
                     }
 
                     user_data['exercises'].insert(0, workout_entry)
-                    user_data['total_points'] = user_data.get('total_points', 0) + points_earned
+                    award_points(user_data, workout_points_key(workout_entry), points_earned, 'workout', workout_entry['date'])
                     house_pts = manual_duration / 60
                     user_data['house_points_contributed'] = user_data.get('house_points_contributed', 0) + house_pts
                     user_data['total_workout_hours'] = user_data.get('total_workout_hours', 0) + (manual_duration / 60)
+                    on_workout_saved(st.session_state.username, user_data, workout_entry, house_pts)
 
                     new_badges, badge_pts = check_and_award_badges(user_data)
-                    if new_badges:
-                        user_data['badges'].extend(new_badges)
-                        user_data['total_points'] += badge_pts
-                        for badge in new_badges:
-                            st.success(f"Badge: {badge['name']} (+{badge['points']} pts)")
+                    for badge in award_badges(user_data, new_badges):
+                        st.success(f"Badge: {badge['name']} (+{badge['points']} pts)")
 
-                    user_data['level'] = calculate_level(user_data['total_points'])[0]
                     update_user_data(user_data)
 
                     # Reset
@@ -1630,11 +2605,36 @@ def exercise_logger():
 
             # - Cardio extra info 
             st.write("---")
+            track_file = st.file_uploader("GPS Track (GPX, TCX or FIT) — optional", type=["gpx", "tcx", "fit"], key="cardio_track")
+            track, track_start, gps = None, None, None
+            if track_file is not None:
+                try:
+                    track_start, track = read_track(track_file, track_file.name)
+                    if track is None:
+                        st.warning("No GPS points found in this file.")
+                except ImportError:
+                    st.error("Reading FIT files needs the fitdecode package. Export a GPX file instead.")
+                except (ValueError, TypeError, SyntaxError) as e:  # ParseError is a SyntaxError
+                    st.error(f"Could not read the track: {e}")
+                if track is not None:
+                    gps = track_summary(track)
+                    g1, g2, g3, g4 = st.columns(4)
+                    g1.metric("Distance", f"{gps['distance_km']:.2f} km")
+                    g2.metric("Moving Time", f"{gps['moving_min']:.0f} min")
+                    g3.metric("Avg Pace", f"{gps['avg_pace_min_km']:.2f} min/km" if gps['avg_pace_min_km'] else "-")
+                    g4.metric("Elevation Gain", f"{gps['elevation_gain_m']:.0f} m")
+                    if gps['splits_min_km']:
+                        st.bar_chart(pd.Series(gps['splits_min_km'], index=[f"km {i + 1}" for i in range(len(gps['splits_min_km']))],
+                                               name="Pace (min/km)"))
+
             cc1, cc2 = st.columns(2)
             with cc1:
-                distance_km = st.number_input("Distance (km) — optional", min_value=0.0, max_value=100.0, value=0.0, step=0.1)
+                distance_km = st.number_input("Distance (km) — optional", min_value=0.0, max_value=100.0,
+                                              value=float(gps['distance_km']) if gps else 0.0, step=0.1)
             with cc2:
-                if distance_km > 0:
+                if gps:
+                    st.metric("Average Speed", f"{gps['avg_speed_kmh']} km/h")
+                elif distance_km > 0:
                     speed_ref = {"Walk": 5, "Jog": 9, "Run": 12, "Sprint": 20}
                     est_speed = speed_ref.get(exercise_type, 10)
                     st.metric("Estimated Speed", f"~{est_speed} km/h")
@@ -1645,7 +2645,10 @@ def exercise_logger():
             st.write("---")
 
             if st.button(" Save Cardio Session", type="primary", use_container_width=True, key="save_cardio"):
-                duration_used = workout_duration_minutes if workout_duration_minutes > 0.1 else st.number_input("Session Duration (minutes)", min_value=1, max_value=300, value=20)
+                if gps:
+                    duration_used = max(gps['moving_min'], 1)
+                else:
+                    duration_used = workout_duration_minutes if workout_duration_minutes > 0.1 else st.number_input("Session Duration (minutes)", min_value=1, max_value=300, value=20)
 
                 points_earned = int(duration_used * 8)
                 verification_status = "unverified"
@@ -1671,8 +2674,7 @@ def exercise_logger():
                     points_earned = int(duration_used * 10)
 
                 house_pts = duration_used / 60
-                steps_per_min = {"Walk": 100, "Jog": 140, "Run": 170, "Sprint": 200}
-                estimated_steps = int(steps_per_min.get(exercise_type, 120) * duration_used)
+                estimated_steps = int(STEPS_PER_MIN.get(exercise_type, 120) * duration_used)
 
                 # Store photo as base64 so teacher can review it
                 photo_b64 = None
@@ -1699,36 +2701,25 @@ def exercise_logger():
                     'has_photo': photo_b64 is not None,
                     'photo_b64': photo_b64,
                     'teacher_override': False,
-                    'workout_type': 'cardio'
+                    'workout_type': 'cardio',
+                    'id': new_id()
                 }
+                if gps:
+                    workout_entry['gps'] = dict(gps, start=track_start.strftime('%Y-%m-%d %H:%M'))
+                    workout_entry['track_file'] = save_track(st.session_state.username, workout_entry['id'], track)
 
                 user_data['exercises'].insert(0, workout_entry)
-                user_data['total_points'] = user_data.get('total_points', 0) + points_earned
+                award_points(user_data, workout_points_key(workout_entry), points_earned, 'workout', workout_entry['date'])
                 user_data['house_points_contributed'] = user_data.get('house_points_contributed', 0) + house_pts
                 user_data['total_workout_hours'] = user_data.get('total_workout_hours', 0) + house_pts
+                on_workout_saved(st.session_state.username, user_data, workout_entry, house_pts)
 
-                # Also log to steps_data
-                if 'steps_data' not in user_data:
-                    user_data['steps_data'] = []
-                steps_entry = {
-                    'date': datetime.now().strftime('%Y-%m-%d'),
-                    'type': 'run_walk',
-                    'activity': exercise_type,
-                    'distance_km': distance_km,
-                    'duration_min': int(duration_used),
-                    'steps': estimated_steps,
-                    'points_earned': points_earned // 10,
-                }
-                user_data['steps_data'].insert(0, steps_entry)
+                record_steps(user_data, workout_entry['date'], estimated_steps, distance_km, int(duration_used))
 
                 new_badges, badge_pts = check_and_award_badges(user_data)
-                if new_badges:
-                    user_data['badges'].extend(new_badges)
-                    user_data['total_points'] += badge_pts
-                    for badge in new_badges:
-                        st.success(f"Badge: {badge['name']} (+{badge['points']} pts)")
+                for badge in award_badges(user_data, new_badges):
+                    st.success(f"Badge: {badge['name']} (+{badge['points']} pts)")
 
-                user_data['level'] = calculate_level(user_data['total_points'])[0]
                 update_user_data(user_data)
 
                 st.success(f"{exercise_type} saved! {int(duration_used)} min · ~{estimated_steps:,} steps · +{points_earned} pts")
@@ -1765,6 +2756,19 @@ def exercise_logger():
             with c3: st.metric("Total Points", total_points_all)
             with c4: st.metric("This Week", len(this_week))
 
+            if get_step_series(user_data)['origin'] is not None:
+                st.write("")
+                st.write("### Steps")
+                periods = step_period_totals(user_data)
+                s1, s2, s3 = st.columns(3)
+                for col, (label, period) in zip((s1, s2, s3), (("This Week", 'week'), ("This Month", 'month'), ("This Term", 'term'))):
+                    with col:
+                        st.metric(f"Steps {label}", f"{int(periods[period]['steps']):,}")
+                        st.caption(f"{periods[period]['distance_km']:.1f} km · {int(periods[period]['minutes'])} min")
+                step_range = st.radio("Show", ["Last 30 days", "Last 90 days", "All time"], horizontal=True, key="steps_chart_range")
+                chart_days = {"Last 30 days": 30, "Last 90 days": 90}.get(step_range)
+                st.bar_chart(step_chart_series(user_data, 'steps', days=chart_days))
+
             st.write("")
             st.write("### Recent Workouts")
 
@@ -1798,6 +2802,25 @@ def exercise_logger():
                 </div>
                 """, unsafe_allow_html=True)
 
+                if ex.get('track_file'):
+                    with st.expander("Route & Splits"):
+                        if not os.path.exists(ex['track_file']):
+                            st.caption("The GPS file for this workout is no longer available.")
+                        else:
+                            route, elevation = track_profile(load_track(ex['track_file']))
+                            st.map(route)
+                            if len(elevation) > 1:
+                                st.caption("Elevation (m) by distance (km)")
+                                st.line_chart(elevation)
+                            splits = ex.get('gps', {}).get('splits_min_km') or []
+                            if splits:
+                                st.bar_chart(pd.Series(splits, index=[f"km {i + 1}" for i in range(len(splits))],
+                                                       name="Pace (min/km)"))
+                        if st.button("Remove GPS Track", key=f"rm_track_{ex['id']}"):
+                            delete_track(ex)
+                            update_user_data(user_data)
+                            st.rerun()
+
             # Breakdown chart
             st.write("")
             st.write("### Exercise Breakdown")
@@ -1809,8 +2832,8 @@ def exercise_logger():
             st.bar_chart(df_chart.set_index('Exercise'))
 
 
-def check_and_award_badges(user_data):
-    """Check if user earned any new badges and award points"""
+def check_and_award_badges(user_data, username=None):
+    """Check if user earned any new badges and award points. username defaults to the logged-in user."""
     badges_earned = []
     points_earned = 0
 
@@ -1919,7 +2942,7 @@ def check_and_award_badges(user_data):
                        if datetime.strptime(s['date'], '%Y-%m-%d') >= week_ago]
 
         if len(recent_sleep) >= 7:
-            good_sleep_count = sum(1 for s in recent_sleep if s['hours'] >= 8)
+            good_sleep_count = sum(1 for s in recent_sleep if sleep_hours(s) >= 8)
 
             if 'Sleep Champion' not in existing_badges and good_sleep_count >= 7:
                 badges_earned.append({
@@ -1931,9 +2954,8 @@ def check_and_award_badges(user_data):
                 points_earned += 50
 
     # Goal Badges
-    if user_data.get('goals'):
-        completed_goals = sum(1 for g in user_data['goals'] if g['progress'] >= 100)
-
+    completed_goals = goals_completed(user_data)
+    if completed_goals:
         if 'Goal Crusher' not in existing_badges and completed_goals >= 5:
             badges_earned.append({
                 'name': 'Goal Crusher',
@@ -2017,8 +3039,8 @@ def check_and_award_badges(user_data):
             points_earned += 25
 
     # Group Badges (Phase 7 - NEW!)
-    if user_data.get('groups'):
-        group_count = len(user_data['groups'])
+    group_count = len(groups_for_member(username or st.session_state.username))
+    if group_count:
 
         if 'Group Leader' not in existing_badges and group_count >= 3:
             badges_earned.append({
@@ -2075,22 +3097,53 @@ def check_and_award_badges(user_data):
 
     return badges_earned, points_earned
 
-def calculate_level(total_points):
-    """Calculate user level based on total points"""
-    if total_points < 50:
-        return "Novice", 0, 50
-    elif total_points < 150:
-        return "Beginner", 50, 150
-    elif total_points < 300:
-        return "Intermediate", 150, 300
-    elif total_points < 500:
-        return "Advanced", 300, 500
-    elif total_points < 800:
-        return "Expert", 500, 800
-    elif total_points < 1200:
-        return "Master", 800, 1200
-    else:
-        return "Legend", 1200, 1200
+# Levels: [min_points, name] rows in ascending order. A school can replace the default table
+# (school_data['level_tables'][school]); each user keeps a level_progress snapshot that is
+# refreshed whenever their points change, so pages never recompute it.
+LEVEL_TABLE = [[0, "Novice"], [50, "Beginner"], [150, "Intermediate"], [300, "Advanced"],
+               [500, "Expert"], [800, "Master"], [1200, "Legend"]]
+
+def get_level_table(school=None):
+    return st.session_state.school_data.get('level_tables', {}).get(school) or LEVEL_TABLE
+
+def calculate_level(total_points, table=LEVEL_TABLE):
+    """(level, min_points, next_level_points) for total_points; the top level returns its own minimum twice."""
+    i = max(bisect.bisect_right([row[0] for row in table], total_points) - 1, 0)
+    level_min, name = table[i]
+    level_max = table[i + 1][0] if i + 1 < len(table) else level_min
+    return name, level_min, level_max
+
+def update_level_snapshot(user_data, total_points):
+    """Store the level and progress for total_points on the user record. Does not save."""
+    name, level_min, level_max = calculate_level(total_points, get_level_table(user_data.get('school')))
+    user_data['level'] = name
+    user_data['level_progress'] = {
+        'points': total_points,
+        'level': name,
+        'min': level_min,
+        'max': level_max,
+        'progress': min(1.0, (total_points - level_min) / (level_max - level_min)) if level_max > level_min else 1.0
+    }
+    return user_data['level_progress']
+
+def get_level_progress(user_data):
+    """The stored snapshot; only users who predate it get one computed here."""
+    return user_data.get('level_progress') or update_level_snapshot(user_data, points_balance(user_data))
+
+def set_level_table(users_data, school, table):
+    """Validate and store a school's thresholds, then refresh that school's snapshots. Returns an error or None."""
+    table = sorted([[int(points), str(name).strip()] for points, name in table if str(name).strip()])
+    if not table or table[0][0] != 0:
+        return "The first level must start at 0 points."
+    if len({points for points, _ in table}) != len(table):
+        return "Each level needs a different points threshold."
+    st.session_state.school_data.setdefault('level_tables', {})[school] = table
+    for data in users_data.values():
+        if data.get('role') == 'student' and data.get('school') == school:
+            update_level_snapshot(data, points_balance(data))
+    save_school_data(st.session_state.school_data)
+    save_users(users_data)
+    return None
 
 def update_login_streak(user_data):
     """Update login streak for daily login tracking"""
@@ -2115,6 +3168,300 @@ def update_login_streak(user_data):
     user_data['last_login'] = datetime.now().isoformat()
     return user_data
 
+# Points Ledger
+# Every fitness-point award is posted under an idempotency key (workout id, badge name, challenge
+# name), so a rerun can never award the same event twice. user_data['points_ledger'] keeps the
+# running balance and per-week/per-term totals; total_points mirrors the balance for old readers.
+POINTS_RECENT_N = 20
+
+def new_points_ledger():
+    return {'balance': 0, 'applied': {}, 'weekly': {}, 'term': {}, 'recent': []}
+
+def workout_points_key(workout):
+    return f"workout:{workout['id']}"
+
+def _post_points(ledger, key, points, reason, date_str):
+    ledger['balance'] += points
+    if date_str:
+        week, term = iso_week(date_str), school_term(date_str)
+        ledger['weekly'][week] = ledger['weekly'].get(week, 0) + points
+        ledger['term'][term] = ledger['term'].get(term, 0) + points
+    ledger['recent'].insert(0, {'key': key, 'points': points, 'reason': reason, 'date': date_str})
+    del ledger['recent'][POINTS_RECENT_N:]
+
+def get_points_ledger(user_data):
+    """The user's ledger, backfilled from their history on first use."""
+    ledger = user_data.get('points_ledger')
+    if ledger is None:
+        ledger = rebuild_points_ledger(user_data)
+    return ledger
+
+def rebuild_points_ledger(user_data):
+    """Post every workout, badge and challenge again; any gap to total_points becomes an opening balance. Does not save."""
+    ledger = new_points_ledger()
+    for i, ex in enumerate(reversed(user_data.get('exercises', []))):
+        ex.setdefault('id', f"legacy-{i}")
+        key = workout_points_key(ex)
+        points = ex.get('points_earned', 0)
+        ledger['applied'][key] = ledger['applied'].get(key, 0) + points
+        _post_points(ledger, key, points, 'workout', ex.get('date'))
+    for badge in user_data.get('badges', []):
+        key = f"badge:{badge['name']}"
+        ledger['applied'][key] = badge.get('points', 0)
+        _post_points(ledger, key, badge.get('points', 0), 'badge', badge.get('date'))
+    for challenge in user_data.get('completed_challenges', []):
+        key = f"challenge:{challenge['name']}"
+        ledger['applied'][key] = challenge.get('points', 0)
+        _post_points(ledger, key, challenge.get('points', 0), 'challenge', challenge.get('completed_date'))
+    opening = user_data.get('total_points', 0) - ledger['balance']
+    if opening:
+        ledger['applied']['opening_balance'] = opening
+        _post_points(ledger, 'opening_balance', opening, 'opening_balance', None)
+    ledger['recent'] = []
+    user_data['points_ledger'] = ledger
+    user_data['total_points'] = ledger['balance']
+    return ledger
+
+def award_points(user_data, key, points, reason, date_str=None, replace=False):
+    """Post points once per key. With replace=True the key is set to points and only the difference is posted.
+    Returns True when the balance changed. Does not save."""
+    ledger = get_points_ledger(user_data)
+    previous = ledger['applied'].get(key)
+    if previous is not None and not replace:
+        return False
+    delta = points - (previous or 0)
+    ledger['applied'][key] = points
+    if delta:
+        _post_points(ledger, key, delta, reason, date_str or datetime.now().strftime('%Y-%m-%d'))
+    user_data['total_points'] = ledger['balance']
+    update_level_snapshot(user_data, ledger['balance'])
+    return delta != 0
+
+def award_badges(user_data, badges):
+    """Add newly earned badges with their points, skipping any already in the ledger. Returns the badges added."""
+    added = []
+    for badge in badges:
+        if award_points(user_data, f"badge:{badge['name']}", badge['points'], 'badge', badge.get('date')):
+            user_data.setdefault('badges', []).append(badge)
+            added.append(badge)
+    return added
+
+def override_workout_points(user_data, workout, points):
+    """Teacher adjustment: the workout's ledger entry is set to points, so saving twice changes nothing."""
+    get_points_ledger(user_data)
+    workout['points_earned'] = points
+    workout['teacher_override'] = True
+    workout['verification_status'] = 'verified'
+    return award_points(user_data, workout_points_key(workout), points, 'teacher_override', workout.get('date'), replace=True)
+
+def points_balance(user_data):
+    return get_points_ledger(user_data)['balance']
+
+def ensure_points_ledgers(users_data, usernames):
+    """Build and save the ledgers of any listed users who do not have one yet, so leaderboards only read
+    stored weekly/term totals. Returns how many were built."""
+    missing = [u for u in usernames if u in users_data and 'points_ledger' not in users_data[u]]
+    for username in missing:
+        rebuild_points_ledger(users_data[username])
+    if missing:
+        save_users(users_data)
+    return len(missing)
+
+def points_this_week(user_data, date_str=None):
+    week = iso_week(date_str or datetime.now().strftime('%Y-%m-%d'))
+    return get_points_ledger(user_data)['weekly'].get(week, 0)
+
+def points_this_term(user_data, date_str=None):
+    term = school_term(date_str or datetime.now().strftime('%Y-%m-%d'))
+    return get_points_ledger(user_data)['term'].get(term, 0)
+
+# Social Graph
+def build_friend_graph(users_data):
+    """Adjacency sets for friendships and pending requests (incoming[u] = users who asked u)."""
+    friends = {}
+    incoming = {}
+    for username, data in users_data.items():
+        if not isinstance(data, dict) or 'password' not in data:
+            continue
+        friends[username] = set(data.get('friends', []))
+        incoming[username] = set(data.get('friend_requests', []))
+    return {'friends': friends, 'incoming': incoming}
+
+def get_friend_graph():
+    return get_cached_index('friend_graph', build_friend_graph)
+
+def are_friends(a, b):
+    return b in get_friend_graph()['friends'].get(a, ())
+
+def request_pending(sender, target):
+    return sender in get_friend_graph()['incoming'].get(target, ())
+
+def _save_friend_graph(all_users):
+    save_users(all_users)
+    mark_indexes_current('friend_graph')
+
+def send_friend_request(all_users, sender, target):
+    """Send a request, or accept straight away if the target already asked the sender."""
+    if request_pending(target, sender):
+        accept_friend_request(all_users, sender, target)
+        return 'accepted'
+    graph = get_friend_graph()
+    all_users[target].setdefault('friend_requests', []).append(sender)
+    graph['incoming'].setdefault(target, set()).add(sender)
+    _save_friend_graph(all_users)
+    return 'sent'
+
+def accept_friend_request(all_users, username, requester):
+    """Add the friendship on both sides and clear requests in either direction, with a single save."""
+    graph = get_friend_graph()
+    for a, b in ((username, requester), (requester, username)):
+        data = all_users[a]
+        if b in data.get('friend_requests', []):
+            data['friend_requests'].remove(b)
+        graph['incoming'].setdefault(a, set()).discard(b)
+        if b not in graph['friends'].setdefault(a, set()):
+            data.setdefault('friends', []).append(b)
+            graph['friends'][a].add(b)
+    _save_friend_graph(all_users)
+
+def decline_friend_request(all_users, username, requester):
+    graph = get_friend_graph()
+    if requester in all_users[username].get('friend_requests', []):
+        all_users[username]['friend_requests'].remove(requester)
+    graph['incoming'].setdefault(username, set()).discard(requester)
+    _save_friend_graph(all_users)
+
+def remove_friend(all_users, username, friend):
+    """Delete the friendship on both sides with a single save."""
+    graph = get_friend_graph()
+    for a, b in ((username, friend), (friend, username)):
+        if a in all_users and b in all_users[a].get('friends', []):
+            all_users[a]['friends'].remove(b)
+        graph['friends'].setdefault(a, set()).discard(b)
+    _save_friend_graph(all_users)
+
+def mutual_friends(a, b):
+    friends = get_friend_graph()['friends']
+    return friends.get(a, set()) & friends.get(b, set())
+
+def suggest_friends(username, limit=5):
+    """Friends-of-friends ranked by number of mutual friends. Returns [(username, mutual_count)]."""
+    graph = get_friend_graph()
+    mine = graph['friends'].get(username, set())
+    excluded = mine | graph['incoming'].get(username, set()) | {username}
+    counts = {}
+    for friend in mine:
+        for candidate in graph['friends'].get(friend, ()):
+            if candidate not in excluded and not request_pending(username, candidate):
+                counts[candidate] = counts.get(candidate, 0) + 1
+    return sorted(counts.items(), key=lambda x: (-x[1], x[0]))[:limit]
+
+# Groups
+def new_group_stats(members, users_data):
+    """Aggregates for a group, computed from member records (used on create/migrate)."""
+    stats = {'total_workouts': 0, 'house_points': 0, 'member_points': {}, 'member_workouts': {}}
+    for member in members:
+        _add_member_stats(stats, member, users_data.get(member, {}))
+    return stats
+
+def _add_member_stats(stats, member, member_data, sign=1):
+    points = member_data.get('house_points_contributed', 0)
+    workouts = len(member_data.get('exercises', []))
+    stats['total_workouts'] += sign * workouts
+    stats['house_points'] += sign * points
+    if sign > 0:
+        stats['member_points'][member] = points
+        stats['member_workouts'][member] = workouts
+    else:
+        stats['member_points'].pop(member, None)
+        stats['member_workouts'].pop(member, None)
+
+def migrate_app_groups():
+    """Move groups out of the old app_groups pseudo-user into the groups store."""
+    users_data = st.session_state.users_data
+    if 'app_groups' not in users_data:
+        return
+    groups_data = st.session_state.groups_data
+    for group_id, group in users_data.pop('app_groups').items():
+        group['stats'] = new_group_stats(group['members'], users_data)
+        groups_data['groups'][group_id] = group
+        for member in group['members']:
+            groups_data['member_index'].setdefault(member, [])
+            if group_id not in groups_data['member_index'][member]:
+                groups_data['member_index'][member].append(group_id)
+    for data in users_data.values():
+        data.pop('groups', None)
+    save_groups(groups_data)
+    save_users(users_data)
+
+def get_group(group_id):
+    return st.session_state.groups_data['groups'].get(group_id)
+
+def groups_for_member(username):
+    return st.session_state.groups_data['member_index'].get(username, [])
+
+def create_group(admin, name, description, group_type, max_members):
+    groups_data = st.session_state.groups_data
+    group_id = f"group_{admin}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    groups_data['groups'][group_id] = {
+        'id': group_id,
+        'name': name,
+        'description': description,
+        'type': group_type,
+        'admin': admin,
+        'members': [admin],
+        'max_members': max_members,
+        'created': datetime.now().strftime('%Y-%m-%d'),
+        'stats': new_group_stats([admin], st.session_state.users_data)
+    }
+    groups_data['member_index'].setdefault(admin, []).append(group_id)
+    save_groups(groups_data)
+    return group_id
+
+def join_group(group_id, username):
+    """Add a member and fold their totals into the group stats. Returns False if the group is full."""
+    groups_data = st.session_state.groups_data
+    group = groups_data['groups'][group_id]
+    if username in group['members']:
+        return True
+    if len(group['members']) >= group['max_members']:
+        return False
+    group['members'].append(username)
+    _add_member_stats(group['stats'], username, st.session_state.users_data.get(username, {}))
+    groups_data['member_index'].setdefault(username, []).append(group_id)
+    save_groups(groups_data)
+    return True
+
+def leave_group(group_id, username):
+    groups_data = st.session_state.groups_data
+    group = groups_data['groups'][group_id]
+    if username in group['members']:
+        group['members'].remove(username)
+        _add_member_stats(group['stats'], username, st.session_state.users_data.get(username, {}), sign=-1)
+    if group_id in groups_data['member_index'].get(username, []):
+        groups_data['member_index'][username].remove(group_id)
+    save_groups(groups_data)
+
+def group_rankings(group_id, metric='house_points'):
+    """Members sorted by the cached per-member totals. Returns [(username, value)]."""
+    stats = get_group(group_id)['stats']
+    values = stats['member_points'] if metric == 'house_points' else stats['member_workouts']
+    return sorted(values.items(), key=lambda x: x[1], reverse=True)
+
+def update_group_stats(username, house_pts):
+    """O(groups per member) update when a member logs a workout."""
+    group_ids = groups_for_member(username)
+    if not group_ids:
+        return
+    groups_data = st.session_state.groups_data
+    for group_id in group_ids:
+        stats = groups_data['groups'][group_id]['stats']
+        stats['total_workouts'] += 1
+        stats['house_points'] += house_pts
+        stats['member_points'][username] = stats['member_points'].get(username, 0) + house_pts
+        stats['member_workouts'][username] = stats['member_workouts'].get(username, 0) + 1
+    save_groups(groups_data)
+
 # Community and Social Features
 def community_features():
     st.header("Community & Achievements")
@@ -2145,14 +3492,11 @@ def community_features():
             'black': {'points': 0, 'members': 0, 'workouts': 0, 'display': 'Black House', 'color': '#2F4F4F'}
         }
 
-        # Calculate total points for each house
-        for username, data in all_users.items():
-            if data.get('role') == 'student' and data.get('house'):
-                house = data['house']
-                if house in house_stats:
-                    house_stats[house]['points'] += data.get('house_points_contributed', 0)
-                    house_stats[house]['members'] += 1
-                    house_stats[house]['workouts'] += len(data.get('exercises', []))
+        # Running totals from the house ledger
+        for house, points, workouts in house_standings():
+            house_stats[house]['points'] = points
+            house_stats[house]['workouts'] = workouts
+            house_stats[house]['members'] = house_member_count(house)
 
         # Sort houses by points
         sorted_houses = sorted(house_stats.items(), key=lambda x: x[1]['points'], reverse=True)
@@ -2208,16 +3552,16 @@ def community_features():
             st.write("")
             st.write(f"###  Top Contributors - {user_house_stats.get('display', 'Your House')}")
 
-            house_members = [(username, data) for username, data in all_users.items()
-                           if data.get('house') == user_house and data.get('role') == 'student']
-            house_members.sort(key=lambda x: x[1].get('house_points_contributed', 0), reverse=True)
-
-            for idx, (username, member) in enumerate(house_members[:5], 1):
+            for idx, (username, points) in enumerate(house_top_contributors(user_house), 1):
                 medal = "" if idx == 1 else "" if idx == 2 else "" if idx == 3 else f"{idx}."
-                points = member.get('house_points_contributed', 0)
 
                 highlight = " (You)" if username == st.session_state.username else ""
-                st.write(f"{medal} **{member['name']}**{highlight} - {points:.1f} points")
+                st.write(f"{medal} **{all_users.get(username, {}).get('name', username)}**{highlight} - {points:.1f} points")
+
+            with st.expander("My House Points History"):
+                for tx in read_house_transactions(username=st.session_state.username, limit=20):
+                    what = tx['workout']['name'] if tx['workout'] else tx['reason'].replace('_', ' ')
+                    st.write(f"{tx['ts'][:10]} · {what} · {tx['points']:+.2f} pts ({tx['house'].title()})")
         else:
             st.info("Students: Your house information will appear here after you log workouts!")
 
@@ -2251,6 +3595,8 @@ def community_features():
             else:
                 global_board_type = st.selectbox("Select Ranking", [
                     "Total House Points",
+                    "Fitness Points This Week",
+                    "Fitness Points This Term",
                     "Weekly Warriors",
                     "Workout Streak",
                     "Total Workouts"
@@ -2281,6 +3627,31 @@ def community_features():
 
                         st.write(f"{medal} {highlight}**{user['name']}** {house_emoji} - {user['points']:.1f} points")
 
+                elif global_board_type in ("Fitness Points This Week", "Fitness Points This Term"):
+                    st.write(f"### {global_board_type}")
+
+                    period_points = points_this_week if global_board_type.endswith("Week") else points_this_term
+                    ensure_points_ledgers(all_users, leaderboard_users)
+                    rankings = []
+                    for username, data in leaderboard_users.items():
+                        points = period_points(data)
+                        if points > 0:
+                            rankings.append({
+                                'username': username,
+                                'name': data['name'],
+                                'points': points,
+                                'house': data.get('house', 'N/A')
+                            })
+
+                    rankings.sort(key=lambda x: x['points'], reverse=True)
+
+                    for idx, user in enumerate(rankings[:20], 1):
+                        medal = "" if idx == 1 else "" if idx == 2 else "" if idx == 3 else f"{idx}."
+                        highlight = "" if user['username'] == st.session_state.username else ""
+                        house_emoji = {'yellow': '🟡', 'red': '', 'blue': '', 'green': '🟢', 'black': ''}.get(user['house'], '')
+
+                        st.write(f"{medal} {highlight}**{user['name']}** {house_emoji} - {user['points']} points")
+
                 elif global_board_type == "Weekly Warriors":
                     st.write("### Most Workouts This Week")
 
@@ -2561,6 +3932,7 @@ def community_features():
 
                 friend_rank_type = st.selectbox("Rank By", [
                     "House Points",
+                    "Fitness Points This Week",
                     "NAPFA Score",
                     "Total Workouts",
                     "Weekly Workouts"
@@ -2579,6 +3951,18 @@ def community_features():
                             'house': data.get('house', 'N/A')
                         })
 
+                elif friend_rank_type == "Fitness Points This Week":
+                    ensure_points_ledgers(all_users, friend_users)
+                    for username, data in friend_users.items():
+                        points = points_this_week(data)
+                        rankings.append({
+                            'username': username,
+                            'name': data['name'],
+                            'value': points,
+                            'display': f"{points} points",
+                            'house': data.get('house', 'N/A')
+                        })
+
                 elif friend_rank_type == "NAPFA Score":
                     for username, data in friend_users.items():
                         if data.get('napfa_history'):
@@ -2629,21 +4013,19 @@ def community_features():
             st.write("### Group Leaderboards")
             st.write("See how your groups rank!")
 
-            user_groups = user_data.get('groups', [])
+            user_groups = groups_for_member(st.session_state.username)
 
             if not user_groups:
                 st.info("Join a group to see group leaderboards!")
             else:
-                all_groups = st.session_state.get('all_groups', {})
-
                 selected_group_id = st.selectbox(
                     "Select Group",
                     user_groups,
-                    format_func=lambda x: all_groups.get(x, {}).get('name', 'Unknown Group'),
+                    format_func=lambda x: (get_group(x) or {}).get('name', 'Unknown Group'),
                     key="select_group_lb"
                 )
 
-                group = all_groups.get(selected_group_id, {})
+                group = get_group(selected_group_id)
 
                 if group:
                     st.write(f"### {group['name']} Leaderboard")
@@ -2655,12 +4037,14 @@ def community_features():
                     ], key="group_rank")
 
                     rankings = []
+                    member_points = group['stats']['member_points']
+                    member_workouts = group['stats']['member_workouts']
 
                     for member in group['members']:
                         member_data = all_users.get(member, {})
 
                         if group_rank_type == "House Points":
-                            value = member_data.get('house_points_contributed', 0)
+                            value = member_points.get(member, 0)
                             display = f"{value:.1f} points"
                         elif group_rank_type == "NAPFA Score":
                             if member_data.get('napfa_history'):
@@ -2669,7 +4053,7 @@ def community_features():
                             else:
                                 continue
                         else:  # Total Workouts
-                            value = len(member_data.get('exercises', []))
+                            value = member_workouts.get(member, 0)
                             display = f"{value} workouts"
 
                         rankings.append({
@@ -2693,18 +4077,16 @@ def community_features():
             st.write("### Class Leaderboard")
             st.write("See how your classmates are doing!")
 
-            teacher_class_key = user_data.get('teacher_class')
+            my_class = get_student_class(st.session_state.users_data, user_data)
 
-            if not teacher_class_key or teacher_class_key not in st.session_state.users_data:
+            if my_class is None:
                 st.info("Join a class via the **Privacy Settings** tab to see your class leaderboard!")
             else:
-                teacher_info = st.session_state.users_data[teacher_class_key]
-                class_label = teacher_info.get('class_label') or f"{teacher_info['name']}'s class"
-                st.write(f"### {class_label}")
+                st.write(f"### {get_class_label(my_class, st.session_state.users_data)}")
 
-                # Get classmates (same teacher_class) who opted into leaderboards
-                classmates = {username: data for username, data in leaderboard_users.items()
-                              if data.get('teacher_class') == teacher_class_key}
+                # Get classmates who opted into leaderboards
+                classmates = {username: leaderboard_users[username] for username in my_class['students']
+                              if username in leaderboard_users}
 
                 if not classmates:
                     st.info("No classmates are on the leaderboard yet!")
@@ -2788,36 +4170,34 @@ def community_features():
         # Check for new badges
         new_badges, new_points = check_and_award_badges(user_data)
 
+        new_badges = award_badges(user_data, new_badges)
         if new_badges:
             st.balloons()
-            st.success(f"You earned {len(new_badges)} new badge(s) and {new_points} points!")
-
-            for badge in new_badges:
-                user_data['badges'].append(badge)
-                user_data['total_points'] = user_data.get('total_points', 0) + badge['points']
-
-            update_user_data(user_data)
+            st.success(f"You earned {len(new_badges)} new badge(s) and {sum(b['points'] for b in new_badges)} points!")
 
         # Display level and progress
-        current_level, level_min, level_max = calculate_level(user_data.get('total_points', 0))
-        user_data['level'] = current_level
-        update_user_data(user_data)
+        had_snapshot = 'level_progress' in user_data
+        snapshot = get_level_progress(user_data)
+        total_points, current_level, level_max = snapshot['points'], snapshot['level'], snapshot['max']
+        if new_badges or not had_snapshot:
+            update_user_data(user_data)
 
         st.write("### Your Progress")
 
-        col1, col2, col3 = st.columns(3)
+        col1, col2, col3, col4 = st.columns(4)
         with col1:
             st.metric("Level", current_level)
         with col2:
-            st.metric("Total Points", user_data.get('total_points', 0))
+            st.metric("Total Points", total_points)
         with col3:
+            st.metric("This Week / Term", f"{points_this_week(user_data)} / {points_this_term(user_data)}")
+        with col4:
             st.metric("Login Streak", f"{user_data.get('login_streak', 0)} days")
 
         # Progress bar to next level
-        if current_level != "Legend":
-            progress = (user_data.get('total_points', 0) - level_min) / (level_max - level_min)
-            st.progress(progress)
-            st.write(f"**Next Level:** {level_max - user_data.get('total_points', 0)} points to go!")
+        if snapshot['progress'] < 1.0:
+            st.progress(snapshot['progress'])
+            st.write(f"**Next Level:** {level_max - total_points} points to go!")
         else:
             st.success("You've reached the maximum level!")
 
@@ -2871,7 +4251,7 @@ def community_features():
         st.subheader("Friends")
 
         # Friend requests
-        friend_requests = user_data.get('friend_requests', [])
+        friend_requests = list(user_data.get('friend_requests', []))
         if friend_requests:
             st.write("### Friend Requests")
             for requester in friend_requests:
@@ -2881,26 +4261,12 @@ def community_features():
                     st.write(f"**{requester_data.get('name', 'Unknown')}** (@{requester})")
                 with col2:
                     if st.button("Accept", key=f"accept_{requester}"):
-                        # Initialize friends arrays if needed
-                        if 'friends' not in user_data:
-                            user_data['friends'] = []
-                        if 'friends' not in all_users[requester]:
-                            all_users[requester]['friends'] = []
-                        
-                        user_data['friends'].append(requester)
-                        user_data['friend_requests'].remove(requester)
-
-                        # Add to requester's friends too
-                        all_users[requester]['friends'].append(st.session_state.username)
-
-                        update_user_data(user_data)
-                        save_users(all_users)
+                        accept_friend_request(all_users, st.session_state.username, requester)
                         st.success(f"Added {requester} as friend!")
                         st.rerun()
                 with col3:
                     if st.button("Decline", key=f"decline_{requester}"):
-                        user_data['friend_requests'].remove(requester)
-                        update_user_data(user_data)
+                        decline_friend_request(all_users, st.session_state.username, requester)
                         st.rerun()
 
         # Add friend
@@ -2914,18 +4280,13 @@ def community_features():
                 new_friend = new_friend.strip()
                 if new_friend == st.session_state.username:
                     st.error("You can't add yourself!")
-                elif new_friend in user_data.get('friends', []):
+                elif are_friends(st.session_state.username, new_friend):
                     st.error("Already friends!")
-                elif st.session_state.username in all_users[new_friend].get('friend_requests', []):
+                elif request_pending(st.session_state.username, new_friend):
                     st.error("Request already sent!")
+                elif send_friend_request(all_users, st.session_state.username, new_friend) == 'accepted':
+                    st.success(f"{new_friend} had already sent you a request - you're now friends!")
                 else:
-                    # Initialize friend_requests if it doesn't exist
-                    if 'friend_requests' not in all_users[new_friend]:
-                        all_users[new_friend]['friend_requests'] = []
-                    
-                    # Add request to target user
-                    all_users[new_friend]['friend_requests'].append(st.session_state.username)
-                    save_users(all_users)
                     st.success(f"Friend request sent to {new_friend}!")
                     st.info(f"They will see your request ({st.session_state.username}) in their Friends tab.")
             else:
@@ -2962,31 +4323,38 @@ def community_features():
                         recent_badge = friend_data['badges'][-1]
                         st.info(f"Recently earned: {recent_badge['name']}")
 
+                    mutual = mutual_friends(st.session_state.username, friend)
+                    if mutual:
+                        st.caption(f"{len(mutual)} mutual friend(s)")
+
                     if st.button(f"Remove Friend", key=f"remove_{friend}"):
-                        user_data['friends'].remove(friend)
-                        all_users[friend]['friends'].remove(st.session_state.username)
-                        update_user_data(user_data)
-                        save_users(all_users)
+                        remove_friend(all_users, st.session_state.username, friend)
                         st.rerun()
         else:
             st.info("No friends yet. Add friends to see their progress!")
 
+        # Friend suggestions
+        suggestions = suggest_friends(st.session_state.username)
+        if suggestions:
+            st.write("### People You May Know")
+            for candidate, mutual_count in suggestions:
+                col1, col2 = st.columns([3, 1])
+                with col1:
+                    st.write(f"**{all_users.get(candidate, {}).get('name', 'Unknown')}** (@{candidate}) - {mutual_count} mutual friend(s)")
+                with col2:
+                    if st.button("Add", key=f"suggest_{candidate}"):
+                        send_friend_request(all_users, st.session_state.username, candidate)
+                        st.success(f"Friend request sent to {candidate}!")
+                        st.rerun()
+
         # GROUPS SECTION
         st.write("")
         st.write("---")
         st.write("## Groups")
         st.write("Create or join groups to workout together!")
 
-        # Load groups from database (using a special key)
-        if 'app_groups' not in st.session_state.users_data:
-            st.session_state.users_data['app_groups'] = {}
-            save_users(st.session_state.users_data)
-        
-        all_groups = st.session_state.users_data.get('app_groups', {})
-
-        # Initialize user groups
-        if 'groups' not in user_data:
-            user_data['groups'] = []
+        # Initialize group invites
+        if 'group_invites' not in user_data:
             user_data['group_invites'] = []
             update_user_data(user_data)
 
@@ -2995,11 +4363,11 @@ def community_features():
         with group_tab1:
             st.write("### My Groups")
 
-            user_groups = user_data.get('groups', [])
+            user_groups = list(groups_for_member(st.session_state.username))
 
             if user_groups:
                 for group_id in user_groups:
-                    group = all_groups.get(group_id, {})
+                    group = get_group(group_id)
                     if group:
                         with st.expander(f"{group['name']} ({len(group['members'])}/{group['max_members']} members)"):
                             st.write(f"**Type:** {group['type']}")
@@ -3017,8 +4385,8 @@ def community_features():
 
                             # Group stats
                             st.write("")
-                            group_workouts = sum([len(all_users.get(m, {}).get('exercises', [])) for m in group['members']])
-                            group_house_points = sum([all_users.get(m, {}).get('house_points_contributed', 0) for m in group['members']])
+                            group_workouts = group['stats']['total_workouts']
+                            group_house_points = group['stats']['house_points']
 
                             col1, col2 = st.columns(2)
                             with col1:
@@ -3029,9 +4397,7 @@ def community_features():
                             # Group leaderboard
                             st.write("")
                             st.write("**Group Leaderboard:**")
-                            member_scores = [(m, all_users.get(m, {}).get('house_points_contributed', 0))
-                                           for m in group['members']]
-                            member_scores.sort(key=lambda x: x[1], reverse=True)
+                            member_scores = group_rankings(group_id)
 
                             for idx, (member, score) in enumerate(member_scores[:5], 1):
                                 medal = "" if idx == 1 else "" if idx == 2 else "" if idx == 3 else f"{idx}."
@@ -3044,7 +4410,8 @@ def community_features():
                                 st.write("")
                                 st.write("**Invite Friends:**")
 
-                                available_friends = [f for f in user_data.get('friends', []) if f not in group['members']]
+                                group_members = set(group['members'])
+                                available_friends = [f for f in user_data.get('friends', []) if f not in group_members]
 
                                 if available_friends and len(group['members']) < group['max_members']:
                                     invite_friend = st.selectbox(
@@ -3066,14 +4433,7 @@ def community_features():
 
                             # Leave group
                             if st.button(f"Leave Group", key=f"leave_{group_id}"):
-                                group['members'].remove(st.session_state.username)
-                                user_data['groups'].remove(group_id)
-                                
-                                # Save group changes to database
-                                st.session_state.users_data['app_groups'][group_id] = group
-                                save_users(st.session_state.users_data)
-                                
-                                update_user_data(user_data)
+                                leave_group(group_id, st.session_state.username)
                                 st.rerun()
             else:
                 st.info("You're not in any groups yet. Create or join one in the other tab!")
@@ -3093,26 +4453,7 @@ def community_features():
 
             if st.button("Create Group", type="primary"):
                 if group_name:
-                    group_id = f"group_{st.session_state.username}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-
-                    new_group = {
-                        'id': group_id,
-                        'name': group_name,
-                        'description': group_description,
-                        'type': group_type,
-                        'admin': st.session_state.username,
-                        'members': [st.session_state.username],
-                        'max_members': max_members,
-                        'created': datetime.now().strftime('%Y-%m-%d'),
-                        'total_points': 0
-                    }
-
-                    # Save to database
-                    st.session_state.users_data['app_groups'][group_id] = new_group
-                    save_users(st.session_state.users_data)
-                    
-                    user_data['groups'].append(group_id)
-                    update_user_data(user_data)
+                    create_group(st.session_state.username, group_name, group_description, group_type, max_members)
 
                     st.success(f"Group '{group_name}' created!")
                     st.balloons()
@@ -3127,23 +4468,16 @@ def community_features():
                 st.write("")
                 st.write("### Group Invitations")
 
-                for group_id in group_invites:
-                    group = all_groups.get(group_id, {})
+                for group_id in list(group_invites):
+                    group = get_group(group_id)
                     if group:
                         col1, col2, col3 = st.columns([3, 1, 1])
                         with col1:
                             st.write(f"**{group['name']}** - {group['type']}")
                         with col2:
                             if st.button("Join", key=f"join_{group_id}"):
-                                if len(group['members']) < group['max_members']:
-                                    group['members'].append(st.session_state.username)
-                                    user_data['groups'].append(group_id)
+                                if join_group(group_id, st.session_state.username):
                                     user_data['group_invites'].remove(group_id)
-                                    
-                                    # Save group changes to database
-                                    st.session_state.users_data['app_groups'][group_id] = group
-                                    save_users(st.session_state.users_data)
-                                    
                                     update_user_data(user_data)
                                     st.success(f"Joined {group['name']}!")
                                     st.rerun()
@@ -3165,102 +4499,104 @@ def community_features():
         # Weekly Challenges
         st.write("### Weekly Challenges")
 
-        # Define weekly challenges
-        weekly_challenges = [
-            {
-                'name': 'Workout Warrior',
-                'description': 'Complete 5 workouts this week',
-                'target': 5,
-                'type': 'workouts',
-                'points': 50
-            },
-            {
-                'name': 'Cardio King',
-                'description': 'Total 150 minutes of exercise this week',
-                'target': 150,
-                'type': 'minutes',
-                'points': 60
-            },
-            {
-                'name': 'Early Bird',
-                'description': 'Log 7 days of sleep tracking',
-                'target': 7,
-                'type': 'sleep',
-                'points': 40
-            }
-        ]
-
-        # Check progress
-        week_ago = datetime.now() - timedelta(days=7)
+        results = evaluate_challenges(user_data)
+        awarded_names = {c['name'] for c in apply_challenge_awards(user_data, results)}
 
-        for challenge in weekly_challenges:
-            with st.expander(f"{'' if challenge['name'] in [c['name'] for c in user_data.get('completed_challenges', [])] else ''} {challenge['name']} (+{challenge['points']} pts)", expanded=True):
+        for challenge, progress, completed in results:
+            completed = completed or challenge['name'] in awarded_names
+            with st.expander(f"{'' if completed else ''} {challenge['name']} (+{challenge['points']} pts)", expanded=True):
                 st.write(f"**Goal:** {challenge['description']}")
 
-                # Calculate progress
-                if challenge['type'] == 'workouts':
-                    weekly_workouts = [e for e in user_data.get('exercises', [])
-                                     if datetime.strptime(e['date'], '%Y-%m-%d') >= week_ago]
-                    progress = len(weekly_workouts)
-                elif challenge['type'] == 'minutes':
-                    weekly_workouts = [e for e in user_data.get('exercises', [])
-                                     if datetime.strptime(e['date'], '%Y-%m-%d') >= week_ago]
-                    progress = sum(e['duration'] for e in weekly_workouts)
-                else:  # sleep
-                    weekly_sleep = [s for s in user_data.get('sleep_history', [])
-                                  if datetime.strptime(s['date'], '%Y-%m-%d') >= week_ago]
-                    progress = len(weekly_sleep)
-
                 st.progress(min(progress / challenge['target'], 1.0))
                 st.write(f"**Progress:** {progress}/{challenge['target']}")
 
-                if progress >= challenge['target']:
-                    completed_names = [c['name'] for c in user_data.get('completed_challenges', [])]
-                    if challenge['name'] not in completed_names:
-                        st.success("Challenge completed! Points awarded!")
-                        user_data.setdefault('completed_challenges', []).append({
-                            'name': challenge['name'],
-                            'completed_date': datetime.now().strftime('%Y-%m-%d'),
-                            'points': challenge['points']
-                        })
-                        user_data['total_points'] = user_data.get('total_points', 0) + challenge['points']
-                        update_user_data(user_data)
+                if challenge['name'] in awarded_names:
+                    st.success("Challenge completed! Points awarded!")
 
         # Friend Challenges
         st.write("")
         st.write("###  Friend Challenges")
 
         friends = user_data.get('friends', [])
+        challenge_store = get_friend_challenge_store()
+        if finalize_friend_challenges(st.session_state.username):
+            save_school_data(st.session_state.school_data)
+
         if not friends:
             st.info("Add friends to create challenges with them!")
         else:
-            selected_friend = st.selectbox("Challenge a friend", friends)
-
-            challenge_types = [
-                "Most workouts this week",
-                "Highest NAPFA score",
-                "Longest workout streak"
-            ]
+            selected_friend = st.selectbox("Challenge a friend", friends,
+                                           format_func=lambda x: all_users.get(x, {}).get('name', x))
 
-            challenge_type = st.selectbox("Challenge type", challenge_types)
+            challenge_type = st.selectbox("Challenge type", list(FRIEND_CHALLENGE_TYPES.keys()),
+                                          format_func=lambda x: FRIEND_CHALLENGE_TYPES[x]['label'])
 
             if st.button("Send Challenge"):
-                st.success(f"Challenge sent to {selected_friend}! (Feature coming soon)")
+                create_friend_challenge(st.session_state.username, selected_friend, challenge_type)
+                st.success(f"Challenge sent to {selected_friend}!")
+                st.rerun()
+
+        open_challenges = [challenge_store['challenges'][cid]
+                           for cid in challenge_store['open_index'].get(st.session_state.username, [])]
+
+        for challenge in open_challenges:
+            label = FRIEND_CHALLENGE_TYPES[challenge['type']]['label']
+            other = challenge['opponent'] if challenge['challenger'] == st.session_state.username else challenge['challenger']
+            other_name = all_users.get(other, {}).get('name', other)
+
+            if challenge['status'] == 'pending':
+                if challenge['opponent'] == st.session_state.username:
+                    col1, col2, col3 = st.columns([3, 1, 1])
+                    with col1:
+                        st.write(f"**{other_name}** challenged you: {label}")
+                    with col2:
+                        if st.button("Accept", key=f"accept_fc_{challenge['id']}"):
+                            accept_friend_challenge(challenge['id'], all_users)
+                            st.rerun()
+                    with col3:
+                        if st.button("Decline", key=f"decline_fc_{challenge['id']}"):
+                            decline_friend_challenge(challenge['id'])
+                            st.rerun()
+                else:
+                    st.caption(f"Waiting for {other_name} to accept: {label}")
+            else:
+                days_left = (datetime.strptime(challenge['end'], '%Y-%m-%d').date() - datetime.now().date()).days
+                with st.expander(f"{label} vs {other_name} ({days_left + 1} day(s) left)", expanded=True):
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        st.metric("You", challenge['scores'][st.session_state.username])
+                    with col2:
+                        st.metric(other_name, challenge['scores'][other])
+
+        recent = [challenge_store['challenges'][cid]
+                  for cid in challenge_store['history_index'].get(st.session_state.username, [])
+                  if cid in challenge_store['challenges']]
+        if recent:
+            st.write("**Recent Results:**")
+            for challenge in recent[:5]:
+                other = challenge['opponent'] if challenge['challenger'] == st.session_state.username else challenge['challenger']
+                if challenge['winner'] == st.session_state.username:
+                    result = "Won"
+                elif challenge['winner'] is None:
+                    result = "Draw"
+                else:
+                    result = "Lost"
+                st.write(f"• {result} - {FRIEND_CHALLENGE_TYPES[challenge['type']]['label']} vs "
+                         f"{all_users.get(other, {}).get('name', other)} "
+                         f"({challenge['scores'][st.session_state.username]} - {challenge['scores'][other]})")
 
         # Class Challenges
         st.write("")
         st.write("### Class Challenges")
 
-        teacher_class_key = user_data.get('teacher_class')
+        my_class = get_student_class(st.session_state.users_data, user_data)
 
-        if teacher_class_key and teacher_class_key in st.session_state.users_data:
-            teacher_info = st.session_state.users_data[teacher_class_key]
-            class_label = teacher_info.get('class_label') or f"{teacher_info['name']}'s class"
-            st.write(f"**Your Class:** {class_label}")
+        if my_class is not None:
+            st.write(f"**Your Class:** {get_class_label(my_class, st.session_state.users_data)}")
 
             # Get class members
-            class_members = {u: d for u, d in all_users.items()
-                             if d.get('teacher_class') == teacher_class_key and d.get('show_on_leaderboards', False)}
+            class_members = {u: all_users[u] for u in my_class['students']
+                             if u in all_users and all_users[u].get('show_on_leaderboards', False)}
 
             if len(class_members) > 1:
                 st.write(f"**Class Members on leaderboard:** {len(class_members)}")
@@ -3313,23 +4649,15 @@ def community_features():
         st.write("")
         st.write("### Your Class")
 
-        teacher_class_key = user_data.get('teacher_class')
+        my_class = get_student_class(st.session_state.users_data, user_data)
 
-        if teacher_class_key and teacher_class_key in st.session_state.users_data:
-            teacher_info = st.session_state.users_data[teacher_class_key]
-            class_label = teacher_info.get('class_label') or f"{teacher_info['name']}'s class"
-            st.success(f"You are enrolled in **{class_label}** (Teacher: {teacher_info['name']})")
+        if my_class is not None:
+            teacher_info = st.session_state.users_data[my_class['teacher']]
+            st.success(f"You are enrolled in **{get_class_label(my_class, st.session_state.users_data)}** (Teacher: {teacher_info['name']})")
 
             if st.button("Leave Class", type="secondary"):
-                # Remove student from teacher's list
-                if teacher_class_key in st.session_state.users_data:
-                    teacher_students = st.session_state.users_data[teacher_class_key].get('students', [])
-                    if st.session_state.username in teacher_students:
-                        teacher_students.remove(st.session_state.username)
-                        st.session_state.users_data[teacher_class_key]['students'] = teacher_students
-                user_data['teacher_class'] = None
+                remove_student_from_class(st.session_state.users_data, st.session_state.username, my_class)
                 update_user_data(user_data)
-                save_users(st.session_state.users_data)
                 st.success("You have left the class.")
                 st.rerun()
         else:
@@ -3339,26 +4667,16 @@ def community_features():
                 if not join_code.strip():
                     st.error("Please enter a class code.")
                 else:
-                    matched = False
-                    for teacher_username, teacher_data_item in st.session_state.users_data.items():
-                        if teacher_data_item.get('role') == 'teacher' and teacher_data_item.get('class_code', '').upper() == join_code.strip().upper():
-                            current_students = teacher_data_item.get('students', [])
-                            if len(current_students) >= 30:
-                                st.error("This class is full (30/30 students). Contact your teacher.")
-                            else:
-                                user_data['teacher_class'] = teacher_username
-                                update_user_data(user_data)
-                                if st.session_state.username not in current_students:
-                                    current_students.append(st.session_state.username)
-                                    st.session_state.users_data[teacher_username]['students'] = current_students
-                                    save_users(st.session_state.users_data)
-                                label = teacher_data_item.get('class_label') or f"{teacher_data_item['name']}'s class"
-                                st.success(f"Joined **{label}**!")
-                                st.rerun()
-                            matched = True
-                            break
-                    if not matched:
+                    joined_class = get_class(st.session_state.users_data, find_class_by_code(join_code))
+                    if joined_class is None:
                         st.error("Invalid class code. Please check with your teacher.")
+                    elif not assign_student_to_class(st.session_state.users_data, st.session_state.username, joined_class):
+                        capacity = class_capacity(joined_class)
+                        st.error(f"This class is full ({capacity}/{capacity} students). Contact your teacher.")
+                    else:
+                        update_user_data(user_data)
+                        st.success(f"Joined **{get_class_label(joined_class, st.session_state.users_data)}**!")
+                        st.rerun()
 
         # Personal Data Export (Phase 7 BONUS!)
         st.write("")
@@ -3377,6 +4695,7 @@ def community_features():
                     'gender': 'Male' if user_data.get('gender') == 'm' else 'Female',
                     'school': user_data.get('school'),
                     'teacher_class': user_data.get('teacher_class'),
+                    'class_id': user_data.get('class_id'),
                     'house': user_data.get('house'),
                     'created': user_data.get('created'),
                     'role': user_data.get('role')
@@ -3397,7 +4716,7 @@ def community_features():
                 },
                 'social': {
                     'friends': user_data.get('friends', []),
-                    'groups': user_data.get('groups', [])
+                    'groups': groups_for_member(st.session_state.username)
                 },
                 'goals': user_data.get('smart_goals', []),
                 'exported_date': datetime.now().isoformat()
@@ -3416,6 +4735,673 @@ def community_features():
             st.success("Your data is ready for download!")
             st.info("This JSON file contains all your FitTrack data. Keep it safe as a backup!")
 
+# Sleep-Performance Correlation
+INTENSITY_SCORES = {'Low': 1, 'Medium': 2, 'High': 3}
+SLEEP_WINDOW_DAYS = 30
+SLEEP_CORRELATION_MAX_AGE_HOURS = 24
+
+def compute_sleep_correlations(users_data):
+    """Join sleep, NAPFA and workout intensity across all students and compute school-level coefficients.
+    Each NAPFA test is paired with the student's average sleep and intensity in the SLEEP_WINDOW_DAYS before it."""
+    sleep_rows, napfa_rows, exercise_rows = [], [], []
+    for username, data in users_data.items():
+        if not isinstance(data, dict) or data.get('role') != 'student':
+            continue
+        sleep_rows.extend((username, s['date'], sleep_hours(s)) for s in data.get('sleep_history', []))
+        napfa_rows.extend((username, t['date'], t['total']) for t in data.get('napfa_history', []))
+        exercise_rows.extend((username, e['date'], INTENSITY_SCORES.get(e.get('intensity'), 2))
+                             for e in data.get('exercises', []))
+
+    if not sleep_rows or not napfa_rows:
+        return None
+
+    napfa = pd.DataFrame(napfa_rows, columns=['username', 'date', 'total'])
+    napfa['date'] = pd.to_datetime(napfa['date'])
+    window = pd.Timedelta(days=SLEEP_WINDOW_DAYS)
+
+    def window_mean(rows, column):
+        df = pd.DataFrame(rows, columns=['username', 'date_obs', column])
+        df['date_obs'] = pd.to_datetime(df['date_obs'])
+        joined = napfa[['username', 'date']].merge(df, on='username')
+        joined = joined[(joined['date_obs'] <= joined['date']) & (joined['date_obs'] > joined['date'] - window)]
+        return joined.groupby(['username', 'date'])[column].mean()
+
+    tests = napfa.set_index(['username', 'date'])
+    tests = tests.join(window_mean(sleep_rows, 'avg_sleep'))
+    if exercise_rows:
+        tests = tests.join(window_mean(exercise_rows, 'avg_intensity'))
+    else:
+        tests['avg_intensity'] = np.nan
+    tests = tests.dropna(subset=['avg_sleep'])
+
+    result = {
+        'generated': datetime.now().isoformat(),
+        'tests': int(len(tests)),
+        'students': int(tests.index.get_level_values('username').nunique()),
+        'r_sleep_napfa': None,
+        'points_per_sleep_hour': None,
+        'r_intensity_napfa': None,
+        'r_sleep_intensity': None,
+        'avg_score_8h_plus': None,
+        'avg_score_under_8h': None,
+        'pct_difference': None
+    }
+    if len(tests) < 3:
+        return result
+
+    def corr(a, b):
+        pair = tests[[a, b]].dropna()
+        if len(pair) < 3 or pair[a].std() == 0 or pair[b].std() == 0:
+            return None
+        return round(float(pair[a].corr(pair[b])), 3)
+
+    result['r_sleep_napfa'] = corr('avg_sleep', 'total')
+    result['r_intensity_napfa'] = corr('avg_intensity', 'total')
+    result['r_sleep_intensity'] = corr('avg_sleep', 'avg_intensity')
+    if tests['avg_sleep'].std() > 0:
+        result['points_per_sleep_hour'] = round(float(np.polyfit(tests['avg_sleep'], tests['total'], 1)[0]), 2)
+
+    well_rested = tests['avg_sleep'] >= 8
+    if well_rested.any() and (~well_rested).any():
+        high = float(tests.loc[well_rested, 'total'].mean())
+        low = float(tests.loc[~well_rested, 'total'].mean())
+        result['avg_score_8h_plus'] = round(high, 1)
+        result['avg_score_under_8h'] = round(low, 1)
+        if low > 0:
+            result['pct_difference'] = round((high - low) / low * 100, 1)
+
+    return result
+
+def get_sleep_correlations(refresh=False):
+    """Return the cached school-level coefficients, recomputing them when stale."""
+    cached = st.session_state.school_data.get('sleep_correlation')
+    stale = (not cached or not cached.get('generated') or
+             datetime.now() - datetime.fromisoformat(cached['generated']) > timedelta(hours=SLEEP_CORRELATION_MAX_AGE_HOURS))
+    if refresh or stale:
+        cached = compute_sleep_correlations(st.session_state.users_data)
+        if cached is None:
+            return None
+        st.session_state.school_data['sleep_correlation'] = cached
+        save_school_data(st.session_state.school_data)
+    return cached
+
+def day_training_load(user_data, date_str):
+    """Training load (minutes x intensity) logged on one day. Exercises are stored newest first."""
+    load = 0
+    for e in user_data.get('exercises', []):
+        if e['date'] < date_str:
+            break
+        if e['date'] == date_str:
+            load += e.get('duration', 0) * INTENSITY_SCORES.get(e.get('intensity'), 2)
+    return load
+
+def _add_sleep_pair(stats, hours, load):
+    stats['n'] += 1
+    stats['sum_x'] += hours
+    stats['sum_y'] += load
+    stats['sum_xx'] += hours * hours
+    stats['sum_yy'] += load * load
+    stats['sum_xy'] += hours * load
+
+def rebuild_personal_sleep_stats(user_data):
+    """Rebuild the running sums for a student's personal sleep vs training load correlation from history."""
+    stats = {'n': 0, 'sum_x': 0.0, 'sum_y': 0.0, 'sum_xx': 0.0, 'sum_yy': 0.0, 'sum_xy': 0.0, 'pending': None}
+    daily_load = {}
+    for e in user_data.get('exercises', []):
+        daily_load[e['date']] = daily_load.get(e['date'], 0) + e.get('duration', 0) * INTENSITY_SCORES.get(e.get('intensity'), 2)
+
+    for s in user_data.get('sleep_history', []):
+        pending = stats['pending']
+        if pending and pending['date'] == s['date']:
+            pending['hours'] += sleep_hours(s)
+            continue
+        if pending and pending['date'] < s['date'] and daily_load.get(pending['date'], 0) > 0:
+            _add_sleep_pair(stats, pending['hours'], daily_load[pending['date']])
+        stats['pending'] = {'date': s['date'], 'hours': sleep_hours(s)}
+
+    user_data['sleep_stats'] = stats
+    return stats
+
+def update_personal_sleep_stats(user_data, entry):
+    """Incremental update when a new sleep entry arrives.
+    The previous night's sleep is paired with the training load logged on that day, which is now complete."""
+    stats = user_data.get('sleep_stats')
+    if stats is None:
+        return rebuild_personal_sleep_stats(user_data)
+
+    pending = stats.get('pending')
+    if pending and pending['date'] == entry['date']:
+        pending['hours'] += sleep_hours(entry)
+        return stats
+    if pending and pending['date'] < entry['date']:
+        load = day_training_load(user_data, pending['date'])
+        if load > 0:
+            _add_sleep_pair(stats, pending['hours'], load)
+    stats['pending'] = {'date': entry['date'], 'hours': sleep_hours(entry)}
+    return stats
+
+def personal_sleep_correlation(user_data):
+    """Pearson r between a student's sleep and next-day training load, or None with too few pairs."""
+    stats = user_data.get('sleep_stats') or rebuild_personal_sleep_stats(user_data)
+    n = stats['n']
+    if n < 5:
+        return None, n
+    var_x = n * stats['sum_xx'] - stats['sum_x'] ** 2
+    var_y = n * stats['sum_yy'] - stats['sum_y'] ** 2
+    if var_x <= 0 or var_y <= 0:
+        return None, n
+    r = (n * stats['sum_xy'] - stats['sum_x'] * stats['sum_y']) / np.sqrt(var_x * var_y)
+    return round(float(r), 2), n
+
+def on_sleep_logged(user_data, entry):
+    """Keep derived sleep data up to date after a new sleep entry is added."""
+    update_personal_sleep_stats(user_data, entry)
+    record_sleep_activity(user_data, entry)
+    record_sleep_night(user_data, entry)
+    reschedule_after(user_data, 'sleep', entry['date'])
+    update_goals(user_data, 'sleep', entry)
+
+# Rolling Activity Window
+ACTIVITY_WINDOW_DAYS = 28
+ACTIVITY_SERIES = ['load', 'workouts', 'minutes', 'sleep']
+
+def build_activity_window(user_data, today=None):
+    """Build the per-user ring buffer of daily buckets from history (used once, then updated on each write)."""
+    today = today or datetime.now().date().toordinal()
+    window = {
+        'last_day': today,
+        'first_day': None,
+        'series': {name: [0] * ACTIVITY_WINDOW_DAYS for name in ACTIVITY_SERIES},
+        'intensity_counts': {'Low': 0, 'Medium': 0, 'High': 0}
+    }
+    for e in user_data.get('exercises', []):
+        day = datetime.strptime(e['date'], '%Y-%m-%d').toordinal()
+        window['first_day'] = day if window['first_day'] is None else min(window['first_day'], day)
+        window['intensity_counts'][e.get('intensity', 'Medium')] = window['intensity_counts'].get(e.get('intensity', 'Medium'), 0) + 1
+        if today - ACTIVITY_WINDOW_DAYS < day <= today:
+            _add_workout_to_window(window, e, day)
+    for entry in user_data.get('sleep_history', []):
+        day = datetime.strptime(entry['date'], '%Y-%m-%d').toordinal()
+        if today - ACTIVITY_WINDOW_DAYS < day <= today:
+            window['series']['sleep'][day % ACTIVITY_WINDOW_DAYS] += 1
+    user_data['activity_window'] = window
+    return window
+
+def roll_activity_window(window, day):
+    """Advance the ring buffer to `day`, clearing the buckets of days that passed (at most ACTIVITY_WINDOW_DAYS)."""
+    last = window['last_day']
+    if day <= last:
+        return window
+    for d in range(max(last + 1, day - ACTIVITY_WINDOW_DAYS + 1), day + 1):
+        for series in window['series'].values():
+            series[d % ACTIVITY_WINDOW_DAYS] = 0
+    window['last_day'] = day
+    return window
+
+def _add_workout_to_window(window, workout, day):
+    slot = day % ACTIVITY_WINDOW_DAYS
+    window['series']['load'][slot] += workout.get('duration', 0) * INTENSITY_SCORES.get(workout.get('intensity'), 2)
+    window['series']['workouts'][slot] += 1
+    window['series']['minutes'][slot] += workout.get('duration', 0)
+
+def window_sum(window, series, days, today=None):
+    """Sum of a daily series over the last `days` days (including today) without modifying the window."""
+    today = today or datetime.now().date().toordinal()
+    last = window['last_day']
+    total = 0
+    for d in range(today - days + 1, today + 1):
+        if last - ACTIVITY_WINDOW_DAYS < d <= last:
+            total += window['series'][series][d % ACTIVITY_WINDOW_DAYS]
+    return total
+
+def get_activity_window(user_data):
+    window = user_data.get('activity_window')
+    if window is None or any(name not in window['series'] for name in ACTIVITY_SERIES):
+        window = build_activity_window(user_data)
+    return window
+
+def record_workout_activity(user_data, workout):
+    """O(1) update of the rolling window when a workout is saved."""
+    window = user_data.get('activity_window')
+    if window is None or any(name not in window['series'] for name in ACTIVITY_SERIES):
+        build_activity_window(user_data)  # history already includes this workout
+        return
+    day = datetime.strptime(workout['date'], '%Y-%m-%d').toordinal()
+    roll_activity_window(window, day)
+    window['first_day'] = day if window['first_day'] is None else min(window['first_day'], day)
+    intensity = workout.get('intensity', 'Medium')
+    window['intensity_counts'][intensity] = window['intensity_counts'].get(intensity, 0) + 1
+    if day > window['last_day'] - ACTIVITY_WINDOW_DAYS:  # older days' slots now belong to recent days
+        _add_workout_to_window(window, workout, day)
+
+def record_sleep_activity(user_data, entry):
+    """O(1) update of the rolling window when a sleep entry is logged."""
+    window = user_data.get('activity_window')
+    if window is None or any(name not in window['series'] for name in ACTIVITY_SERIES):
+        build_activity_window(user_data)  # history already includes this entry
+        return
+    day = datetime.strptime(entry['date'], '%Y-%m-%d').toordinal()
+    roll_activity_window(window, day)
+    if day > window['last_day'] - ACTIVITY_WINDOW_DAYS:
+        window['series']['sleep'][day % ACTIVITY_WINDOW_DAYS] += 1
+
+# Injury Risk Scoring
+ACWR_MIN_HISTORY_DAYS = 21
+
+def recent_sleep_average(user_data, nights=7):
+    sleep = user_data.get('sleep_history', [])[-nights:]
+    if not sleep:
+        return None
+    return sum(sleep_hours(s) for s in sleep) / len(sleep)
+
+def score_injury_risk(user_data, avg_sleep_hours=None, today=None):
+    """Score injury risk from the rolling window: acute:chronic workload ratio, intensity mix, frequency and sleep."""
+    window = get_activity_window(user_data)
+    today = today or datetime.now().date().toordinal()
+
+    acute = window_sum(window, 'load', 7, today)
+    chronic = window_sum(window, 'load', ACTIVITY_WINDOW_DAYS, today)
+    history_days = today - window['first_day'] if window['first_day'] is not None else 0
+    acwr = None
+    if chronic > 0 and history_days >= ACWR_MIN_HISTORY_DAYS:
+        acwr = (acute / 7) / (chronic / ACTIVITY_WINDOW_DAYS)
+
+    counts = window['intensity_counts']
+    total = sum(counts.values())
+    high_intensity_ratio = counts.get('High', 0) / total if total > 0 else 0
+    workouts_per_week = window_sum(window, 'workouts', 14, today) / 2
+
+    if avg_sleep_hours is None:
+        avg_sleep_hours = recent_sleep_average(user_data)
+
+    risk_score = 0
+    risk_factors = []
+
+    if acwr is not None and acwr > 1.5:
+        risk_score += 25
+        risk_factors.append(f"Training load spiked this week (acute:chronic ratio {acwr:.2f})")
+
+    if high_intensity_ratio > 0.7:
+        risk_score += 30
+        risk_factors.append("Too many high-intensity workouts (>70%)")
+
+    if workouts_per_week > 6:
+        risk_score += 25
+        risk_factors.append("Insufficient rest days (<1 per week)")
+
+    if workouts_per_week < 2:
+        risk_score += 15
+        risk_factors.append("Inconsistent training increases injury risk")
+
+    if avg_sleep_hours is not None and avg_sleep_hours < 7:
+        risk_score += 20
+        risk_factors.append("Poor sleep reduces recovery")
+
+    if risk_score >= 50:
+        risk_level = "High Risk"
+    elif risk_score >= 25:
+        risk_level = "Moderate Risk"
+    else:
+        risk_level = "Low Risk"
+
+    return {
+        'score': risk_score,
+        'level': risk_level,
+        'factors': risk_factors,
+        'acwr': None if acwr is None else round(acwr, 2),
+        'workouts_per_week': workouts_per_week,
+        'high_intensity_ratio': round(high_intensity_ratio, 2)
+    }
+
+def batch_injury_risk(users_data, usernames, today=None):
+    """Score a whole class from each student's stored window. Returns {username: result}."""
+    today = today or datetime.now().date().toordinal()
+    results = {}
+    for username in usernames:
+        data = users_data.get(username)
+        if data and data.get('exercises'):
+            results[username] = score_injury_risk(data, today=today)
+    return results
+
+def on_workout_saved(username, user_data, workout, house_pts):
+    """Keep derived per-user, class, group and school data up to date after a workout is saved."""
+    record_workout_activity(user_data, workout)
+    reschedule_after(user_data, 'exercise', workout['date'])
+    update_goals(user_data, 'exercise', workout)
+    update_class_rollup(st.session_state.users_data, username, user_data, 'workout', workout, house_pts)
+    update_group_stats(username, house_pts)
+    school_changed = record_friend_challenge_activity(username, 'workout', workout)
+    school_changed = record_workout_analytics(username, user_data, workout, house_pts) or school_changed
+    school_changed = record_house_points(username, user_data, house_pts, workout) or school_changed
+    if school_changed:
+        save_school_data(st.session_state.school_data)
+
+# Weekly Challenges
+# metric is a rolling-window series; window_days counts back from today (inclusive)
+WEEKLY_CHALLENGES = [
+    {
+        'name': 'Workout Warrior',
+        'description': 'Complete 5 workouts this week',
+        'metric': 'workouts',
+        'window_days': 7,
+        'target': 5,
+        'points': 50
+    },
+    {
+        'name': 'Cardio King',
+        'description': 'Total 150 minutes of exercise this week',
+        'metric': 'minutes',
+        'window_days': 7,
+        'target': 150,
+        'points': 60
+    },
+    {
+        'name': 'Early Bird',
+        'description': 'Log 7 days of sleep tracking',
+        'metric': 'sleep',
+        'window_days': 7,
+        'target': 7,
+        'points': 40
+    }
+]
+
+def evaluate_challenges(user_data, challenges=WEEKLY_CHALLENGES, today=None):
+    """Progress for each challenge from the rolling window. Returns [(challenge, progress, completed)]."""
+    window = get_activity_window(user_data)
+    today = today or datetime.now().date().toordinal()
+    completed_names = {c['name'] for c in user_data.get('completed_challenges', [])}
+    results = []
+    for challenge in challenges:
+        progress = window_sum(window, challenge['metric'], challenge['window_days'], today)
+        results.append((challenge, progress, challenge['name'] in completed_names))
+    return results
+
+def apply_challenge_awards(user_data, results):
+    """Record every newly met challenge and its points together, then save once. Returns the awarded challenges."""
+    awarded = [challenge for challenge, progress, completed in results
+               if not completed and progress >= challenge['target']]
+    if not awarded:
+        return []
+    today_str = datetime.now().strftime('%Y-%m-%d')
+    awarded = [challenge for challenge in awarded
+               if award_points(user_data, f"challenge:{challenge['name']}", challenge['points'], 'challenge', today_str)]
+    completions = user_data.setdefault('completed_challenges', [])
+    for challenge in awarded:
+        completions.append({
+            'name': challenge['name'],
+            'completed_date': today_str,
+            'points': challenge['points']
+        })
+    update_user_data(user_data)
+    return awarded
+
+# Friend Challenges
+FRIEND_CHALLENGE_TYPES = {
+    'workouts': {'label': 'Most workouts this week', 'days': 7},
+    'minutes': {'label': 'Most exercise minutes this week', 'days': 7},
+    'napfa': {'label': 'Highest NAPFA score (30 days)', 'days': 30},
+    'streak': {'label': 'Longest workout streak (2 weeks)', 'days': 14}
+}
+FRIEND_CHALLENGE_HISTORY = 10
+
+def get_friend_challenge_store():
+    """Challenges by id, plus per-user indexes of open (pending/active) and recently finished ids."""
+    return st.session_state.school_data.setdefault('friend_challenges', {'challenges': {}, 'open_index': {}, 'history_index': {}})
+
+def create_friend_challenge(challenger, opponent, challenge_type):
+    store = get_friend_challenge_store()
+    challenge_id = f"fc_{challenger}_{opponent}_{new_id()}"
+    store['challenges'][challenge_id] = {
+        'id': challenge_id,
+        'type': challenge_type,
+        'challenger': challenger,
+        'opponent': opponent,
+        'created': datetime.now().strftime('%Y-%m-%d'),
+        'status': 'pending',
+        'start': None,
+        'end': None,
+        'scores': {challenger: 0, opponent: 0},
+        'streaks': {},
+        'winner': None
+    }
+    for username in (challenger, opponent):
+        store['open_index'].setdefault(username, []).append(challenge_id)
+    save_school_data(st.session_state.school_data)
+    return challenge_id
+
+def accept_friend_challenge(challenge_id, users_data):
+    """Start the challenge window today, seeding scores from today's activity so earlier logs count."""
+    challenge = get_friend_challenge_store()['challenges'][challenge_id]
+    today = datetime.now().date()
+    challenge['status'] = 'active'
+    challenge['start'] = today.strftime('%Y-%m-%d')
+    challenge['end'] = (today + timedelta(days=FRIEND_CHALLENGE_TYPES[challenge['type']]['days'] - 1)).strftime('%Y-%m-%d')
+    for username in challenge['scores']:
+        data = users_data.get(username, {})
+        if challenge['type'] in ('workouts', 'minutes'):
+            challenge['scores'][username] = window_sum(get_activity_window(data), challenge['type'], 1)
+        elif challenge['type'] == 'napfa':
+            todays = [t['total'] for t in data.get('napfa_history', []) if t['date'] == challenge['start']]
+            challenge['scores'][username] = max(todays) if todays else 0
+        elif window_sum(get_activity_window(data), 'workouts', 1) > 0:
+            challenge['streaks'][username] = {'last_day': today.toordinal(), 'current': 1}
+            challenge['scores'][username] = 1
+    save_school_data(st.session_state.school_data)
+
+def _close_friend_challenge(store, challenge, status):
+    challenge['status'] = status
+    if status == 'finished':
+        scores = challenge['scores']
+        a, b = challenge['challenger'], challenge['opponent']
+        challenge['winner'] = a if scores[a] > scores[b] else b if scores[b] > scores[a] else None
+    for username in (challenge['challenger'], challenge['opponent']):
+        if challenge['id'] in store['open_index'].get(username, []):
+            store['open_index'][username].remove(challenge['id'])
+        if status == 'finished':
+            history = store['history_index'].setdefault(username, [])
+            history.insert(0, challenge['id'])
+            for old_id in history[FRIEND_CHALLENGE_HISTORY:]:
+                other = store['challenges'].get(old_id, {})
+                if not any(old_id in store['history_index'].get(u, [])[:FRIEND_CHALLENGE_HISTORY]
+                           for u in (other.get('challenger'), other.get('opponent'))):
+                    store['challenges'].pop(old_id, None)
+            del history[FRIEND_CHALLENGE_HISTORY:]
+
+def decline_friend_challenge(challenge_id):
+    store = get_friend_challenge_store()
+    _close_friend_challenge(store, store['challenges'].pop(challenge_id), 'declined')
+    save_school_data(st.session_state.school_data)
+
+def finalize_friend_challenges(username, today_str=None):
+    """Close the user's active challenges whose window has ended. Returns True if anything changed."""
+    store = get_friend_challenge_store()
+    today_str = today_str or datetime.now().strftime('%Y-%m-%d')
+    changed = False
+    for challenge_id in list(store['open_index'].get(username, [])):
+        challenge = store['challenges'][challenge_id]
+        if challenge['status'] == 'active' and today_str > challenge['end']:
+            _close_friend_challenge(store, challenge, 'finished')
+            changed = True
+    return changed
+
+def record_friend_challenge_activity(username, kind, entry):
+    """Update live scores of the user's active challenges from a new workout or NAPFA test.
+    O(open challenges of this user); returns True if the store changed and needs saving."""
+    store = get_friend_challenge_store()
+    changed = finalize_friend_challenges(username, entry['date'])
+    for challenge_id in store['open_index'].get(username, []):
+        challenge = store['challenges'][challenge_id]
+        if challenge['status'] != 'active' or not challenge['start'] <= entry['date'] <= challenge['end']:
+            continue
+        scores = challenge['scores']
+        if kind == 'workout':
+            if challenge['type'] == 'workouts':
+                scores[username] += 1
+            elif challenge['type'] == 'minutes':
+                scores[username] += entry.get('duration', 0)
+            elif challenge['type'] == 'streak':
+                # same rule as the streak badge: gaps of up to 2 days keep a streak going
+                day = datetime.strptime(entry['date'], '%Y-%m-%d').toordinal()
+                state = challenge['streaks'].setdefault(username, {'last_day': None, 'current': 0})
+                if state['last_day'] is None or day - state['last_day'] > 2:
+                    state['current'] = 1
+                elif day > state['last_day']:
+                    state['current'] += 1
+                state['last_day'] = max(day, state['last_day'] or day)
+                scores[username] = max(scores[username], state['current'])
+        elif kind == 'napfa' and challenge['type'] == 'napfa':
+            scores[username] = max(scores[username], entry['total'])
+        else:
+            continue
+        changed = True
+    return changed
+
+# Training Plan Optimizer
+# A weekly plan is one session (or rest) per day, solved by DP over the days. The state is
+# (day, trained hard yesterday, sessions chosen so far); sub-solutions are memoized, and whole
+# solves are cached on (headroom, feasible sessions) so classmates with the same profile share them.
+PLAN_DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+PLAN_STATIONS = ['SU', 'SBJ', 'SAR', 'PU', 'SR', 'RUN']
+PLAN_SESSIONS = {
+    'intervals': {'label': 'Interval Training', 'type': 'Cardio', 'minutes': 45, 'hard': True,
+                  'stimulus': {'RUN': 1.0, 'SR': 0.4}},
+    'long_run': {'label': 'Long Distance Run (3-4km)', 'type': 'Cardio', 'minutes': 60, 'hard': True,
+                 'stimulus': {'RUN': 1.2}},
+    'upper_body': {'label': 'Upper Body: Pull-ups, Push-ups, Sit-ups', 'type': 'Strength', 'minutes': 60, 'hard': True,
+                   'stimulus': {'PU': 1.0, 'SU': 0.5}},
+    'core_legs': {'label': 'Core & Lower Body: Planks, Squats, Lunges', 'type': 'Strength', 'minutes': 60, 'hard': True,
+                  'stimulus': {'SU': 0.8, 'SBJ': 0.6}},
+    'plyometrics': {'label': 'Plyometrics & Agility Drills', 'type': 'Strength', 'minutes': 45, 'hard': True,
+                    'stimulus': {'SBJ': 1.0, 'SR': 0.8}},
+    'easy_run': {'label': 'Easy Run (2-3km)', 'type': 'Cardio', 'minutes': 30, 'hard': False,
+                 'stimulus': {'RUN': 0.5}},
+    'flexibility': {'label': 'Stretching & Flexibility', 'type': 'Flexibility', 'minutes': 30, 'hard': False,
+                    'stimulus': {'SAR': 1.0}}
+}
+PLAN_RESPONSE_RATE = 0.35  # how quickly extra sessions on a station stop paying off
+PLAN_HARD_BUFFER_MIN = 90  # hard sessions end at least this long before bedtime
+PLAN_EASY_BUFFER_MIN = 30
+PLAN_WEEKEND_WINDOWS = {"Full day available": (8 * 60, 20 * 60), "Half day (morning)": (8 * 60, 12 * 60),
+                        "Half day (afternoon)": (13 * 60, 18 * 60)}
+
+def _minutes(hhmm):
+    hours, minutes = hhmm.split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+def _hhmm(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def _subtract_intervals(windows, busy):
+    """Free windows minus busy intervals; both are sorted lists of (start, end) minutes."""
+    free = []
+    for start, end in windows:
+        for b_start, b_end in busy:
+            if b_end <= start or b_start >= end:
+                continue
+            if b_start > start:
+                free.append((start, b_start))
+            start = max(start, b_end)
+        if start < end:
+            free.append((start, end))
+    return free
+
+def plan_free_windows(settings):
+    """Per day, the free (start, end) windows in minutes and the bedtime implied by the sleep target."""
+    school_start, school_end = _minutes(settings['school_start']), _minutes(settings['school_end'])
+    wake = school_start - 45
+    bedtime = min(wake + 24 * 60 - int(settings.get('sleep_target', 9) * 60), 24 * 60)
+    busy = settings.get('busy', {})
+    windows = {}
+    for day in PLAN_DAYS:
+        if day in ("Saturday", "Sunday"):
+            day_windows = [PLAN_WEEKEND_WINDOWS[settings.get('weekend', "Full day available")]]
+        else:
+            day_windows = [(max(wake, 0), school_start - 15), (school_end + 30, bedtime)]
+        windows[day] = _subtract_intervals([w for w in day_windows if w[1] > w[0]], sorted(busy.get(day, [])))
+    return windows, bedtime
+
+def _place_session(windows, bedtime, session):
+    """Start minute of the first slot that fits session, or None."""
+    latest_end = bedtime - (PLAN_HARD_BUFFER_MIN if session['hard'] else PLAN_EASY_BUFFER_MIN)
+    for start, end in windows:
+        if start + session['minutes'] <= min(end, latest_end):
+            return start
+    return None
+
+def _projected_gain(headroom, chosen):
+    stimulus = dict.fromkeys(PLAN_STATIONS, 0.0)
+    for key in chosen:
+        for station, amount in PLAN_SESSIONS[key]['stimulus'].items():
+            stimulus[station] += amount
+    return sum(room * (1 - math.exp(-PLAN_RESPONSE_RATE * stimulus[station]))
+               for station, room in zip(PLAN_STATIONS, headroom))
+
+@lru_cache(maxsize=1024)
+def solve_week_plan(headroom, feasible, min_rest_days=1):
+    """Best (projected gain, session key or None per day). headroom is grade points left per station
+    (PLAN_STATIONS order); feasible lists the session keys that fit on each day. No hard sessions on
+    consecutive days, and at least min_rest_days rest days."""
+    @lru_cache(maxsize=None)
+    def best(day, hard_yesterday, chosen):
+        if day == len(PLAN_DAYS):
+            if day - len(chosen) < min_rest_days:
+                return -1.0, ()
+            return _projected_gain(headroom, chosen), ()
+        result = best(day + 1, False, chosen)
+        result = (result[0], (None,) + result[1])
+        for key in feasible[day]:
+            hard = PLAN_SESSIONS[key]['hard']
+            if hard and hard_yesterday:
+                continue
+            score, rest = best(day + 1, hard, tuple(sorted(chosen + (key,))))
+            if score > result[0] + 1e-9:
+                result = (score, (key,) + rest)
+        return result
+    return best(0, False, ())
+
+def plan_headroom(napfa):
+    return tuple(max(5 - napfa.get('grades', {}).get(station, 0), 0) for station in PLAN_STATIONS)
+
+def build_week_plan(user_data, settings):
+    """Weekly plan for one student from their latest NAPFA grades, free time and sleep.
+    Returns {'days': {day: [entry]}, 'projected_gain', 'station_gain', 'solve_ms'}."""
+    started = time.time()
+    napfa = user_data['napfa_history'][-1] if user_data.get('napfa_history') else {}
+    headroom = plan_headroom(napfa)
+    windows, bedtime = plan_free_windows(settings)
+    placements = {day: {key: _place_session(windows[day], bedtime, session) for key, session in PLAN_SESSIONS.items()}
+                  for day in PLAN_DAYS}
+    feasible = tuple(tuple(key for key, start in placements[day].items() if start is not None) for day in PLAN_DAYS)
+    avg_sleep = recent_sleep_average(user_data)
+    min_rest_days = 2 if avg_sleep is not None and avg_sleep < settings.get('sleep_target', 9) - 1 else 1
+    gain, choice = solve_week_plan(headroom, feasible, min_rest_days)
+
+    days = {}
+    for day, key in zip(PLAN_DAYS, choice):
+        if key is None:
+            days[day] = [{"time": "All Day", "activity": "Rest & Recovery", "type": "Rest", "session": None}]
+        else:
+            session, start = PLAN_SESSIONS[key], placements[day][key]
+            days[day] = [{"time": f"{_hhmm(start)}-{_hhmm(start + session['minutes'])}", "activity": session['label'],
+                          "type": session['type'], "session": key}]
+    chosen = [key for key in choice if key]
+    station_gain = {station: round(_projected_gain(tuple(room if s == station else 0 for s, room in zip(PLAN_STATIONS, headroom)), chosen), 2)
+                    for station in PLAN_STATIONS}
+    return {'days': days, 'projected_gain': round(max(gain, 0.0), 2), 'station_gain': station_gain,
+            'generated': datetime.now().isoformat(), 'solve_ms': round((time.time() - started) * 1000, 1)}
+
+def plan_class_schedules(users_data, usernames, settings):
+    """Plans for a whole class in one pass; identical profiles reuse the cached solve. Stores each plan, then saves once."""
+    plans = {}
+    for username in usernames:
+        student = users_data.get(username)
+        if not student or not student.get('napfa_history'):
+            continue
+        plans[username] = build_week_plan(student, settings)
+        student['training_plan'] = plans[username]
+    save_users(users_data)
+    return plans
+
 # AI Insights and Recommendations
 def ai_insights():
     st.header("AI Fitness Coach")
@@ -3522,10 +5508,11 @@ def ai_insights():
             sleep_data = user_data['sleep_history']
 
             # Calculate average sleep
-            avg_sleep_hours = sum([s['hours'] + s['minutes']/60 for s in sleep_data]) / len(sleep_data)
+            avg_sleep_hours = sum(sleep_hours(s) for s in sleep_data) / len(sleep_data)
 
             # Analyze NAPFA performance vs sleep
             napfa_score = user_data['napfa_history'][-1]['total']
+            school_sleep = get_sleep_correlations()
 
             # Statistical correlation (simplified)
             if avg_sleep_hours >= 8:
@@ -3544,6 +5531,10 @@ def ai_insights():
                 insight = "Poor sleep is limiting your performance. Getting 8+ hours could improve your score by ~5 points!"
                 predicted_improvement = 5
 
+            # Use the school-wide trend when there is enough data
+            if avg_sleep_hours < 8 and school_sleep and school_sleep.get('points_per_sleep_hour') and school_sleep['points_per_sleep_hour'] > 0:
+                predicted_improvement = school_sleep['points_per_sleep_hour'] * (8 - avg_sleep_hours)
+
             col1, col2 = st.columns(2)
             with col1:
                 st.metric("Average Sleep", f"{avg_sleep_hours:.1f} hours")
@@ -3557,7 +5548,30 @@ def ai_insights():
             st.info(f"**Insight:** {insight}")
 
             # Show correlation
-            st.write("**Research shows:** Students who sleep 8+ hours score on average 15% higher on NAPFA tests.")
+            if school_sleep and school_sleep.get('r_sleep_napfa') is not None:
+                st.write(f"**School data ({school_sleep['students']} students, {school_sleep['tests']} tests):**")
+                sc1, sc2, sc3 = st.columns(3)
+                with sc1:
+                    st.metric("Sleep vs NAPFA (r)", f"{school_sleep['r_sleep_napfa']:+.2f}")
+                with sc2:
+                    if school_sleep.get('points_per_sleep_hour') is not None:
+                        st.metric("Points per Extra Hour", f"{school_sleep['points_per_sleep_hour']:+.2f}")
+                with sc3:
+                    if school_sleep.get('r_intensity_napfa') is not None:
+                        st.metric("Intensity vs NAPFA (r)", f"{school_sleep['r_intensity_napfa']:+.2f}")
+                if school_sleep.get('pct_difference') is not None:
+                    st.write(f"Students averaging 8+ hours of sleep score {school_sleep['avg_score_8h_plus']}/30 on average, "
+                             f"vs {school_sleep['avg_score_under_8h']}/30 for those under 8 hours "
+                             f"({school_sleep['pct_difference']:+.1f}%).")
+            else:
+                st.write("**Research shows:** Students who sleep 8+ hours score on average 15% higher on NAPFA tests.")
+
+            personal_r, pairs = personal_sleep_correlation(user_data)
+            if personal_r is not None:
+                st.write(f"**Your data:** correlation between your sleep and next-day training load is "
+                         f"**{personal_r:+.2f}** ({pairs} nights).")
+            else:
+                st.caption(f"Log sleep and workouts on {max(5 - pairs, 1)} more day(s) to see your personal sleep correlation.")
 
         st.write("---")
 
@@ -3567,61 +5581,26 @@ def ai_insights():
         if not has_exercises:
             st.info("Log 5+ workouts to get injury risk analysis!")
         else:
-            exercises = user_data['exercises']
-
-            # Calculate workout intensity distribution
-            intensity_counts = {'Low': 0, 'Medium': 0, 'High': 0}
-            for ex in exercises:
-                intensity_counts[ex['intensity']] += 1
-
-            total = sum(intensity_counts.values())
-            high_intensity_ratio = intensity_counts['High'] / total if total > 0 else 0
-
-            # Check workout frequency (last 2 weeks)
-            two_weeks_ago = datetime.now() - timedelta(days=14)
-            recent_workouts = [e for e in exercises
-                             if datetime.strptime(e['date'], '%Y-%m-%d') >= two_weeks_ago]
-
-            workouts_per_week = len(recent_workouts) / 2
-
-            # Risk calculation
-            risk_score = 0
-            risk_factors = []
+            risk = score_injury_risk(user_data)
+            risk_level = risk['level']
+            risk_factors = risk['factors']
 
-            if high_intensity_ratio > 0.7:
-                risk_score += 30
-                risk_factors.append("Too many high-intensity workouts (>70%)")
-
-            if workouts_per_week > 6:
-                risk_score += 25
-                risk_factors.append("Insufficient rest days (<1 per week)")
-
-            if workouts_per_week < 2:
-                risk_score += 15
-                risk_factors.append("Inconsistent training increases injury risk")
-
-            # Sleep factor
-            if has_sleep:
-                if avg_sleep_hours < 7:
-                    risk_score += 20
-                    risk_factors.append("Poor sleep reduces recovery")
-
-            # Determine risk level
-            if risk_score >= 50:
-                risk_level = "High Risk"
+            if risk_level == "High Risk":
                 risk_color = "#f44336"
                 recommendation = " REDUCE intensity and take more rest days!"
-            elif risk_score >= 25:
-                risk_level = "Moderate Risk"
+            elif risk_level == "Moderate Risk":
                 risk_color = "#ff9800"
                 recommendation = "Balance your training intensity and rest."
             else:
-                risk_level = "Low Risk"
                 risk_color = "#4caf50"
                 recommendation = "Your training is well-balanced!"
 
             st.markdown(f'<div class="stat-card" style="background: {risk_color}; color: white;"><h2>Risk Level: {risk_level}</h2><p>{recommendation}</p></div>', unsafe_allow_html=True)
 
+            if risk['acwr'] is not None:
+                st.metric("Acute:Chronic Workload Ratio", f"{risk['acwr']:.2f}",
+                          help="Last 7 days vs 28-day average load. 0.8-1.3 is the safe zone.")
+
             if risk_factors:
                 st.write("**Risk Factors:**")
                 for factor in risk_factors:
@@ -3660,6 +5639,10 @@ def ai_insights():
             # Specific
             st.write("#### Specific - What exactly do you want to achieve?")
 
+            # Goals with a binding update themselves from NAPFA tests, workouts or sleep logs
+            latest_napfa = user_data['napfa_history'][-1] if user_data.get('napfa_history') else None
+            binding = None
+
             if goal_category == "NAPFA Improvement":
                 specific_options = [
                     "Achieve NAPFA Gold Medal",
@@ -3674,8 +5657,21 @@ def ai_insights():
                                             ["Sit-Ups", "Standing Broad Jump", "Sit and Reach",
                                              "Pull-Ups", "Shuttle Run", "2.4km Run"])
                     target_grade = 5
-                elif "increase total" in specific_goal:
+                    station = GOAL_NAPFA_KEYS[component]
+                    specific_goal = f"Improve {component} to Grade {target_grade}"
+                    binding = {'metric': 'napfa_grade', 'param': station, 'target': target_grade,
+                               'baseline': latest_napfa['grades'].get(station, 0) if latest_napfa else 0}
+                elif "increase total" in specific_goal.lower():
                     target_increase = st.number_input("Points to increase", min_value=1, max_value=10, value=3)
+                    current_total = latest_napfa['total'] if latest_napfa else 0
+                    specific_goal = f"Increase total NAPFA score from {current_total} to {current_total + target_increase}"
+                    binding = {'metric': 'napfa_total', 'target': current_total + target_increase, 'baseline': current_total}
+                elif "Gold" in specific_goal:
+                    binding = {'metric': 'napfa_medal', 'target': MEDAL_RANKS['Gold'],
+                               'baseline': MEDAL_RANKS.get(napfa_medal(latest_napfa), 0) if latest_napfa else 0}
+                else:
+                    binding = {'metric': 'napfa_min_grade', 'target': 3,
+                               'baseline': min(latest_napfa['grades'].values()) if latest_napfa else 0}
 
             elif goal_category == "Weight Management":
                 current_weight = st.number_input("Current Weight (kg)", min_value=30.0, max_value=150.0, value=60.0)
@@ -3687,6 +5683,7 @@ def ai_insights():
                 current_reps = st.number_input(f"Current max {exercise}", min_value=0, max_value=200, value=10)
                 target_reps = st.number_input(f"Target {exercise}", min_value=0, max_value=200, value=20)
                 specific_goal = f"Increase {exercise} from {current_reps} to {target_reps} reps"
+                binding = {'metric': 'exercise_pb', 'param': exercise, 'target': target_reps, 'baseline': current_reps}
 
             elif goal_category == "Endurance Training":
                 distance = st.selectbox("Distance", ["1km", "2.4km", "5km", "10km"])
@@ -3698,11 +5695,24 @@ def ai_insights():
                 current_reach = st.number_input("Current Sit & Reach (cm)", min_value=0, max_value=100, value=30)
                 target_reach = st.number_input("Target Sit & Reach (cm)", min_value=0, max_value=100, value=40)
                 specific_goal = f"Improve flexibility from {current_reach}cm to {target_reach}cm"
+                binding = {'metric': 'napfa_score', 'param': 'SAR', 'target': target_reach, 'baseline': current_reach}
 
             else:  # Consistency
-                workout_days = st.number_input("Workouts per week", min_value=1, max_value=7, value=4)
-                duration = st.number_input("For how many weeks?", min_value=1, max_value=52, value=8)
-                specific_goal = f"Workout {workout_days} days/week for {duration} weeks"
+                habit = st.selectbox("Habit", ["Workouts per week", "Active minutes per week", "Average sleep"])
+                if habit == "Workouts per week":
+                    workout_days = st.number_input("Workouts per week", min_value=1, max_value=7, value=4)
+                    duration = st.number_input("For how many weeks?", min_value=1, max_value=52, value=8)
+                    specific_goal = f"Workout {workout_days} days/week for {duration} weeks"
+                    binding = {'metric': 'workout_weeks', 'param': workout_days, 'target': duration, 'baseline': 0}
+                elif habit == "Active minutes per week":
+                    weekly_minutes = st.number_input("Minutes per week", min_value=30, max_value=1000, value=150, step=10)
+                    specific_goal = f"Be active for {weekly_minutes} minutes in a week"
+                    binding = {'metric': 'weekly_minutes', 'target': weekly_minutes, 'baseline': 0}
+                else:
+                    sleep_target = st.number_input("Average hours of sleep", min_value=6.0, max_value=11.0, value=8.5, step=0.5)
+                    current_sleep = sleep_summary(user_data)['rolling'].get('avg_hours') or 0
+                    specific_goal = f"Average {sleep_target:g} hours of sleep over 7 nights"
+                    binding = {'metric': 'sleep_avg', 'target': sleep_target, 'baseline': current_sleep}
 
             # Measurable
             st.write("#### Measurable - How will you track progress?")
@@ -3746,6 +5756,9 @@ def ai_insights():
                     ai_feedback = "Safe and achievable rate!"
 
             st.info(f"**AI Assessment:** {achievability} - {ai_feedback}")
+            if binding:
+                st.caption(f"Progress is tracked automatically: {GOAL_METRICS[binding['metric']]['label']}, "
+                           f"from {binding['baseline']:g} to {binding['target']:g}.")
 
             # Relevant
             st.write("#### Relevant - Why is this important to you?")
@@ -3805,16 +5818,20 @@ def ai_insights():
                     'milestones': milestones,
                     'created_date': datetime.now().strftime('%Y-%m-%d'),
                     'progress': 0,
-                    'weekly_checkpoints': []
+                    'weekly_checkpoints': [],
+                    **(binding or {})
                 }
 
-                user_data['smart_goals'].append(smart_goal)
-                update_user_data(user_data)
+                error = add_goal(user_data, smart_goal)
+                if error:
+                    st.error(error)
+                else:
+                    update_user_data(user_data)
 
-                st.success("SMART Goal created!")
-                st.balloons()
-                time.sleep(1)
-                st.rerun()
+                    st.success("SMART Goal created!")
+                    st.balloons()
+                    time.sleep(1)
+                    st.rerun()
 
         with goal_tab2:
             st.write("### My Active SMART Goals")
@@ -3844,23 +5861,27 @@ def ai_insights():
                         st.write("")
                         st.write("### Progress Tracking")
 
-                        new_progress = st.slider(
-                            "Update Progress",
-                            min_value=0,
-                            max_value=100,
-                            value=goal['progress'],
-                            key=f"progress_{idx}"
-                        )
+                        if goal.get('metric'):
+                            st.progress(goal['progress'] / 100)
+                            st.caption(f"{GOAL_METRICS[goal['metric']]['label']}: {goal.get('value', 0):g} "
+                                       f"(target {goal['target']:g}) · {goal['progress']}% · updates automatically")
+                            if goal.get('completed_date'):
+                                st.success(f"Completed on {goal['completed_date']}!")
+                        else:
+                            new_progress = st.slider(
+                                "Update Progress",
+                                min_value=0,
+                                max_value=100,
+                                value=goal['progress'],
+                                key=f"progress_{idx}"
+                            )
 
-                        if st.button("Update Progress", key=f"update_{idx}"):
-                            user_data['smart_goals'][idx]['progress'] = new_progress
-                            user_data['smart_goals'][idx]['weekly_checkpoints'].append({
-                                'date': datetime.now().strftime('%Y-%m-%d'),
-                                'progress': new_progress
-                            })
-                            update_user_data(user_data)
-                            st.success("Progress updated!")
-                            st.rerun()
+                            if st.button("Update Progress", key=f"update_{idx}"):
+                                get_goal_index(user_data)
+                                set_goal_progress(user_data, user_data['smart_goals'][idx], new_progress)
+                                update_user_data(user_data)
+                                st.success("Progress updated!")
+                                st.rerun()
 
                         # Show milestones
                         if goal.get('milestones'):
@@ -3871,7 +5892,7 @@ def ai_insights():
 
                         # Delete goal
                         if st.button(" Delete Goal", key=f"delete_{idx}"):
-                            user_data['smart_goals'].pop(idx)
+                            remove_goal(user_data, idx)
                             update_user_data(user_data)
                             st.rerun()
 
@@ -3921,7 +5942,7 @@ def ai_insights():
             with col3:
                 sleep_week = [s for s in user_data['sleep_history'][-7:]]
                 if sleep_week:
-                    avg_sleep = sum([s['hours'] + s['minutes']/60 for s in sleep_week]) / len(sleep_week)
+                    avg_sleep = sum(sleep_hours(s) for s in sleep_week) / len(sleep_week)
                     st.metric("Avg Sleep", f"{avg_sleep:.1f}h")
                     st.write(f"**Records:** {len(sleep_week)} days")
 
@@ -3941,6 +5962,7 @@ def ai_insights():
                 weekend_schedule = st.radio("Weekend Schedule",
                                            ["Full day available", "Half day (morning)", "Half day (afternoon)"],
                                            key="weekend_sched")
+                sleep_target = st.slider("Sleep Target (hours)", 8.0, 10.0, 9.0, 0.5, key="plan_sleep_target")
 
             # Generate button
             if st.button(" Generate My Complete Schedule", type="primary"):
@@ -3953,51 +5975,23 @@ def ai_insights():
                     if grade <= 2:  # D or E grade
                         weak_stations.append(station)
 
-                # Determine focus areas
-                focus_cardio = 'RUN' in weak_stations
-                focus_strength = any(s in weak_stations for s in ['PU', 'SU'])
-                focus_flexibility = 'SAR' in weak_stations
+                # Solve for the week that maximizes projected NAPFA gain in the free slots
+                plan = build_week_plan(user_data, {
+                    'school_start': weekday_start.strftime('%H:%M'),
+                    'school_end': weekday_end.strftime('%H:%M'),
+                    'weekend': weekend_schedule,
+                    'sleep_target': sleep_target,
+                    'busy': schedule_busy_by_day(user_data)
+                })
+                user_data['training_plan'] = plan
+                update_user_data(user_data)
 
                 # Weekly schedule
                 st.write("### Your Weekly Training Schedule")
+                st.caption(f"Projected NAPFA gain: +{plan['projected_gain']:.1f} grade points over a training block · "
+                           f"solved in {plan['solve_ms']:.0f} ms")
 
-                schedule_data = {
-                    "Monday": [],
-                    "Tuesday": [],
-                    "Wednesday": [],
-                    "Thursday": [],
-                    "Friday": [],
-                    "Saturday": [],
-                    "Sunday": []
-                }
-
-                # Build schedule based on analysis
-                if focus_cardio:
-                    schedule_data["Monday"].append({"time": "06:00-06:45", "activity": "Morning Run (2-3km)", "type": "Cardio"})
-                    schedule_data["Wednesday"].append({"time": "17:30-18:15", "activity": "Interval Training", "type": "Cardio"})
-                    schedule_data["Friday"].append({"time": "17:30-18:30", "activity": "Long Distance Run (3-4km)", "type": "Cardio"})
-
-                if focus_strength:
-                    schedule_data["Tuesday"].append({"time": "17:30-18:30", "activity": "Upper Body: Pull-ups, Push-ups, Sit-ups", "type": "Strength"})
-                    schedule_data["Thursday"].append({"time": "17:30-18:30", "activity": "Core & Lower Body: Planks, Squats, Lunges", "type": "Strength"})
-                    schedule_data["Saturday"].append({"time": "09:00-10:00", "activity": "Full Body Circuit Training", "type": "Strength"})
-
-                if focus_flexibility:
-                    schedule_data["Monday"].append({"time": "19:30-20:00", "activity": " Stretching & Flexibility", "type": "Flexibility"})
-                    schedule_data["Wednesday"].append({"time": "19:30-20:00", "activity": " Yoga/Stretching", "type": "Flexibility"})
-                    schedule_data["Friday"].append({"time": "19:30-20:00", "activity": " Deep Stretching", "type": "Flexibility"})
-
-                # Add general workouts if no specific weaknesses
-                if not weak_stations:
-                    schedule_data["Monday"].append({"time": "06:00-06:45", "activity": "Morning Run (3km)", "type": "Cardio"})
-                    schedule_data["Tuesday"].append({"time": "17:30-18:30", "activity": "Strength Training", "type": "Strength"})
-                    schedule_data["Wednesday"].append({"time": "06:00-06:45", "activity": "Speed Work", "type": "Cardio"})
-                    schedule_data["Thursday"].append({"time": "17:30-18:30", "activity": "Core & Upper Body", "type": "Strength"})
-                    schedule_data["Friday"].append({"time": "17:30-18:30", "activity": "Endurance Run", "type": "Cardio"})
-                    schedule_data["Saturday"].append({"time": "09:00-10:00", "activity": " Flexibility & Recovery", "type": "Flexibility"})
-
-                # Add rest day
-                schedule_data["Sunday"].append({"time": "All Day", "activity": " Rest & Recovery", "type": "Rest"})
+                schedule_data = plan['days']
 
                 # Display schedule
                 for day, activities in schedule_data.items():
@@ -4092,6 +6086,344 @@ def ai_insights():
                 st.write("---")
                 st.success("Schedule generated! Track your progress in the Exercise Log and NAPFA Test sections.")
 
+            elif user_data.get('training_plan'):
+                saved_plan = user_data['training_plan']
+                st.write("### Your Current Training Plan")
+                st.caption(f"Generated {datetime.fromisoformat(saved_plan['generated']).strftime('%d %b %Y')} · "
+                           f"projected gain +{saved_plan['projected_gain']:.1f} grade points")
+                st.dataframe(pd.DataFrame([{'Day': day, 'Time': entries[0]['time'], 'Activity': entries[0]['activity']}
+                                           for day, entries in saved_plan['days'].items()]),
+                             use_container_width=True, hide_index=True)
+                if st.button("Add Plan to My Schedule", key="plan_to_schedule"):
+                    clashes = add_plan_to_schedule(user_data, saved_plan)
+                    update_user_data(user_data)
+                    st.success("Plan added to your Training Schedule - export it from there as a calendar file.")
+                    for entry in clashes:
+                        st.warning(f"{entry['day']} {entry['activity']} overlaps another entry.")
+
+
+# Reminders
+# Each user keeps a min-heap of [due_date, key] rows in user_data['reminders']['heap'], with the
+# details in 'items'. Writes reschedule their reminder (the old heap row is left behind and skipped
+# when popped); the page only pops rows that have come due into 'active'.
+REMINDER_AFTER_DAYS = {'napfa': 31, 'bmi': 15, 'sleep': 1, 'exercise': 3}
+GOAL_REMINDER_DAYS = 7
+REMINDER_DIGEST_MAX_AGE_HOURS = 24
+
+def new_reminders():
+    return {'heap': [], 'items': {}, 'active': []}
+
+def _shift_date(date_str, days):
+    return (datetime.strptime(date_str, '%Y-%m-%d') + timedelta(days=days)).strftime('%Y-%m-%d')
+
+def get_reminders(user_data):
+    """The user's reminder queue, built from their history on first use."""
+    reminders = user_data.get('reminders')
+    if reminders is None:
+        reminders = rebuild_reminders(user_data)
+    return reminders
+
+def rebuild_reminders(user_data, today=None):
+    """Schedule every reminder from the user's history in one pass. Does not save."""
+    today = today or datetime.now().strftime('%Y-%m-%d')
+    reminders = new_reminders()
+    items = reminders['items']
+    latest = {
+        'napfa': user_data['napfa_history'][-1]['date'] if user_data.get('napfa_history') else None,
+        'bmi': user_data['bmi_history'][-1]['date'] if user_data.get('bmi_history') else None,
+        'sleep': user_data['sleep_history'][-1]['date'] if user_data.get('sleep_history') else None,
+        'exercise': user_data['exercises'][0]['date'] if user_data.get('exercises') else None
+    }
+    for kind, last in latest.items():
+        if last:
+            items[kind] = {'kind': kind, 'due': _shift_date(last, REMINDER_AFTER_DAYS[kind]), 'anchor': last}
+        elif kind in ('sleep', 'exercise'):
+            items[kind] = {'kind': kind, 'due': today, 'anchor': None}
+    goals = [(g.get('target'), g.get('date')) for g in user_data.get('goals', [])]
+    goals += [(g.get('specific'), g.get('time_bound')) for g in user_data.get('smart_goals', []) if g.get('progress', 0) < 100]
+    for target, date in goals:
+        if date and date > today:
+            items[f"goal:{date}:{target}"] = {'kind': 'goal', 'due': _shift_date(date, -GOAL_REMINDER_DAYS),
+                                              'anchor': date, 'target': target, 'expires': date}
+    reminders['heap'] = [[item['due'], key] for key, item in items.items()]
+    heapq.heapify(reminders['heap'])
+    user_data['reminders'] = reminders
+    return reminders
+
+def schedule_reminder(user_data, key, due, **details):
+    """Set (or move) a reminder. Does not save."""
+    reminders = get_reminders(user_data)
+    reminders['items'][key] = dict(details, due=due)
+    if key in reminders['active']:
+        reminders['active'].remove(key)
+    heapq.heappush(reminders['heap'], [due, key])
+    # Drop stale rows once they dominate the heap
+    if len(reminders['heap']) > 4 * len(reminders['items']) + 16:
+        reminders['heap'] = [[item['due'], k] for k, item in reminders['items'].items()]
+        heapq.heapify(reminders['heap'])
+
+def cancel_reminder(user_data, key):
+    reminders = get_reminders(user_data)
+    reminders['items'].pop(key, None)
+    if key in reminders['active']:
+        reminders['active'].remove(key)
+
+def reschedule_after(user_data, kind, date_str):
+    """Called when a NAPFA/BMI/sleep/exercise entry is written on date_str. Does not save."""
+    schedule_reminder(user_data, kind, _shift_date(date_str, REMINDER_AFTER_DAYS[kind]), kind=kind, anchor=date_str)
+
+def schedule_goal_reminder(user_data, target, date_str):
+    schedule_reminder(user_data, f"goal:{date_str}:{target}", _shift_date(date_str, -GOAL_REMINDER_DAYS),
+                      kind='goal', anchor=date_str, target=target, expires=date_str)
+
+def pop_due_reminders(user_data, today=None):
+    """Move reminders that have come due onto the active list. Returns (active items, changed)."""
+    today = today or datetime.now().strftime('%Y-%m-%d')
+    reminders = get_reminders(user_data)
+    heap, items, active = reminders['heap'], reminders['items'], reminders['active']
+    changed = False
+    while heap and heap[0][0] <= today:
+        due, key = heapq.heappop(heap)
+        changed = True
+        item = items.get(key)
+        if item is not None and item['due'] == due and key not in active:
+            active.append(key)
+    for key in list(active):
+        item = items.get(key)
+        if item is None or (item.get('expires') and item['expires'] <= today):
+            active.remove(key)
+            items.pop(key, None)
+            changed = True
+    return [items[key] for key in active], changed
+
+def reminder_message(item, today=None):
+    today = datetime.strptime(today or datetime.now().strftime('%Y-%m-%d'), '%Y-%m-%d')
+    days = (today - datetime.strptime(item['anchor'], '%Y-%m-%d')).days if item.get('anchor') else None
+    if item['kind'] == 'napfa':
+        return f"It's been {days} days since your last NAPFA test. Consider retesting to track progress!"
+    if item['kind'] == 'bmi':
+        return f" Update your BMI - last recorded {days} days ago"
+    if item['kind'] == 'sleep':
+        return "Don't forget to log your sleep from last night!" if item.get('anchor') \
+            else "Start tracking your sleep for better recovery insights!"
+    if item['kind'] == 'exercise':
+        return f"It's been {days} days since your last logged workout. Time to get moving!" if item.get('anchor') \
+            else "Start logging your exercises to track your fitness journey!"
+    if item['kind'] == 'goal_milestone':
+        if item['milestone'] >= 100:
+            return f"Goal complete: '{item['target']}'! +{GOAL_COMPLETION_POINTS} points"
+        return f"Milestone: {item['milestone']}% of '{item['target']}' reached. Keep going!"
+    return f"Goal deadline approaching: '{item['target']}' in {-days} days!"
+
+def run_school_reminder_job(users_data=None, today=None):
+    """Pop due reminders for every student in one pass and store a digest of who has what pending."""
+    users_data = users_data if users_data is not None else st.session_state.users_data
+    today = today or datetime.now().strftime('%Y-%m-%d')
+    started = time.time()
+    digest = {}
+    changed = False
+    for username, data in users_data.items():
+        if data.get('role') != 'student':
+            continue
+        items, student_changed = pop_due_reminders(data, today)
+        changed = changed or student_changed
+        if items:
+            digest[username] = sorted({item['kind'] for item in items})
+    if changed:
+        save_users(users_data)
+    store = {'generated': datetime.now().isoformat(), 'students': digest, 'duration_s': round(time.time() - started, 3)}
+    st.session_state.school_data['reminder_digest'] = store
+    save_school_data(st.session_state.school_data)
+    return store
+
+def ensure_school_reminders_fresh():
+    """Scheduled run: refresh the digest when it is missing or older than REMINDER_DIGEST_MAX_AGE_HOURS."""
+    store = st.session_state.school_data.get('reminder_digest', {})
+    generated = store.get('generated')
+    if not generated or datetime.now() - datetime.fromisoformat(generated) > timedelta(hours=REMINDER_DIGEST_MAX_AGE_HOURS):
+        store = run_school_reminder_job()
+    return store
+
+# Goal Engine
+# A SMART goal can be bound to a metric: {'metric', 'param', 'baseline', 'target'}. user_data['goal_index']
+# lists the open bound goals by the data source that moves them, so a NAPFA, workout or sleep write only
+# touches those goals and folds the new record into each goal's value and state. Crossing 25/50/75/100%
+# posts a milestone reminder; completing a goal posts ledger points and re-checks the goal badges.
+GOAL_METRICS = {
+    'exercise_pb': {'source': 'exercise', 'label': 'Best set'},
+    'weekly_minutes': {'source': 'exercise', 'label': 'Active minutes this week'},
+    'workout_weeks': {'source': 'exercise', 'label': 'Weeks on target'},
+    'napfa_grade': {'source': 'napfa', 'label': 'Station grade'},
+    'napfa_score': {'source': 'napfa', 'label': 'Station result'},
+    'napfa_total': {'source': 'napfa', 'label': 'NAPFA total'},
+    'napfa_medal': {'source': 'napfa', 'label': 'Medal (3 = Gold)'},
+    'napfa_min_grade': {'source': 'napfa', 'label': 'Lowest station grade'},
+    'sleep_avg': {'source': 'sleep', 'label': '7-night average sleep (h)'},
+}
+GOAL_NAPFA_KEYS = {'Sit-Ups': 'SU', 'Standing Broad Jump': 'SBJ', 'Sit and Reach': 'SAR',
+                   'Pull-Ups': 'PU', 'Shuttle Run': 'SR', '2.4km Run': 'RUN'}
+MEDAL_RANKS = {'No Medal': 0, 'Bronze': 1, 'Silver': 2, 'Gold': 3}
+GOAL_MILESTONES = (25, 50, 75, 100)
+GOAL_COMPLETION_POINTS = 25
+GOAL_MILESTONE_NOTICE_DAYS = 3
+
+def _workout_best_set(workout):
+    if 'best_set' in workout:
+        return workout['best_set']
+    return workout.get('total_reps', 0) // max(workout.get('sets') or 1, 1)
+
+def _fold_goal_event(user_data, goal, event):
+    """The goal's value after one new record from its source. Updates goal['state'] in place."""
+    metric, param, value = goal['metric'], goal.get('param'), goal.get('value', 0)
+    state = goal.setdefault('state', {})
+    if metric == 'exercise_pb':
+        if event.get('name', '').lower() == str(param).lower() and event.get('workout_type') == 'counter':
+            return max(value, _workout_best_set(event))
+        return value
+    if metric in ('weekly_minutes', 'workout_weeks'):
+        week = iso_week(event['date'])
+        if week < state.get('week', ''):
+            return value
+        if week > state.get('week', ''):
+            state.update(week=week, minutes=0, workouts=0)
+        state['minutes'] += event.get('duration', 0)
+        state['workouts'] += 1
+        if metric == 'weekly_minutes':
+            return state['minutes']
+        return value + 1 if state['workouts'] == param else value
+    if metric == 'napfa_grade':
+        return event['grades'].get(param, 0)
+    if metric == 'napfa_score':
+        return event['scores'].get(param, 0)
+    if metric == 'napfa_total':
+        return event['total']
+    if metric == 'napfa_medal':
+        return MEDAL_RANKS.get(napfa_medal(event), 0)
+    if metric == 'napfa_min_grade':
+        return min(event['grades'].values())
+    if metric == 'sleep_avg':
+        return sleep_summary(user_data)['rolling'].get('avg_hours') or 0
+    return value
+
+def goal_current_value(user_data, goal):
+    """Replay the goal's source history into its value and state (used once, when the goal is bound)."""
+    goal['value'], goal['state'] = 0, {}
+    source = GOAL_METRICS[goal['metric']]['source']
+    if source == 'exercise':
+        since = goal.get('created_date', '') if goal['metric'] in ('weekly_minutes', 'workout_weeks') else ''
+        for workout in reversed(user_data.get('exercises', [])):
+            if workout['date'] >= since:
+                goal['value'] = _fold_goal_event(user_data, goal, workout)
+    elif source == 'napfa' and user_data.get('napfa_history'):
+        goal['value'] = _fold_goal_event(user_data, goal, user_data['napfa_history'][-1])
+    elif source == 'sleep':
+        goal['value'] = _fold_goal_event(user_data, goal, None)
+    return goal['value']
+
+def goal_progress(goal):
+    baseline, target, value = goal.get('baseline', 0), goal['target'], goal.get('value', 0)
+    if target == baseline:
+        return 100 if value >= target else 0
+    return int(max(0, min(100, (value - baseline) / (target - baseline) * 100)))
+
+def build_goal_index(user_data):
+    """Open bound goals by source, and the number of goals completed. Does not save."""
+    index = {'sources': {}, 'completed': 0}
+    for goal in user_data.get('smart_goals', []):
+        goal.setdefault('id', new_id())
+        if goal.get('progress', 0) >= 100:
+            index['completed'] += 1
+        elif goal.get('metric'):
+            index['sources'].setdefault(GOAL_METRICS[goal['metric']]['source'], []).append(goal['id'])
+    index['completed'] += sum(1 for g in user_data.get('goals', []) if g.get('progress', 0) >= 100)
+    user_data['goal_index'] = index
+    return index
+
+def get_goal_index(user_data):
+    return user_data.get('goal_index') or build_goal_index(user_data)
+
+def goals_completed(user_data):
+    return get_goal_index(user_data)['completed']
+
+def _goal_reminder_key(goal):
+    return f"goal:{goal['time_bound']}:{goal['specific']}"
+
+def set_goal_progress(user_data, goal, progress, date_str=None):
+    """Record new progress and emit any milestones crossed. Returns the milestones. Does not save."""
+    date_str = date_str or datetime.now().strftime('%Y-%m-%d')
+    previous = goal.get('progress', 0)
+    goal['progress'] = progress
+    if progress != previous:
+        goal.setdefault('weekly_checkpoints', []).append({'date': date_str, 'progress': progress})
+    hit = goal.setdefault('milestones_hit', [])
+    crossed = [m for m in GOAL_MILESTONES if progress >= m and m not in hit]
+    if not crossed:
+        return []
+    hit.extend(crossed)
+    schedule_reminder(user_data, f"goal_milestone:{goal['id']}", date_str, kind='goal_milestone', anchor=date_str,
+                      target=goal['specific'], milestone=crossed[-1],
+                      expires=_shift_date(date_str, GOAL_MILESTONE_NOTICE_DAYS))
+    if 100 in crossed:
+        index = get_goal_index(user_data)
+        index['completed'] += 1
+        for ids in index['sources'].values():
+            if goal['id'] in ids:
+                ids.remove(goal['id'])
+        goal['completed_date'] = date_str
+        cancel_reminder(user_data, _goal_reminder_key(goal))
+        if goal.get('metric'):  # self-reported slider goals count towards badges but earn no points
+            award_points(user_data, f"goal:{goal['id']}", GOAL_COMPLETION_POINTS, 'goal', date_str)
+        award_badges(user_data, check_and_award_badges(user_data)[0])
+    return crossed
+
+def add_goal(user_data, goal):
+    """Save a new SMART goal, binding it to its metric if it has one. Returns an error message
+    instead if a bound goal is already met. Does not save."""
+    goal.setdefault('id', new_id())
+    if goal.get('metric'):
+        if goal['target'] <= goal.get('baseline', 0):
+            return "Your target must be above your current level."
+        value = goal_current_value(user_data, goal)
+        if value >= goal['target']:
+            return (f"You're already there ({GOAL_METRICS[goal['metric']]['label']}: {value:g}). "
+                    f"Set a target above {value:g}.")
+    index = get_goal_index(user_data)
+    user_data.setdefault('smart_goals', []).append(goal)
+    schedule_goal_reminder(user_data, goal['specific'], goal['time_bound'])
+    if goal.get('metric'):
+        index['sources'].setdefault(GOAL_METRICS[goal['metric']]['source'], []).append(goal['id'])
+        set_goal_progress(user_data, goal, goal_progress(goal), goal.get('created_date'))
+    return None
+
+def remove_goal(user_data, position):
+    goal = user_data['smart_goals'].pop(position)
+    for ids in get_goal_index(user_data)['sources'].values():
+        if goal.get('id') in ids:
+            ids.remove(goal['id'])
+    cancel_reminder(user_data, _goal_reminder_key(goal))
+    cancel_reminder(user_data, f"goal_milestone:{goal.get('id')}")
+    if goal.get('progress', 0) >= 100:
+        index = get_goal_index(user_data)
+        index['completed'] = max(0, index['completed'] - 1)
+        if f"goal:{goal['id']}" in get_points_ledger(user_data)['applied']:
+            award_points(user_data, f"goal:{goal['id']}", 0, 'goal_removed', replace=True)
+    return goal
+
+def update_goals(user_data, source, event, date_str=None):
+    """Fold a new NAPFA test, workout or sleep entry into the open goals bound to it. Returns
+    [(goal, milestones)] for goals that crossed one. Does not save."""
+    ids = get_goal_index(user_data)['sources'].get(source)
+    if not ids:
+        return []
+    date_str = date_str or (event or {}).get('date')
+    wanted = set(ids)
+    crossed = []
+    for goal in [g for g in user_data.get('smart_goals', []) if g.get('id') in wanted]:
+        goal['value'] = _fold_goal_event(user_data, goal, event)
+        milestones = set_goal_progress(user_data, goal, goal_progress(goal), date_str)
+        if milestones:
+            crossed.append((goal, milestones))
+    return crossed
 
 def reminders_and_progress():
     st.header("Weekly Progress Report")
@@ -4124,13 +6456,11 @@ def reminders_and_progress():
         st.metric("Streak", f"{streak} days")
 
     # Show progress bar for current level
-    total_points = user_data.get('total_points', 0)
-    level_name, min_points, max_points = calculate_level(total_points)
+    snapshot = get_level_progress(user_data)
 
-    if max_points > min_points:
-        progress = min(100, ((total_points - min_points) / (max_points - min_points)) * 100)
-        st.progress(progress / 100)
-        st.caption(f"{total_points} / {max_points} points to next level")
+    if snapshot['max'] > snapshot['min']:
+        st.progress(snapshot['progress'])
+        st.caption(f"{snapshot['points']} / {snapshot['max']} points to next level")
 
     st.write("---")
 
@@ -4141,7 +6471,7 @@ def reminders_and_progress():
     today_date = datetime.now().strftime('%Y-%m-%d')
 
     # Check scheduled activities for today
-    today_activities = [s for s in user_data.get('schedule', []) if s['day'] == today]
+    today_activities = schedule_entries_for(user_data, today, today_date)
 
     if today_activities:
         for activity in today_activities:
@@ -4149,47 +6479,11 @@ def reminders_and_progress():
     else:
         st.success(f"No workouts scheduled for {today}. Good rest day or add a session!")
 
-    # Smart reminders based on data
-    reminders = []
-
-    # Check last NAPFA test
-    if user_data.get('napfa_history'):
-        last_napfa_date = datetime.strptime(user_data['napfa_history'][-1]['date'], '%Y-%m-%d')
-        days_since_napfa = (datetime.now() - last_napfa_date).days
-        if days_since_napfa > 30:
-            reminders.append(f"It's been {days_since_napfa} days since your last NAPFA test. Consider retesting to track progress!")
-
-    # Check last BMI
-    if user_data.get('bmi_history'):
-        last_bmi_date = datetime.strptime(user_data['bmi_history'][-1]['date'], '%Y-%m-%d')
-        days_since_bmi = (datetime.now() - last_bmi_date).days
-        if days_since_bmi > 14:
-            reminders.append(f" Update your BMI - last recorded {days_since_bmi} days ago")
-
-    # Check sleep tracking
-    if user_data.get('sleep_history'):
-        last_sleep_date = datetime.strptime(user_data['sleep_history'][-1]['date'], '%Y-%m-%d')
-        if last_sleep_date.strftime('%Y-%m-%d') != today_date:
-            reminders.append("Don't forget to log your sleep from last night!")
-    else:
-        reminders.append("Start tracking your sleep for better recovery insights!")
-
-    # Check exercise logging
-    if user_data.get('exercises'):
-        last_exercise_date = datetime.strptime(user_data['exercises'][0]['date'], '%Y-%m-%d')
-        days_since_exercise = (datetime.now() - last_exercise_date).days
-        if days_since_exercise > 2:
-            reminders.append(f"It's been {days_since_exercise} days since your last logged workout. Time to get moving!")
-    else:
-        reminders.append("Start logging your exercises to track your fitness journey!")
-
-    # Check goals progress
-    if user_data.get('goals'):
-        for goal in user_data['goals']:
-            target_date = datetime.strptime(goal['date'], '%Y-%m-%d')
-            days_until = (target_date - datetime.now()).days
-            if 0 <= days_until <= 7:
-                reminders.append(f"Goal deadline approaching: '{goal['target']}' in {days_until} days!")
+    # Smart reminders: pop whatever has come due from the user's reminder queue
+    due_items, changed = pop_due_reminders(user_data, today_date)
+    if changed:
+        update_user_data(user_data)
+    reminders = [reminder_message(item, today_date) for item in due_items]
 
     if reminders:
         st.markdown("### Smart Reminders")
@@ -4232,7 +6526,7 @@ def reminders_and_progress():
             st.metric("Sleep Tracked", len(sleep_this_week))
         with col4:
             if sleep_this_week:
-                avg_sleep = sum([s['hours'] + s['minutes']/60 for s in sleep_this_week]) / len(sleep_this_week)
+                avg_sleep = sum(sleep_hours(s) for s in sleep_this_week) / len(sleep_this_week)
                 st.metric("Avg Sleep", f"{avg_sleep:.1f}h")
             else:
                 st.metric("Avg Sleep", "No data")
@@ -4404,22 +6698,32 @@ def reminders_and_progress():
         if not user_data.get('sleep_history'):
             st.info("No sleep data yet. Start tracking your sleep!")
         else:
-            sleep_data = user_data['sleep_history']
-
-            # Calculate stats
-            total_records = len(sleep_data)
-            avg_hours = sum([s['hours'] + s['minutes']/60 for s in sleep_data]) / total_records
-
-            quality_counts = {'Excellent': 0, 'Good': 0, 'Fair': 0, 'Poor': 0}
-            for s in sleep_data:
-                quality_counts[s['quality']] += 1
+            summary = sleep_summary(user_data)
+            rolling = summary['rolling']
+            avg_hours = summary['avg_hours']
+            quality_counts = summary['quality']
 
             # Display metrics
             col1, col2 = st.columns(2)
             with col1:
                 st.metric("Average Sleep", f"{avg_hours:.1f} hours")
             with col2:
-                st.metric("Records Tracked", total_records)
+                st.metric("Nights Tracked", summary['nights'])
+
+            st.write("")
+            st.write("**Last 7 Nights:**")
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric("Average", f"{rolling['avg_hours']:.1f} h" if rolling.get('avg_hours') is not None else "-")
+            with col2:
+                st.metric("Sleep Debt", f"{rolling.get('debt_hours', 0):.1f} h", help=f"Hours short of {SLEEP_TARGET_HOURS}h on the nights you logged")
+            with col3:
+                st.metric("Regularity", f"{rolling['regularity']:.0f}" if rolling.get('regularity') is not None else "-",
+                          help="Sleep Regularity Index over the last two weeks: 100 = same sleep and wake times every day")
+            with col4:
+                drift = rolling.get('bedtime_drift_min')
+                st.metric("Bedtime Drift", f"{drift:+.0f} min/night" if drift is not None else "-",
+                          help="Positive means your bedtime is getting later")
 
             # Quality breakdown
             st.write("")
@@ -4435,13 +6739,10 @@ def reminders_and_progress():
                 st.metric("Poor", quality_counts['Poor'])
 
             # Sleep trend
-            if len(sleep_data) > 1:
+            if summary['nights'] > 1:
                 st.write("")
                 st.write("**Sleep Duration Trend:**")
-                df = pd.DataFrame(sleep_data)
-                df['total_hours'] = df['hours'] + df['minutes'] / 60
-                df_chart = df.set_index('date')['total_hours']
-                st.line_chart(df_chart)
+                st.line_chart(sleep_chart_frame(user_data))
 
             # Sleep insights
             st.write("")
@@ -4454,13 +6755,252 @@ def reminders_and_progress():
                 st.warning("You're not getting enough sleep. Aim for 8-10 hours for teenagers!")
 
             # Best and worst
-            if len(sleep_data) >= 3:
-                sleep_sorted = sorted(sleep_data, key=lambda x: x['hours'] + x['minutes']/60, reverse=True)
-                best = sleep_sorted[0]
-                worst = sleep_sorted[-1]
+            if summary['nights'] >= 3:
+                best, worst = summary['best'], summary['worst']
+                st.write(f"**Best night:** {best[0]} - {int(best[1])}h {round(best[1] % 1 * 60)}m")
+                st.write(f"**Shortest night:** {worst[0]} - {int(worst[1])}h {round(worst[1] % 1 * 60)}m")
+
+# Metrics Library
+# Array versions of the body and heart-rate formulas: every argument may be a scalar or a NumPy array,
+# so one call covers a single student or a whole class. Derived values are also kept per user in
+# user_data['metrics_series'] ({metric: [[date, value], ...]}), appended on save, so charts never
+# rebuild them from the raw histories.
+ACTIVITY_MULTIPLIERS = {
+    "Sedentary (little/no exercise)": 1.2,
+    "Lightly Active (1-3 days/week)": 1.375,
+    "Moderately Active (3-5 days/week)": 1.55,
+    "Very Active (6-7 days/week)": 1.725,
+    "Extremely Active (athlete, 2x/day)": 1.9
+}
+HR_ZONE_BOUNDS = np.array([0.50, 0.60, 0.70, 0.80, 0.90, 1.00])
+METRIC_SERIES = ['weight', 'bmr', 'tdee', 'body_fat_pct', 'lean_mass', 'resting_hr']
+
+def mifflin_bmr(weight_kg, height_cm, age, male):
+    """Mifflin-St Jeor basal metabolic rate (kcal/day)."""
+    return 10 * np.asarray(weight_kg, dtype=float) + 6.25 * np.asarray(height_cm, dtype=float) \
+        - 5 * np.asarray(age, dtype=float) + np.where(male, 5, -161)
+
+def total_daily_energy(bmr, multiplier):
+    return np.asarray(bmr, dtype=float) * np.asarray(multiplier, dtype=float)
+
+def karvonen_zones(age, resting_hr):
+    """Zone boundaries (bpm) by the heart-rate reserve method: shape (..., 6), zone i spans [i, i+1]."""
+    resting_hr = np.asarray(resting_hr, dtype=float)
+    reserve = (220 - np.asarray(age, dtype=float)) - resting_hr
+    return np.floor(resting_hr[..., None] + reserve[..., None] * HR_ZONE_BOUNDS)
+
+def navy_body_fat(waist_cm, neck_cm, height_cm, male, hip_cm=None):
+    """U.S. Navy circumference estimate of body fat %. hip_cm is only used for females."""
+    waist, neck = np.asarray(waist_cm, dtype=float), np.asarray(neck_cm, dtype=float)
+    height = np.log10(np.asarray(height_cm, dtype=float))
+    hip = np.asarray(hip_cm if hip_cm is not None else np.nan, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        male_pct = 495 / (1.0324 - 0.19077 * np.log10(waist - neck) + 0.15456 * height) - 450
+        female_pct = 495 / (1.29579 - 0.35004 * np.log10(waist + hip - neck) + 0.22100 * height) - 450
+    return np.where(male, male_pct, female_pct)
+
+def build_metrics_series(user_data):
+    """Derived metrics from bmr_history, body_comp_history and heart_rate_data, oldest first."""
+    series = {metric: [] for metric in METRIC_SERIES}
+    for record in user_data.get('bmr_history', []):
+        series['bmr'].append([record['date'], record['bmr']])
+        series['tdee'].append([record['date'], record['tdee']])
+        series['weight'].append([record['date'], record['weight']])
+    for record in user_data.get('body_comp_history', []):
+        series['body_fat_pct'].append([record['date'], record['body_fat_pct']])
+        series['lean_mass'].append([record['date'], record['lean_mass']])
+    for record in user_data.get('heart_rate_data', []):
+        series['resting_hr'].append([record['date'], record['resting_hr']])
+    for points in series.values():
+        points.sort(key=lambda p: p[0])
+    user_data['metrics_series'] = series
+    return series
+
+def get_metrics_series(user_data):
+    return user_data.get('metrics_series') or build_metrics_series(user_data)
+
+def record_metrics(user_data, date_str, **values):
+    """Append derived values for date_str to the cached series, after the history record is written. Does not save."""
+    if not user_data.get('metrics_series'):
+        build_metrics_series(user_data)  # already includes the new record
+        return
+    series = user_data['metrics_series']
+    for metric, value in values.items():
+        if value is not None:
+            series.setdefault(metric, []).append([date_str, round(float(value), 2)])
+
+def metric_frame(user_data, metric):
+    """One cached metric as a date-indexed Series for charting."""
+    points = get_metrics_series(user_data).get(metric, [])
+    return pd.Series([p[1] for p in points], index=pd.to_datetime([p[0] for p in points]), name=metric)
+
+def class_health_metrics(users_data, usernames, activity_level="Moderately Active (3-5 days/week)", today=None):
+    """BMR, TDEE, Karvonen zones and body-fat level and trend for every student in one vectorized pass."""
+    today = today or datetime.now().date()
+    rows, weight, height, age, male, resting = [], [], [], [], [], []
+    trend_idx, trend_x, trend_y = [], [], []
+    for username in usernames:
+        student = users_data.get(username)
+        if not student:
+            continue
+        bmi = student['bmi_history'][-1] if student.get('bmi_history') else {}
+        series = get_metrics_series(student)
+        rows.append(username)
+        weight.append(bmi.get('weight', np.nan))
+        height.append(bmi['height'] * 100 if bmi.get('height') else np.nan)
+        age.append(get_user_age(student))
+        male.append(student.get('gender', 'm') == 'm')
+        resting.append(series['resting_hr'][-1][1] if series.get('resting_hr') else 70)
+        for date_str, value in series.get('body_fat_pct', []):
+            trend_idx.append(len(rows) - 1)
+            trend_x.append((datetime.strptime(date_str, '%Y-%m-%d').date() - today).days)
+            trend_y.append(value)
+    if not rows:
+        return pd.DataFrame()
+
+    bmr = mifflin_bmr(weight, height, age, male)
+    zones = karvonen_zones(age, resting)
+    n = len(rows)
+    idx, x, y = np.asarray(trend_idx, dtype=int), np.asarray(trend_x, dtype=float), np.asarray(trend_y, dtype=float)
+    count = np.bincount(idx, minlength=n).astype(float)
+    sum_x, sum_y = np.bincount(idx, x, n), np.bincount(idx, y, n)
+    sum_xx, sum_xy = np.bincount(idx, x * x, n), np.bincount(idx, x * y, n)
+    denom = count * sum_xx - sum_x * sum_x
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(denom > 0, (count * sum_xy - sum_x * sum_y) / denom, np.nan)
+    latest_fat = np.full(n, np.nan)
+    if len(idx):
+        last = np.r_[np.flatnonzero(np.diff(idx)), len(idx) - 1]  # each student's points are oldest first
+        latest_fat[idx[last]] = y[last]
+
+    frame = pd.DataFrame({
+        'Name': [users_data[u]['name'] for u in rows],
+        'Age': age,
+        'BMR': np.round(bmr),
+        'TDEE': np.round(total_daily_energy(bmr, ACTIVITY_MULTIPLIERS[activity_level])),
+        'Resting HR': resting,
+        'Max HR': 220 - np.asarray(age),
+        'Zone 2 (bpm)': [f"{int(lo)}-{int(hi)}" for lo, hi in zones[:, 1:3]],
+        'Zone 4 (bpm)': [f"{int(lo)}-{int(hi)}" for lo, hi in zones[:, 3:5]],
+        'Body Fat %': np.round(latest_fat, 1),
+        'Body Fat Trend (%/month)': np.round(slope * 30, 2)
+    }, index=rows)
+    return frame
+
+# Heart Rate Sessions
+# Device exports (CSV, TCX, GPX) are read as a stream: CSV row by row, XML with iterparse, clearing
+# each element once read. Samples go straight into typed arrays; time-in-zone is one bincount over
+# the zone index of every sample, weighted by the seconds until the next sample.
+HR_MAX_SAMPLE_GAP_S = 10  # a longer gap (paused recording) only counts this many seconds
+HR_MATCH_WINDOW_MIN = 180
+HR_ZONE_LABELS = ['Below Zone 1', 'Zone 1', 'Zone 2', 'Zone 3', 'Zone 4', 'Zone 5']
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def iter_hr_samples_xml(source):
+    """Yield (timestamp text, bpm) from a TCX Trackpoint or GPX trkpt stream. Only values inside a point
+    count, so lap averages (AverageHeartRateBpm) and metadata times are ignored."""
+    import xml.etree.ElementTree as ET
+    stamp, bpm, in_point = None, None, False
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        name = _local_name(elem.tag)
+        if name in ('Trackpoint', 'trkpt'):
+            if event == 'start':
+                stamp, bpm, in_point = None, None, True
+                continue
+            if stamp and bpm:
+                yield stamp, float(bpm)
+            stamp, bpm, in_point = None, None, False
+            elem.clear()
+        elif event == 'end' and in_point:
+            if name in ('Time', 'time'):
+                stamp = (elem.text or '').strip()
+            elif name in ('Value', 'hr') and (elem.text or '').strip():
+                bpm = elem.text.strip()
+
+def iter_hr_samples_csv(lines, stats=None):
+    """Yield (timestamp text, bpm) from a CSV with a time column and a heart-rate column. Rows with a
+    missing time or a non-numeric bpm are skipped and counted in stats['skipped']."""
+    stats = stats if stats is not None else {}
+    stats.setdefault('skipped', 0)
+    reader = csv.reader(lines)
+    header = [h.strip().lower() for h in next(reader, [])]
+    time_col = next((i for i, h in enumerate(header) if h in ('time', 'timestamp', 'datetime', 'date_time', 'seconds')), None)
+    hr_col = next((i for i, h in enumerate(header) if h in ('heart_rate', 'heartrate', 'hr', 'bpm', 'heart rate')), None)
+    if time_col is None or hr_col is None:
+        raise ValueError("CSV needs a time/timestamp column and a heart_rate/hr/bpm column.")
+    for row in reader:
+        if len(row) <= max(time_col, hr_col) or not row[hr_col].strip():
+            continue
+        try:
+            value = float(row[hr_col])
+        except ValueError:
+            value = None
+        if value is None or not row[time_col].strip():
+            stats['skipped'] += 1
+            continue
+        yield row[time_col].strip(), value
+
+def read_hr_samples(file, filename, stats=None):
+    """(start as local datetime or None, seconds from start array, bpm array) for an uploaded export.
+    CSV rows that could not be read are counted in stats['skipped']."""
+    from array import array
+    if filename.lower().endswith('.csv'):
+        import io
+        samples = iter_hr_samples_csv(io.TextIOWrapper(file, encoding='utf-8', errors='replace'), stats)
+    else:
+        samples = iter_hr_samples_xml(file)
+    stamps, bpm = [], array('d')
+    for stamp, value in samples:
+        stamps.append(stamp)
+        bpm.append(value)
+    if not stamps:
+        return None, np.array([]), np.array([])
+    bpm = np.frombuffer(bpm, dtype=float)
+    if stamps[0].replace('.', '', 1).isdigit():
+        seconds = np.asarray(stamps, dtype=float)
+        start = datetime.fromtimestamp(seconds[0]) if seconds[0] > 1e9 else None
+        return start, seconds - seconds[0], bpm
+    parsed = pd.to_datetime(pd.Index(stamps), format='ISO8601', utc=True)
+    seconds = np.asarray((parsed - parsed[0]) / pd.Timedelta(seconds=1), dtype=float)
+    start = parsed[0]
+    aware = stamps[0].endswith('Z') or (stamps[0][-6:-5] in ('+', '-') and stamps[0][-3:-2] == ':')
+    start = start.tz_convert(datetime.now().astimezone().tzinfo) if aware else start
+    return start.tz_localize(None).to_pydatetime(), seconds, bpm
+
+def hr_zone_summary(seconds, bpm, zone_bounds):
+    """Time in each zone (HR_ZONE_LABELS order) plus average/max HR, from per-sample arrays."""
+    dt = np.minimum(np.diff(seconds, append=seconds[-1] + 1), HR_MAX_SAMPLE_GAP_S).clip(min=0)
+    zone = np.searchsorted(zone_bounds[:5], bpm, side='right')  # 0 = below zone 1, 5 = zone 5
+    zone_seconds = np.bincount(zone, weights=dt, minlength=6)
+    return {
+        'samples': int(len(bpm)),
+        'duration_min': round(float(dt.sum()) / 60, 1),
+        'avg_hr': round(float(np.average(bpm, weights=dt)) if dt.sum() > 0 else float(bpm.mean()), 1),
+        'max_hr': int(bpm.max()),
+        'zone_seconds': [int(round(x)) for x in zone_seconds],
+        'zone_bounds': [int(b) for b in zone_bounds]
+    }
 
-                st.write(f"**Best night:** {best['date']} - {best['hours']}h {best['minutes']}m")
-                st.write(f"**Shortest night:** {worst['date']} - {worst['hours']}h {worst['minutes']}m")
+def match_hr_exercise(user_data, start):
+    """Index of the logged workout closest to start on the same day (within HR_MATCH_WINDOW_MIN), or None."""
+    if start is None:
+        return None
+    best, best_gap = None, HR_MATCH_WINDOW_MIN
+    for i, ex in enumerate(user_data.get('exercises', [])):
+        if ex.get('date') != start.strftime('%Y-%m-%d') or not ex.get('time'):
+            continue
+        gap = abs(_minutes(ex['time']) - (start.hour * 60 + start.minute))
+        if gap <= best_gap:
+            best, best_gap = i, gap
+    return best
+
+def attach_hr_session(user_data, exercise_index, start, summary):
+    """Store the zone summary on the workout. Does not save."""
+    summary = dict(summary, start=start.isoformat(timespec='seconds') if start else None)
+    user_data['exercises'][exercise_index]['hr_summary'] = summary
+    return summary
 
 # Advanced Health Metrics
 def advanced_metrics():
@@ -4517,22 +7057,8 @@ def advanced_metrics():
 
         if st.button("Calculate BMR & Calories", type="primary"):
             # Mifflin-St Jeor Equation (most accurate for teens)
-            if gender == 'm':
-                bmr = (10 * weight) + (6.25 * height) - (5 * age) + 5
-            else:
-                bmr = (10 * weight) + (6.25 * height) - (5 * age) - 161
-
-            # Activity multipliers
-            activity_multipliers = {
-                "Sedentary (little/no exercise)": 1.2,
-                "Lightly Active (1-3 days/week)": 1.375,
-                "Moderately Active (3-5 days/week)": 1.55,
-                "Very Active (6-7 days/week)": 1.725,
-                "Extremely Active (athlete, 2x/day)": 1.9
-            }
-
-            multiplier = activity_multipliers[activity_level]
-            tdee = bmr * multiplier  # Total Daily Energy Expenditure
+            bmr = float(mifflin_bmr(weight, height, age, gender == 'm'))
+            tdee = float(total_daily_energy(bmr, ACTIVITY_MULTIPLIERS[activity_level]))  # Total Daily Energy Expenditure
 
             # Calculate macros
             protein_grams = weight * 1.6  # 1.6g per kg for active teens
@@ -4633,6 +7159,7 @@ def advanced_metrics():
                 'height': height,
                 'activity_level': activity_level
             })
+            record_metrics(user_data, datetime.now().strftime('%Y-%m-%d'), bmr=bmr, tdee=tdee, weight=weight)
             update_user_data(user_data)
 
     with tab2:
@@ -4655,7 +7182,7 @@ def advanced_metrics():
         )
 
         # Heart Rate Reserve method (Karvonen Formula)
-        hr_reserve = max_hr - resting_hr
+        zone_bounds = karvonen_zones(age, resting_hr)
 
         # Define zones
         zones = {
@@ -4699,10 +7226,8 @@ def advanced_metrics():
         st.write("")
         st.write(f"### Your Heart Rate Zones (Max HR: {max_hr} bpm)")
 
-        for zone_name, zone_info in zones.items():
-            min_percent, max_percent = zone_info['range']
-            min_hr = int(resting_hr + (hr_reserve * min_percent))
-            max_hr_zone = int(resting_hr + (hr_reserve * max_percent))
+        for i, (zone_name, zone_info) in enumerate(zones.items()):
+            min_hr, max_hr_zone = int(zone_bounds[i]), int(zone_bounds[i + 1])
 
             with st.expander(f"{zone_name}: {min_hr}-{max_hr_zone} bpm", expanded=True):
                 st.markdown(f"""
@@ -4733,6 +7258,41 @@ def advanced_metrics():
         - Light jogging or walking
         """)
 
+        # Import a recorded session
+        st.write("")
+        st.write("### Import a Heart Rate Session")
+        st.caption("Upload a CSV, TCX or GPX export from your watch to see time in each zone for a logged workout.")
+        hr_file = st.file_uploader("Heart rate file", type=['csv', 'tcx', 'gpx'], key="hr_upload")
+        if hr_file is not None:
+            hr_stats = {}
+            try:
+                start, seconds, bpm = read_hr_samples(hr_file, hr_file.name, hr_stats)
+            except (ValueError, SyntaxError) as e:
+                st.error(f"Could not read the file: {e}")
+                bpm = np.array([])
+            if hr_stats.get('skipped'):
+                st.caption(f"Skipped {hr_stats['skipped']:,} row(s) without a readable time or heart rate.")
+            if len(bpm) == 0:
+                st.warning("No heart rate samples found in this file.")
+            else:
+                summary = hr_zone_summary(seconds, bpm, zone_bounds)
+                st.write(f"**{summary['samples']:,} samples · {summary['duration_min']} min · "
+                         f"avg {summary['avg_hr']} bpm · max {summary['max_hr']} bpm**")
+                st.bar_chart(pd.Series([s / 60 for s in summary['zone_seconds']], index=HR_ZONE_LABELS, name="Minutes"))
+
+                exercises = user_data.get('exercises', [])
+                if exercises:
+                    matched = match_hr_exercise(user_data, start)
+                    choice = st.selectbox(
+                        "Attach to workout", range(min(len(exercises), 50)),
+                        index=matched if matched is not None and matched < 50 else 0,
+                        format_func=lambda i: f"{exercises[i]['date']} {exercises[i].get('time', '')} · {exercises[i]['name']}",
+                        key="hr_attach_choice")
+                    if st.button("Attach to Workout", key="hr_attach"):
+                        attach_hr_session(user_data, choice, start, summary)
+                        update_user_data(user_data)
+                        st.success("Heart rate summary attached to your workout!")
+
         # Save resting HR
         if 'heart_rate_data' not in user_data:
             user_data['heart_rate_data'] = []
@@ -4743,6 +7303,7 @@ def advanced_metrics():
                 'resting_hr': resting_hr,
                 'max_hr': max_hr
             })
+            record_metrics(user_data, datetime.now().strftime('%Y-%m-%d'), resting_hr=resting_hr)
             update_user_data(user_data)
             st.success("Resting heart rate saved!")
 
@@ -4794,12 +7355,7 @@ def advanced_metrics():
 
         if st.button("Calculate Body Composition", type="primary"):
             # Navy Method formulas
-            if gender == 'm':
-                # Male formula
-                body_fat_pct = (495 / (1.0324 - 0.19077 * np.log10(waist - neck) + 0.15456 * np.log10(height_cm))) - 450
-            else:
-                # Female formula
-                body_fat_pct = (495 / (1.29579 - 0.35004 * np.log10(waist + hip - neck) + 0.22100 * np.log10(height_cm))) - 450
+            body_fat_pct = float(navy_body_fat(waist, neck, height_cm, gender == 'm', hip if gender == 'f' else None))
 
             # Calculate fat mass and lean mass
             fat_mass = (body_fat_pct / 100) * weight
@@ -4973,27 +7529,26 @@ def advanced_metrics():
                 'waist': waist,
                 'hip': hip if gender == 'f' else None
             })
+            record_metrics(user_data, datetime.now().strftime('%Y-%m-%d'),
+                           body_fat_pct=round(body_fat_pct, 1), lean_mass=round(lean_mass, 1))
             update_user_data(user_data)
 
             st.success("Body composition data saved to your history!")
 
         # Show history if available
-        if user_data.get('body_comp_history') and len(user_data['body_comp_history']) > 1:
+        if len(get_metrics_series(user_data).get('body_fat_pct', [])) > 1:
             st.write("")
             st.write("### Progress Tracking")
 
-            df_comp = pd.DataFrame(user_data['body_comp_history'])
-            df_comp['date'] = pd.to_datetime(df_comp['date'])
-
             col1, col2 = st.columns(2)
 
             with col1:
                 st.write("**Body Fat % Trend**")
-                st.line_chart(df_comp.set_index('date')['body_fat_pct'])
+                st.line_chart(metric_frame(user_data, 'body_fat_pct'))
 
             with col2:
                 st.write("**Lean Mass Trend**")
-                st.line_chart(df_comp.set_index('date')['lean_mass'])
+                st.line_chart(metric_frame(user_data, 'lean_mass'))
 
         # Method explanation
         st.write("")
@@ -5679,18 +8234,612 @@ def show_mock_nutrition_data(food_query):
             3. Embed videos directly in app
             """)
 
+# House Ledger
+# Every change to a student's house points is a transaction appended to HOUSE_LEDGER_FILE.
+# Running totals live in school_data['house_ledger'] so standings and top lists are O(1) reads.
+HOUSE_TOP_N = 10
+
+def new_house_ledger():
+    return {'next_id': 1, 'totals': {}, 'workouts': {}, 'balances': {}, 'top': {}}
+
+def _iter_house_transactions():
+    if not os.path.exists(HOUSE_LEDGER_FILE):
+        return
+    with open(HOUSE_LEDGER_FILE) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def _last_ledger_id():
+    """The id of the last transaction on disk, read from the end of the file."""
+    if not os.path.exists(HOUSE_LEDGER_FILE):
+        return 0
+    with open(HOUSE_LEDGER_FILE, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 4096))
+        lines = f.read().splitlines()
+    for line in reversed(lines):
+        try:
+            return json.loads(line)['id']
+        except (ValueError, KeyError):
+            continue  # the first line of the tail may be cut off
+    return 0
+
+def _append_ledger_transaction(ledger, username, house, points, reason, workout=None):
+    # The file is written before school data is saved, so trust it over a possibly stale next_id
+    ledger['next_id'] = max(ledger['next_id'], _last_ledger_id() + 1)
+    tx = {
+        'id': ledger['next_id'],
+        'ts': datetime.now().isoformat(timespec='seconds'),
+        'username': username,
+        'house': house,
+        'points': round(points, 4),
+        'reason': reason,
+        'workout': {'date': workout['date'], 'time': workout.get('time'), 'name': workout.get('name'),
+                    'duration': workout.get('duration')} if workout else None
+    }
+    ledger['next_id'] += 1
+    with open(HOUSE_LEDGER_FILE, 'a') as f:
+        f.write(json.dumps(tx) + '\n')
+    return tx
+
+def _apply_ledger_points(ledger, username, house, points, workout=False):
+    ledger['totals'][house] = ledger['totals'].get(house, 0) + points
+    balances = ledger['balances'].setdefault(house, {})
+    balances[username] = balances.get(username, 0) + points
+    if workout:
+        ledger['workouts'][house] = ledger['workouts'].get(house, 0) + 1
+    _update_house_top(ledger, house, username)
+
+def _update_house_top(ledger, house, username):
+    """Keep the HOUSE_TOP_N best balances per house; O(N) per change, full refill only when a listed member
+    drops out or loses points (someone outside the list may now rank above them)."""
+    balances = ledger['balances'].get(house, {})
+    previous = next((entry for entry in ledger['top'].get(house, []) if entry[0] == username), None)
+    if previous is not None and (username not in balances or balances[username] < previous[1]):
+        ledger['top'][house] = [list(entry) for entry in heapq.nlargest(HOUSE_TOP_N, balances.items(), key=lambda x: x[1])]
+        return
+    top = [entry for entry in ledger['top'].get(house, []) if entry[0] != username]
+    if username in balances:
+        top.append([username, balances[username]])
+    top.sort(key=lambda x: x[1], reverse=True)
+    if len(top) < min(HOUSE_TOP_N, len(balances)):
+        top = sorted(([u, p] for u, p in balances.items()), key=lambda x: x[1], reverse=True)
+    ledger['top'][house] = top[:HOUSE_TOP_N]
+
+def get_house_ledger():
+    """The running totals, rebuilt from the ledger file (or opening balances) on first use."""
+    ledger = st.session_state.school_data.get('house_ledger')
+    if ledger is None:
+        ledger = rebuild_house_ledger(st.session_state.users_data)
+    return ledger
+
+def rebuild_house_ledger(users_data):
+    """Recompute the running totals by replaying HOUSE_LEDGER_FILE, then add an opening-balance transaction
+    for each student with a house but no balance there. Workout counts follow each student's history."""
+    ledger = new_house_ledger()
+    for tx in _iter_house_transactions():
+        ledger['next_id'] = max(ledger['next_id'], tx['id'] + 1)
+        house, username = tx['house'], tx['username']
+        ledger['totals'][house] = ledger['totals'].get(house, 0) + tx['points']
+        balances = ledger['balances'].setdefault(house, {})
+        if tx['reason'] == 'transfer_out':
+            balances.pop(username, None)
+        else:
+            balances[username] = balances.get(username, 0) + tx['points']
+    for username, data in users_data.items():
+        if data.get('role') != 'student' or not data.get('house'):
+            continue
+        house = data['house']
+        ledger['workouts'][house] = ledger['workouts'].get(house, 0) + len(data.get('exercises', []))
+        if username not in ledger['balances'].get(house, {}):
+            points = data.get('house_points_contributed', 0)
+            _append_ledger_transaction(ledger, username, house, points, 'opening_balance')
+            ledger['totals'][house] = ledger['totals'].get(house, 0) + points
+            ledger['balances'].setdefault(house, {})[username] = points
+    for house, balances in ledger['balances'].items():
+        ledger['top'][house] = [list(entry) for entry in heapq.nlargest(HOUSE_TOP_N, balances.items(), key=lambda x: x[1])]
+    st.session_state.school_data['house_ledger'] = ledger
+    save_school_data(st.session_state.school_data)
+    return ledger
+
+def add_house_member(username, house):
+    """Register a new student with a zero balance so member counts include them. Does not save."""
+    if house:
+        get_house_ledger()['balances'].setdefault(house, {}).setdefault(username, 0)
+
+def record_house_points(username, user_data, points, workout):
+    """Ledger entry for a saved workout. Returns True when school data needs saving."""
+    if user_data.get('role') != 'student' or not user_data.get('house'):
+        return False
+    ledger = get_house_ledger()
+    house = user_data['house']
+    _append_ledger_transaction(ledger, username, house, points, 'workout', workout)
+    _apply_ledger_points(ledger, username, house, points, workout=True)
+    return True
+
+def transfer_house(users_data, username, new_house):
+    """Move a student and their contributed points to another house, with matching out/in transactions."""
+    student = users_data[username]
+    old_house = student.get('house')
+    if old_house == new_house:
+        return
+    ledger = get_house_ledger()
+    workouts = len(student.get('exercises', []))
+    ledger['workouts'][new_house] = ledger['workouts'].get(new_house, 0) + workouts
+    if old_house:
+        balance = ledger['balances'].get(old_house, {}).pop(username, 0)
+        ledger['totals'][old_house] = ledger['totals'].get(old_house, 0) - balance
+        ledger['workouts'][old_house] = ledger['workouts'].get(old_house, 0) - workouts
+        _append_ledger_transaction(ledger, username, old_house, -balance, 'transfer_out')
+        _update_house_top(ledger, old_house, username)
+    else:
+        # First join: the student's whole history counts for the new house
+        balance = student.get('house_points_contributed', 0)
+    _append_ledger_transaction(ledger, username, new_house, balance, 'transfer_in')
+    _apply_ledger_points(ledger, username, new_house, balance)
+    student['house'] = new_house
+    cls = get_student_class(users_data, student)
+    if cls is not None and cls.get('rollup') is not None:
+        rebuild_class_rollup(users_data, cls)
+    save_school_data(st.session_state.school_data)
+
+def house_standings():
+    """[(house, points, workouts)] best first, straight from the running totals."""
+    ledger = get_house_ledger()
+    return sorted(((house, ledger['totals'].get(house, 0), ledger['workouts'].get(house, 0)) for house in ROSTER_HOUSES),
+                  key=lambda x: x[1], reverse=True)
+
+def house_top_contributors(house, n=5):
+    return get_house_ledger()['top'].get(house, [])[:n]
+
+def house_member_count(house):
+    return len(get_house_ledger()['balances'].get(house, {}))
+
+def read_house_transactions(username=None, house=None, limit=50):
+    """Most recent transactions matching the filters, streamed from the ledger file."""
+    from collections import deque
+    matches = deque(maxlen=limit)
+    for tx in _iter_house_transactions():
+        if (username is None or tx['username'] == username) and (house is None or tx['house'] == house):
+            matches.append(tx)
+    return list(reversed(matches))
+
+# School Analytics (pre-aggregated cubes for school admins)
+# Each school has its own cubes; cells are keyed "a|b|c" so they survive the JSON round trip.
+
+def school_level(user_data):
+    """Secondary level from age (13 -> Sec 1 ... 17 -> Sec 5)."""
+    if not user_data.get('birthday') and not isinstance(user_data.get('age'), int):
+        return 'Unknown'
+    return f"Sec {min(max(get_user_age(user_data) - 12, 1), 5)}"
+
+def iso_week(date_str):
+    year, week, _ = datetime.strptime(date_str, '%Y-%m-%d').isocalendar()
+    return f"{year}-W{week:02d}"
+
+def school_term(date_str):
+    """Term 1: Jan-Mar, Term 2: Apr-Jun, Term 3: Jul-Sep, Term 4: Oct-Dec."""
+    d = datetime.strptime(date_str, '%Y-%m-%d')
+    return f"{d.year}-T{(d.month - 1) // 3 + 1}"
+
+def new_analytics_cubes():
+    return {'generated': None, 'schools': {}, 'napfa_term_latest': {}}
+
+def get_analytics_cubes():
+    cubes = st.session_state.school_data.get('analytics')
+    if not cubes or 'schools' not in cubes:  # missing, or saved before cubes were split by school
+        cubes = st.session_state.school_data['analytics'] = new_analytics_cubes()
+    return cubes
+
+def school_cubes(cubes, school):
+    """One school's cubes, empty if it has no data yet."""
+    return cubes['schools'].get(school or 'none') or {'house_level_week': {}, 'class_medal_term': {}}
+
+def _school_cubes_for(cubes, user_data):
+    return cubes['schools'].setdefault(user_data.get('school') or 'none',
+                                       {'house_level_week': {}, 'class_medal_term': {}})
+
+def _add_workout_to_cubes(cubes, username, user_data, workout, house_pts):
+    house = user_data.get('house') or 'none'
+    key = f"{house}|{school_level(user_data)}|{iso_week(workout['date'])}"
+    cell = _school_cubes_for(cubes, user_data)['house_level_week'].setdefault(
+        key, {'workouts': 0, 'minutes': 0, 'points': 0, 'students': {}})
+    cell['workouts'] += 1
+    cell['minutes'] += workout.get('duration', 0)
+    cell['points'] += house_pts
+    cell['students'][username] = cell['students'].get(username, 0) + 1
+
+def _add_napfa_to_cubes(cubes, username, user_data, test):
+    """Each student counts once per term, under the medal of their latest test that term."""
+    term = school_term(test['date'])
+    class_id = user_data.get('class_id') or 'none'
+    school = user_data.get('school') or 'none'
+    medal = napfa_medal(test)
+    latest_key = f"{username}|{term}"
+    previous = cubes['napfa_term_latest'].get(latest_key)
+    if previous:
+        counts = cubes['schools'][previous['school']]['class_medal_term']
+        old_key = f"{previous['class_id']}|{previous['medal']}|{term}"
+        counts[old_key] -= 1
+        if counts[old_key] == 0:
+            del counts[old_key]
+    counts = _school_cubes_for(cubes, user_data)['class_medal_term']
+    new_key = f"{class_id}|{medal}|{term}"
+    counts[new_key] = counts.get(new_key, 0) + 1
+    cubes['napfa_term_latest'][latest_key] = {'school': school, 'class_id': class_id, 'medal': medal,
+                                              'total': test['total']}
+
+def rebuild_analytics_cubes(users_data):
+    """Full rebuild from every student's history (admin button / first use)."""
+    cubes = new_analytics_cubes()
+    for username, data in users_data.items():
+        if data.get('role') != 'student':
+            continue
+        for workout in data.get('exercises', []):
+            _add_workout_to_cubes(cubes, username, data, workout, workout.get('duration', 0) / 60)
+        for test in data.get('napfa_history', []):
+            _add_napfa_to_cubes(cubes, username, data, test)
+    cubes['generated'] = datetime.now().isoformat()
+    st.session_state.school_data['analytics'] = cubes
+    save_school_data(st.session_state.school_data)
+    return cubes
+
+def record_workout_analytics(username, user_data, workout, house_pts):
+    """Returns True when the cubes changed (the caller saves school data)."""
+    if user_data.get('role') != 'student':
+        return False
+    _add_workout_to_cubes(get_analytics_cubes(), username, user_data, workout, house_pts)
+    return True
+
+def record_napfa_analytics(username, user_data, test):
+    if user_data.get('role') != 'student':
+        return False
+    _add_napfa_to_cubes(get_analytics_cubes(), username, user_data, test)
+    return True
+
+def house_level_week_frame(cubes, school):
+    """One school's house x level x week cube as a DataFrame (one row per cell)."""
+    rows = []
+    for key, cell in school_cubes(cubes, school)['house_level_week'].items():
+        house, level, week = key.split('|')
+        rows.append({'House': house, 'Level': level, 'Week': week, 'Workouts': cell['workouts'],
+                     'Minutes': cell['minutes'], 'Points': cell['points'], 'Active Students': len(cell['students'])})
+    return pd.DataFrame(rows, columns=['House', 'Level', 'Week', 'Workouts', 'Minutes', 'Points', 'Active Students'])
+
+def class_medal_term_frame(cubes, users_data, school):
+    rows = []
+    for key, count in school_cubes(cubes, school)['class_medal_term'].items():
+        class_id, medal, term = key.split('|')
+        cls = get_class(users_data, class_id) if class_id != 'none' else None
+        rows.append({'Class': get_class_label(cls, users_data) if cls else 'No class', 'Medal': medal,
+                     'Term': term, 'Students': count})
+    return pd.DataFrame(rows, columns=['Class', 'Medal', 'Term', 'Students'])
+
+def ensure_school_admin(users_data, username):
+    """Make a teacher a school admin if their email is in FITTRACK_SCHOOL_ADMINS. Anyone else needs an
+    existing admin at their school to grant access. Returns True when access was granted. Does not save."""
+    data = users_data.get(username, {})
+    if data.get('role') != 'teacher' or data.get('school_admin'):
+        return False
+    if data.get('email', '').lower() in SCHOOL_ADMIN_EMAILS:
+        data['school_admin'] = True
+        return True
+    return False
+
+def school_analytics():
+    st.header("School Analytics")
+    st.caption("School-wide participation and fitness, from pre-aggregated data.")
+
+    all_users = st.session_state.users_data
+    school = get_user_data().get('school')
+    cubes = get_analytics_cubes()
+
+    col1, col2 = st.columns([3, 1])
+    with col2:
+        if st.button("Rebuild Analytics", key="rebuild_analytics") or not cubes.get('generated'):
+            cubes = rebuild_analytics_cubes(all_users)
+    with col1:
+        st.caption(f"Full rebuild: {datetime.fromisoformat(cubes['generated']).strftime('%d %b %Y %H:%M')} · updated live as students log activity")
+
+    tab1, tab2, tab3, tab4 = st.tabs(["Participation", "NAPFA Medals", "Admins", "Levels"])
+
+    with tab1:
+        df = house_level_week_frame(cubes, school)
+        if df.empty:
+            st.info("No workouts logged yet.")
+        else:
+            weeks = sorted(df['Week'].unique())
+            c1, c2, c3 = st.columns(3)
+            with c1:
+                houses = st.multiselect("Houses", sorted(df['House'].unique()), key="sa_houses")
+            with c2:
+                levels = st.multiselect("Levels", sorted(df['Level'].unique()), key="sa_levels")
+            with c3:
+                week_range = st.select_slider("Weeks", options=weeks, value=(weeks[max(0, len(weeks) - 8)], weeks[-1]), key="sa_weeks") \
+                    if len(weeks) > 1 else (weeks[0], weeks[0])
+            metric = st.radio("Measure", ['Active Students', 'Workouts', 'Minutes', 'Points'], horizontal=True, key="sa_metric")
+            split_by = st.radio("Split by", ['House', 'Level'], horizontal=True, key="sa_split")
+
+            view = df[(df['Week'] >= week_range[0]) & (df['Week'] <= week_range[1])]
+            if houses:
+                view = view[view['House'].isin(houses)]
+            if levels:
+                view = view[view['Level'].isin(levels)]
+
+            if view.empty:
+                st.info("No data for this selection.")
+            else:
+                # Active Students is distinct within a cell; a student active in several weeks counts in each
+                pivot = view.pivot_table(index='Week', columns=split_by, values=metric, aggfunc='sum', fill_value=0)
+                st.line_chart(pivot)
+                st.dataframe(view.groupby(split_by)[['Workouts', 'Minutes', 'Points', 'Active Students']].sum(),
+                             use_container_width=True)
+
+    with tab2:
+        df = class_medal_term_frame(cubes, all_users, school)
+        if df.empty:
+            st.info("No NAPFA tests recorded yet.")
+        else:
+            term = st.selectbox("Term", sorted(df['Term'].unique(), reverse=True), key="sa_term")
+            view = df[df['Term'] == term]
+            pivot = view.pivot_table(index='Class', columns='Medal', values='Students', aggfunc='sum', fill_value=0)
+            st.bar_chart(pivot)
+            st.dataframe(pivot, use_container_width=True)
+
+    with tab3:
+        st.write("### School Admins")
+        st.caption("Admins (principals, heads of department) can open School Analytics.")
+        teachers = {u: d for u, d in all_users.items() if d.get('role') == 'teacher' and d.get('school') == school}
+        for username, data in teachers.items():
+            if data.get('school_admin'):
+                st.write(f"• {data['name']} (@{username})")
+        others = [u for u, d in teachers.items() if not d.get('school_admin')]
+        if others:
+            grant = st.selectbox("Grant access to", others, format_func=lambda x: teachers[x]['name'], key="sa_grant")
+            if st.button("Grant Admin Access", key="sa_grant_btn"):
+                all_users[grant]['school_admin'] = True
+                save_users(all_users)
+                st.success(f"{teachers[grant]['name']} can now view School Analytics.")
+                st.rerun()
+
+    with tab4:
+        st.write("### Level Thresholds")
+        st.caption(f"Points needed for each level at {school or 'your school'}. Students' levels update when you save.")
+        table = pd.DataFrame(get_level_table(school), columns=['Min Points', 'Level'])
+        edited = st.data_editor(table, num_rows="dynamic", use_container_width=True, key="sa_levels_table")
+        if st.button("Save Levels", key="sa_levels_save", type="primary"):
+            error = set_level_table(all_users, school, edited.dropna().values.tolist())
+            if error:
+                st.error(error)
+            else:
+                st.success("Level thresholds saved.")
+                st.rerun()
+
+# Report Export (streams rows to CSV/Parquet files)
+EXPORT_DIR = 'exports'
+EXPORT_BATCH_SIZE = 1000
+EXPORT_MAX_AGE_HOURS = 1    # report files only need to live until they are downloaded
+NAPFA_REPORT_COLUMNS = [('NAPFA Total', 'int'), ('Medal', 'str'), ('Sit-Ups', 'int'), ('Broad Jump', 'int'),
+                        ('Sit & Reach', 'int'), ('Pull-Ups', 'int'), ('Shuttle Run', 'int'), ('2.4km Run', 'int')]
+NAPFA_GRADE_KEYS = {'Sit-Ups': 'SU', 'Broad Jump': 'SBJ', 'Sit & Reach': 'SAR',
+                    'Pull-Ups': 'PU', 'Shuttle Run': 'SR', '2.4km Run': 'RUN'}
+WORKOUT_DETAIL_COLUMNS = [('Username', 'str'), ('Name', 'str'), ('Date', 'str'), ('Time', 'str'),
+                          ('Exercise', 'str'), ('Duration (min)', 'int'), ('Intensity', 'str'),
+                          ('Distance (km)', 'float'), ('Total Reps', 'int'), ('Points', 'float'),
+                          ('Verification', 'str')]
+
+def summary_report_columns(include_napfa=True, include_workouts=True, include_attendance=True, date_range=False):
+    columns = [('Name', 'str'), ('Email', 'str'), ('Age', 'str'), ('Gender', 'str')]
+    if include_napfa:
+        columns += NAPFA_REPORT_COLUMNS
+    if include_workouts:
+        columns += [('Total Workouts', 'int'), ('Workouts This Week', 'int')]
+        if date_range:
+            columns += [('Workouts In Range', 'int'), ('Minutes In Range', 'int')]
+    if include_attendance:
+        columns += [('Login Streak', 'int'), ('Level', 'str'), ('Total Points', 'float')]
+    return columns
+
+def _exercises_in_range(exercises, start=None, end=None):
+    """Exercises are stored newest first, so stop as soon as we pass the start date."""
+    for e in exercises:
+        if end and e['date'] > end:
+            continue
+        if start and e['date'] < start:
+            break
+        yield e
+
+def summary_report_rows(users_data, usernames, include_napfa=True, include_workouts=True,
+                        include_attendance=True, start=None, end=None):
+    """Yield one summary row per student from stored totals and the rolling activity window."""
+    today = datetime.now().date().toordinal()
+    for username in usernames:
+        student = users_data.get(username)
+        if not student:
+            continue
+        row = {
+            'Name': student['name'],
+            'Email': student.get('email', ''),
+            'Age': str(student.get('age', '')),
+            'Gender': 'Male' if student.get('gender') == 'm' else 'Female'
+        }
+
+        if include_napfa and student.get('napfa_history'):
+            latest = student['napfa_history'][-1]
+            row['NAPFA Total'] = latest['total']
+            row['Medal'] = latest['medal']
+            for column, key in NAPFA_GRADE_KEYS.items():
+                row[column] = latest['grades'].get(key, 0)
+
+        if include_workouts:
+            row['Total Workouts'] = len(student.get('exercises', []))
+            row['Workouts This Week'] = window_sum(get_activity_window(student), 'workouts', 7, today)
+            if start or end:
+                in_range = list(_exercises_in_range(student.get('exercises', []), start, end))
+                row['Workouts In Range'] = len(in_range)
+                row['Minutes In Range'] = sum(e.get('duration', 0) for e in in_range)
+
+        if include_attendance:
+            row['Login Streak'] = student.get('login_streak', 0)
+            row['Level'] = student.get('level', 'Novice')
+            row['Total Points'] = points_balance(student)
+
+        yield row
+
+def workout_detail_rows(users_data, usernames, start=None, end=None):
+    """Yield one row per logged workout, optionally limited to a date range."""
+    for username in usernames:
+        student = users_data.get(username)
+        if not student:
+            continue
+        for e in _exercises_in_range(student.get('exercises', []), start, end):
+            yield {
+                'Username': username,
+                'Name': student['name'],
+                'Date': e['date'],
+                'Time': e.get('time', ''),
+                'Exercise': e.get('name', ''),
+                'Duration (min)': e.get('duration', 0),
+                'Intensity': e.get('intensity', ''),
+                'Distance (km)': e.get('distance_km'),
+                'Total Reps': e.get('total_reps'),
+                'Points': e.get('points_earned'),
+                'Verification': e.get('verification_status', '')
+            }
+
+def write_report_csv(rows, columns, path):
+    """Write rows to CSV one at a time. Returns the number of rows written."""
+    count = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=[name for name, _ in columns])
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+def write_report_parquet(rows, columns, path, batch_size=EXPORT_BATCH_SIZE):
+    """Write rows to Parquet in row groups of batch_size. Requires pyarrow."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {'str': pa.string(), 'int': pa.int64(), 'float': pa.float64()}
+    schema = pa.schema([(name, arrow_types[kind]) for name, kind in columns])
+    casts = {'str': str, 'int': int, 'float': float}
+
+    def to_batch(batch):
+        arrays = {}
+        for name, kind in columns:
+            values = [row.get(name) for row in batch]
+            arrays[name] = [None if v is None or v == '' else casts[kind](v) for v in values]
+        return pa.Table.from_pydict(arrays, schema=schema)
+
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                writer.write_table(to_batch(batch))
+                count += len(batch)
+                batch = []
+        if batch or count == 0:
+            writer.write_table(to_batch(batch))
+            count += len(batch)
+    return count
+
+def prune_exports(max_age_hours=EXPORT_MAX_AGE_HOURS):
+    """Delete report files in EXPORT_DIR older than max_age_hours. Returns how many were removed."""
+    if not os.path.isdir(EXPORT_DIR):
+        return 0
+    cutoff = time.time() - max_age_hours * 3600
+    removed = 0
+    for entry in os.scandir(EXPORT_DIR):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
+            removed += 1
+    return removed
+
+def report_scopes(teacher_data):
+    """Who a teacher may export: their own classes, plus their whole school for school admins."""
+    scopes = ["This class", "All my classes"]
+    if teacher_data.get('school_admin'):
+        scopes.append("Whole school")
+    return scopes
+
+def report_scope_usernames(users_data, teacher_data, scope, class_id=None):
+    if scope == "Whole school" and teacher_data.get('school_admin'):
+        school = teacher_data.get('school')
+        return [u for u, d in users_data.items() if d.get('role') == 'student' and d.get('school') == school]
+    classes = teacher_classes(teacher_data) if scope == "All my classes" else \
+        [c for c in teacher_classes(teacher_data) if c['id'] == class_id]
+    return [u for cls in classes for u in cls['students'] if u in users_data]
+
+def export_report(users_data, usernames, report='summary', fmt='csv', start=None, end=None, **options):
+    """Stream a summary or per-workout report to a file in EXPORT_DIR. Returns (path, row_count)."""
+    prune_exports()
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    if report == 'workouts':
+        rows = workout_detail_rows(users_data, usernames, start, end)
+        columns = WORKOUT_DETAIL_COLUMNS
+    else:
+        rows = summary_report_rows(users_data, usernames, start=start, end=end, **options)
+        columns = summary_report_columns(date_range=bool(start or end), **options)
+
+    # A unique file per export, so teachers exporting at the same moment never share a file
+    fd, path = tempfile.mkstemp(dir=EXPORT_DIR, prefix=f"{report}_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}_",
+                                suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        if fmt == 'parquet':
+            count = write_report_parquet(rows, columns, path)
+        else:
+            count = write_report_csv(rows, columns, path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, count
+
 def teacher_dashboard():
     st.header("Teacher Dashboard")
 
     user_data = get_user_data()
     all_users = st.session_state.users_data
 
+    # Class switcher
+    classes = teacher_classes(user_data)
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        if classes:
+            selected_class_id = st.selectbox(
+                "Class",
+                [c['id'] for c in classes],
+                format_func=lambda x: user_data['classes'][x].get('label') or 'My Class',
+                key="teacher_selected_class"
+            )
+    with col2:
+        with st.expander("Add Class"):
+            added_label = st.text_input("Class Name", placeholder="e.g., 3-Integrity, Sec 2A", key="teacher_new_class_label")
+            if st.button("Create Class", key="teacher_create_class"):
+                added_class = new_class(st.session_state.username, added_label.strip(), generate_class_code(all_users))
+                user_data.setdefault('classes', {})[added_class['id']] = added_class
+                update_user_data(user_data)
+                st.success(f"Class created! Code: {added_class['code']}")
+                st.rerun()
+
+    if not classes:
+        st.info("Create your first class to get a class code for your students.")
+        return
+
+    current_class = user_data['classes'][selected_class_id]
+
     # Display class code
-    class_display_label = user_data.get('class_label') or 'My Class'
+    class_display_label = current_class.get('label') or 'My Class'
     st.markdown(f"""
     <div class="stat-card" style="background: linear-gradient(135deg, {COLOURS['blue']} 0%, #1565c0 100%); color: white;">
         <h2>{class_display_label}</h2>
-        <h3>Class Code: <strong>{user_data['class_code']}</strong></h3>
+        <h3>Class Code: <strong>{current_class['code']}</strong></h3>
         <p>Share this code with your students so they can join your class</p>
     </div>
     """, unsafe_allow_html=True)
@@ -5698,9 +8847,13 @@ def teacher_dashboard():
     st.write("")
 
     # Get student list
-    student_usernames = user_data.get('students', [])
+    student_usernames = current_class['students']
     students_data = {username: all_users[username] for username in student_usernames if username in all_users}
 
+    # Scheduled NAPFA forecast and reminder runs (results are shared by all teachers)
+    forecast_store = ensure_napfa_forecasts_fresh()
+    reminder_digest = ensure_school_reminders_fresh()
+
     # Create tabs
     tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
         "My Fitness",
@@ -5834,14 +8987,12 @@ def teacher_dashboard():
             'black': {'points': 0, 'members': [], 'workouts': 0, 'display': 'Black House', 'color': '#2F4F4F'}
         }
 
-        # Calculate points for teacher's students only
-        for username, student in students_data.items():
-            if student.get('house'):
-                house = student['house']
-                if house in house_stats:
-                    house_stats[house]['points'] += student.get('house_points_contributed', 0)
-                    house_stats[house]['members'].append(username)
-                    house_stats[house]['workouts'] += len(student.get('exercises', []))
+        # Per-house totals for this class from the class rollup
+        if current_class.get('rollup') is None or 'houses' not in current_class['rollup']:
+            rebuild_class_rollup(all_users, current_class)
+            save_users(all_users)
+        for house, totals in current_class['rollup']['houses'].items():
+            house_stats[house].update(totals)
 
         # Sort houses
         sorted_houses = sorted(house_stats.items(), key=lambda x: x[1]['points'], reverse=True)
@@ -5882,48 +9033,26 @@ def teacher_dashboard():
     with tab3:
         st.subheader("Class Overview")
 
+        overview = class_overview_stats(all_users, current_class)
+        napfa_scores = overview['napfa_scores']
+
         # Stats
         col1, col2, col3, col4 = st.columns(4)
 
         with col1:
-            st.metric("Total Students", f"{len(students_data)}/30")
+            st.metric("Total Students", f"{overview['students']}/{class_capacity(current_class)}")
 
         with col2:
-            # Calculate average NAPFA
-            napfa_scores = []
-            for student in students_data.values():
-                if student.get('napfa_history'):
-                    napfa_scores.append(student['napfa_history'][-1]['total'])
-
-            if napfa_scores:
-                avg_napfa = sum(napfa_scores) / len(napfa_scores)
-                st.metric("Avg NAPFA Score", f"{avg_napfa:.1f}/30")
+            if overview['avg_napfa'] is not None:
+                st.metric("Avg NAPFA Score", f"{overview['avg_napfa']:.1f}/30")
             else:
                 st.metric("Avg NAPFA Score", "No data")
 
         with col3:
-            # Active this week
-            week_ago = datetime.now() - timedelta(days=7)
-            active_count = 0
-            for student in students_data.values():
-                if student.get('exercises'):
-                    for exercise in student['exercises']:
-                        if datetime.strptime(exercise['date'], '%Y-%m-%d') >= week_ago:
-                            active_count += 1
-                            break
-
-            st.metric("Active This Week", f"{active_count}/{len(students_data)}")
+            st.metric("Active This Week", f"{overview['active_this_week']}/{overview['students']}")
 
         with col4:
-            # Total workouts this week
-            total_workouts = 0
-            for student in students_data.values():
-                if student.get('exercises'):
-                    weekly = [e for e in student['exercises']
-                            if datetime.strptime(e['date'], '%Y-%m-%d') >= week_ago]
-                    total_workouts += len(weekly)
-
-            st.metric("Class Workouts", total_workouts)
+            st.metric("Class Workouts", overview['workouts_this_week'])
 
         # Performance distribution
         if napfa_scores:
@@ -5938,19 +9067,7 @@ def teacher_dashboard():
             st.write("")
             st.write("###  Medal Distribution")
 
-            medal_counts = {'Gold': 0, 'Silver': 0, 'Bronze': 0, 'No Medal': 0}
-            for student in students_data.values():
-                if student.get('napfa_history'):
-                    medal = student['napfa_history'][-1]['medal']
-                    if '' in medal:
-                        medal_counts['Gold'] += 1
-                    elif '' in medal:
-                        medal_counts['Silver'] += 1
-                    elif '' in medal:
-                        medal_counts['Bronze'] += 1
-                    else:
-                        medal_counts['No Medal'] += 1
-
+            medal_counts = overview['medal_counts']
             col1, col2, col3, col4 = st.columns(4)
             col1.metric("Gold", medal_counts['Gold'])
             col2.metric("Silver", medal_counts['Silver'])
@@ -5962,21 +9079,9 @@ def teacher_dashboard():
             st.write("")
             st.write("###  Top Performers")
 
-            student_scores = []
-            for username, student in students_data.items():
-                if student.get('napfa_history'):
-                    student_scores.append({
-                        'name': student['name'],
-                        'username': username,
-                        'score': student['napfa_history'][-1]['total'],
-                        'medal': student['napfa_history'][-1]['medal']
-                    })
-
-            student_scores.sort(key=lambda x: x['score'], reverse=True)
-
-            for idx, student in enumerate(student_scores[:5], 1):
+            for idx, (username, napfa) in enumerate(overview['top'][:5], 1):
                 medal = "" if idx == 1 else "" if idx == 2 else "" if idx == 3 else f"{idx}."
-                st.write(f"{medal} **{student['name']}** - {student['score']}/30 ({student['medal']})")
+                st.write(f"{medal} **{all_users.get(username, {}).get('name', username)}** - {napfa['total']}/30 ({napfa['medal']})")
 
         # Students needing attention
         st.write("")
@@ -5992,17 +9097,163 @@ def teacher_dashboard():
                 if latest_napfa['total'] < 9:
                     needs_attention.append(f" **{student['name']}** - Low NAPFA score ({latest_napfa['total']}/30)")
 
+        class_risk = batch_injury_risk(students_data, list(students_data.keys()))
+        for username, risk in class_risk.items():
+            if risk['level'] == "High Risk":
+                needs_attention.append(f"**{students_data[username]['name']}** - High injury risk ({', '.join(risk['factors'])})")
+
+        for username in students_data:
+            if 'napfa' in reminder_digest.get('students', {}).get(username, []):
+                needs_attention.append(f"**{students_data[username]['name']}** - NAPFA retest overdue")
+
         if needs_attention:
             for msg in needs_attention[:5]:
                 st.warning(msg)
         else:
             st.success("All students doing well!")
 
+        # NAPFA forecasts from the batch job
+        st.write("")
+        st.write("### NAPFA Gold Forecasts")
+
+        fc1, fc2 = st.columns([3, 1])
+        with fc1:
+            if forecast_store.get('generated'):
+                generated_at = datetime.fromisoformat(forecast_store['generated'])
+                st.caption(f"Last run: {generated_at.strftime('%d %b %Y %H:%M')} · "
+                           f"{len(forecast_store.get('students', {}))} students in {forecast_store.get('duration_s', 0):.2f}s")
+        with fc2:
+            if st.button("Refresh Forecasts", key="refresh_forecasts"):
+                forecast_store = run_napfa_forecast_job()
+                st.success("Forecasts updated!")
+
+        class_forecasts = [(username, forecast_store.get('students', {}).get(username))
+                           for username in students_data]
+        class_forecasts = [(username, f) for username, f in class_forecasts if f]
+
+        if not class_forecasts:
+            st.info("Forecasts will appear once your students complete NAPFA tests.")
+        else:
+            status_labels = {
+                'gold': 'Gold achieved',
+                'on_track': 'On track',
+                'off_track': 'Off track',
+                'declining': 'Declining',
+                'insufficient_data': 'Needs 2+ tests'
+            }
+            forecast_rows = []
+            for username, f in class_forecasts:
+                forecast_rows.append({
+                    'Name': students_data[username]['name'],
+                    'Latest': f"{f['latest_total']}/30",
+                    'Trend (pts/month)': f['slope_per_month'] if f['slope_per_month'] is not None else '-',
+                    'Predicted Gold': datetime.strptime(f['gold_date'], '%Y-%m-%d').strftime('%b %Y') if f['gold_date'] else '-',
+                    'Status': status_labels.get(f['status'], f['status'])
+                })
+            st.dataframe(pd.DataFrame(forecast_rows), use_container_width=True, hide_index=True)
+
+            at_risk = [(username, f) for username, f in class_forecasts if f['at_risk']]
+            if at_risk:
+                st.write(f"**{len(at_risk)} student(s) at risk of missing Gold:**")
+                for username, f in at_risk:
+                    st.warning(f"**{students_data[username]['name']}** - {', '.join(f['reasons'])}")
+
+        # Weekly training plans for the whole class
+        st.write("")
+        with st.expander("Generate Weekly Training Plans"):
+            st.caption("Each student with a NAPFA test gets the week that maximizes their projected gain, "
+                       "shown in their AI Schedule Generator.")
+            pc1, pc2, pc3 = st.columns(3)
+            with pc1:
+                class_start = st.time_input("School Start", value=datetime.strptime("07:30", "%H:%M").time(), key="class_plan_start")
+            with pc2:
+                class_end = st.time_input("School End", value=datetime.strptime("15:30", "%H:%M").time(), key="class_plan_end")
+            with pc3:
+                class_weekend = st.selectbox("Weekends", list(PLAN_WEEKEND_WINDOWS), key="class_plan_weekend")
+            if st.button("Generate for Class", key="class_plan_generate"):
+                started = time.time()
+                plans = plan_class_schedules(all_users, list(students_data), {
+                    'school_start': class_start.strftime('%H:%M'),
+                    'school_end': class_end.strftime('%H:%M'),
+                    'weekend': class_weekend
+                })
+                st.success(f"Generated {len(plans)} plan(s) in {time.time() - started:.2f}s.")
+                if plans:
+                    st.dataframe(pd.DataFrame([
+                        {'Name': students_data[username]['name'],
+                         'Sessions': sum(1 for entries in plan['days'].values() if entries[0]['session']),
+                         'Projected Gain': plan['projected_gain']}
+                        for username, plan in plans.items()
+                    ]), use_container_width=True, hide_index=True)
+
+        with st.expander("Class Health Metrics"):
+            st.caption("BMR and calorie needs, heart-rate zones and body-fat trends for every student, from their latest records.")
+            class_activity = st.selectbox("Activity level for TDEE", list(ACTIVITY_MULTIPLIERS), index=2, key="class_metrics_activity")
+            metrics_df = class_health_metrics(all_users, list(students_data), class_activity)
+            if metrics_df.empty:
+                st.info("No students in this class yet.")
+            else:
+                st.dataframe(metrics_df, use_container_width=True, hide_index=True)
+
+        with st.expander("Schedule a Class Session"):
+            st.caption("Adds the session to every student's Training Schedule. Students it would clash with are skipped.")
+            sc1, sc2, sc3, sc4 = st.columns(4)
+            with sc1:
+                session_day = st.selectbox("Day", PLAN_DAYS, key="class_session_day")
+            with sc2:
+                session_time = st.time_input("Time", value=datetime.strptime("16:00", "%H:%M").time(), key="class_session_time")
+            with sc3:
+                session_duration = st.number_input("Duration (min)", min_value=10, max_value=300, value=60, key="class_session_duration")
+            with sc4:
+                session_once = st.checkbox("One-off (next occurrence)", key="class_session_once")
+            session_activity = st.text_input("Activity", placeholder="e.g., NAPFA practice", key="class_session_activity")
+            if st.button("Add to Class Schedules", key="class_session_add") and session_activity:
+                entry = {'day': session_day, 'activity': session_activity, 'time': str(session_time),
+                         'duration': int(session_duration)}
+                if session_once:
+                    ahead = (PLAN_DAYS.index(session_day) - datetime.now().weekday()) % 7
+                    entry.update({'recurrence': 'once',
+                                  'date': (datetime.now().date() + timedelta(days=ahead)).isoformat()})
+                result = push_class_session(all_users, current_class, entry)
+                st.success(f"Added to {len(result['added'])} student schedule(s).")
+                if result['conflicts']:
+                    st.warning("Clashes, not added: " + ", ".join(all_users[u]['name'] for u in result['conflicts']))
+
     with tab4:
         st.subheader("Student List")
 
+        with st.expander("Import Class Roster (CSV)"):
+            st.caption("Columns: email, name (required); gender, house, birthday (optional). "
+                       "New students get an account with a temporary password; existing students are added to your class.")
+            roster_file = st.file_uploader("Roster CSV", type=['csv'], key="roster_upload")
+            if roster_file is not None and st.button("Import Roster", type="primary", key="import_roster"):
+                rows, errors = parse_roster_csv(roster_file.getvalue().decode('utf-8-sig'))
+                for error in errors[:10]:
+                    st.warning(error)
+                if rows:
+                    result = import_roster(all_users, current_class, rows, get_email_index())
+                    if not result['ok']:
+                        st.error(result['error'])
+                    else:
+                        for created in result['created']:
+                            add_house_member(created['username'], all_users[created['username']].get('house'))
+                        save_users(all_users)
+                        save_school_data(st.session_state.school_data)
+                        mark_indexes_current('email_index')
+                        st.success(f"Created {len(result['created'])} account(s) and added "
+                                   f"{len(result['added'])} existing student(s) to your class.")
+                        if result['created']:
+                            st.download_button(
+                                "Download New Logins (CSV)",
+                                data=pd.DataFrame(result['created']).to_csv(index=False),
+                                file_name=f"new_student_logins_{datetime.now().strftime('%Y%m%d')}.csv",
+                                mime="text/csv"
+                            )
+                    for email, reason in result['skipped'][:10]:
+                        st.info(f"Skipped {email}: {reason}")
+
         if not students_data:
-            st.info("No students in your class yet. Share your class code: " + user_data['class_code'])
+            st.info("No students in your class yet. Share your class code: " + current_class['code'])
         else:
             # Search and filter
             search = st.text_input("Search students", placeholder="Enter name or username")
@@ -6030,7 +9281,7 @@ def teacher_dashboard():
 
                         with col3:
                             st.write(f"**Level:** {student.get('level', 'Novice')}")
-                            st.write(f"**Points:** {student.get('total_points', 0)}")
+                            st.write(f"**Points:** {points_balance(student)}")
                             st.write(f"**Login Streak:** {student.get('login_streak', 0)} days")
 
                         # House info and assignment
@@ -6064,17 +9315,15 @@ def teacher_dashboard():
                         col_a, col_b = st.columns(2)
                         with col_a:
                             if st.button(f"Update House", key=f"update_house_{username}"):
-                                student['house'] = new_house
+                                transfer_house(all_users, username, new_house)
                                 save_users(all_users)
                                 st.success(f"Updated {student['name']}'s house to {new_house.title()}!")
                                 st.rerun()
 
                         with col_b:
                             if st.button(f"Remove from class", key=f"remove_{username}"):
-                                user_data['students'].remove(username)
-                                student['teacher_class'] = None
+                                remove_student_from_class(all_users, username, current_class)
                                 update_user_data(user_data)
-                                save_users(all_users)
                                 st.success(f"Removed {student['name']} from class")
                                 st.rerun()
 
@@ -6229,12 +9478,8 @@ def teacher_dashboard():
                         with b1:
                             if st.button(" Save", key=f"save_{s_username}_{ex_idx}", use_container_width=True, type="primary"):
                                 diff = new_pts - current_pts
-                                st.session_state.users_data[s_username]["exercises"][ex_idx]["points_earned"] = new_pts
-                                st.session_state.users_data[s_username]["exercises"][ex_idx]["teacher_override"] = True
-                                st.session_state.users_data[s_username]["exercises"][ex_idx]["verification_status"] = "verified"
-                                st.session_state.users_data[s_username]["total_points"] = (
-                                    st.session_state.users_data[s_username].get("total_points", 0) + diff
-                                )
+                                student = st.session_state.users_data[s_username]
+                                override_workout_points(student, student["exercises"][ex_idx], new_pts)
                                 save_users(st.session_state.users_data)
                                 st.success(f"Saved! {'+' if diff >= 0 else ''}{diff} pts applied to {s_name}.")
                                 st.rerun()
@@ -6333,14 +9578,22 @@ def teacher_dashboard():
 
         # Class name management
         st.write("###  Rename Your Class")
-        current_label = user_data.get('class_label', '')
+        current_label = current_class.get('label', '')
         new_label = st.text_input("Class Name", value=current_label, placeholder="e.g., 3-Integrity, Sec 2A", key="teacher_class_label")
         if st.button(" Save Class Name"):
-            user_data['class_label'] = new_label.strip()
+            current_class['label'] = new_label.strip()
             update_user_data(user_data)
             st.success(f"Class renamed to **{new_label.strip()}**!")
             st.rerun()
 
+        new_capacity = st.number_input("Class Capacity", min_value=max(1, len(students_data)),
+                                       max_value=MAX_CLASS_CAPACITY, value=max(class_capacity(current_class), len(students_data)),
+                                       key="teacher_class_capacity")
+        if new_capacity != class_capacity(current_class) and st.button("Save Capacity", key="save_capacity"):
+            current_class['capacity'] = int(new_capacity)
+            update_user_data(user_data)
+            st.success(f"Class capacity set to {int(new_capacity)}.")
+
         st.write("---")
 
         # AI Verification Strictness
@@ -6397,70 +9650,57 @@ def teacher_dashboard():
         st.info("Generate a comprehensive class report and export to Google Sheets")
 
         # Report options
-        include_napfa = st.checkbox("Include NAPFA scores", value=True)
-        include_workouts = st.checkbox("Include workout logs", value=True)
-        include_attendance = st.checkbox("Include attendance/participation", value=True)
-
-        if st.button("Generate Report (Download CSV)", type="primary"):
-            if not students_data:
+        report_kind = st.radio("Report", ["Class summary", "Per-workout detail"], horizontal=True, key="report_kind")
+        report_scope = st.radio("Students", report_scopes(user_data), horizontal=True, key="report_scope")
+        report_format = st.radio("Format", ["CSV", "Parquet"], horizontal=True, key="report_format")
+
+        use_range = st.checkbox("Limit to a date range", key="report_use_range")
+        start_str = end_str = None
+        if use_range:
+            rc1, rc2 = st.columns(2)
+            with rc1:
+                start_str = st.date_input("From", value=datetime.now().date() - timedelta(days=30), key="report_start").strftime('%Y-%m-%d')
+            with rc2:
+                end_str = st.date_input("To", value=datetime.now().date(), key="report_end").strftime('%Y-%m-%d')
+
+        include_napfa = include_workouts = include_attendance = True
+        if report_kind == "Class summary":
+            include_napfa = st.checkbox("Include NAPFA scores", value=True)
+            include_workouts = st.checkbox("Include workout logs", value=True)
+            include_attendance = st.checkbox("Include attendance/participation", value=True)
+
+        if st.button("Generate Report", type="primary"):
+            report_usernames = report_scope_usernames(all_users, user_data, report_scope, current_class['id'])
+
+            if not report_usernames:
                 st.error("No students to export")
             else:
-                # Generate report data
-                report_data = []
-
-                for username, student in students_data.items():
-                    row = {
-                        'Name': student['name'],
-                        'Email': student.get('email', ''),
-                        'Age': student.get('age', ''),
-                        'Gender': 'Male' if student.get('gender') == 'm' else 'Female'
-                    }
-
-                    if include_napfa and student.get('napfa_history'):
-                        latest = student['napfa_history'][-1]
-                        row['NAPFA Total'] = latest['total']
-                        row['Medal'] = latest['medal']
-                        row['Sit-Ups'] = latest['grades'].get('SU', 0)
-                        row['Broad Jump'] = latest['grades'].get('SBJ', 0)
-                        row['Sit & Reach'] = latest['grades'].get('SAR', 0)
-                        row['Pull-Ups'] = latest['grades'].get('PU', 0)
-                        row['Shuttle Run'] = latest['grades'].get('SR', 0)
-                        row['2.4km Run'] = latest['grades'].get('RUN', 0)
-
-                    if include_workouts:
-                        row['Total Workouts'] = len(student.get('exercises', []))
-
-                        # This week
-                        week_ago = datetime.now() - timedelta(days=7)
-                        weekly = [e for e in student.get('exercises', [])
-                                if datetime.strptime(e['date'], '%Y-%m-%d') >= week_ago]
-                        row['Workouts This Week'] = len(weekly)
-
-                    if include_attendance:
-                        row['Login Streak'] = student.get('login_streak', 0)
-                        row['Level'] = student.get('level', 'Novice')
-                        row['Total Points'] = student.get('total_points', 0)
-
-                    report_data.append(row)
-
-                # Create DataFrame
-                df_report = pd.DataFrame(report_data)
-
-                # Convert to CSV
-                csv = df_report.to_csv(index=False)
-
-                st.download_button(
-                    label="Download CSV Report",
-                    data=csv,
-                    file_name=f"class_report_{datetime.now().strftime('%Y%m%d')}.csv",
-                    mime="text/csv"
-                )
+                fmt = report_format.lower()
+                options = {}
+                if report_kind == "Class summary":
+                    options = {'include_napfa': include_napfa, 'include_workouts': include_workouts,
+                               'include_attendance': include_attendance}
+                try:
+                    path, row_count = export_report(all_users, report_usernames,
+                                                    report='workouts' if report_kind == "Per-workout detail" else 'summary',
+                                                    fmt=fmt, start=start_str, end=end_str, **options)
+                except ImportError:
+                    st.error("Parquet export needs pyarrow. Install it with: pip install pyarrow")
+                else:
+                    with open(path, 'rb') as f:
+                        st.download_button(
+                            label=f"Download {report_format} Report",
+                            data=f,
+                            file_name=os.path.basename(path),
+                            mime="text/csv" if fmt == 'csv' else "application/octet-stream"
+                        )
 
-                st.success("Report generated! Click to download.")
+                    st.success(f"Report generated with {row_count} rows! Click to download.")
 
-                # Preview
-                st.write("### Preview")
-                st.dataframe(df_report, use_container_width=True)
+                    # Preview
+                    if fmt == 'csv':
+                        st.write("### Preview")
+                        st.dataframe(pd.read_csv(path, nrows=50), use_container_width=True)
 
         st.write("")
         st.write("###  Share Instructions")
@@ -6475,13 +9715,370 @@ def teacher_dashboard():
         **For automatic Google Sheets export, this feature will be available after deployment.**
         """)
 
+# Schedule
+# user_data['schedule'] holds weekly entries (keyed by 'day') and one-off entries ('recurrence': 'once',
+# keyed by 'date'); weekly entries may be bounded by 'starts'/'until' dates. user_data['schedule_index']
+# keeps each key's [start, end, id] rows sorted by start, plus the longest entry per key, so an
+# overlap check is a bisect plus the few rows it lands on. 'positions' maps each id to its place in
+# the schedule list, so a row resolves to its entry without a scan.
+
+def schedule_interval(entry):
+    start = _minutes(entry['time'])
+    return start, start + int(entry['duration'])
+
+def schedule_key(entry):
+    return entry['date'] if entry.get('recurrence') == 'once' else entry['day']
+
+def build_schedule_index(schedule):
+    index = {'days': {}, 'longest': {}, 'positions': {}}
+    for i, entry in enumerate(schedule):
+        entry.setdefault('id', f"legacy-{i}")
+        _index_schedule_entry(index, entry, i)
+    return index
+
+def _index_schedule_entry(index, entry, position):
+    index['positions'][entry['id']] = position
+    key = schedule_key(entry)
+    start, end = schedule_interval(entry)
+    bisect.insort(index['days'].setdefault(key, []), [start, end, entry['id']])
+    index['longest'][key] = max(index['longest'].get(key, 0), end - start)
+
+def get_schedule_index(user_data):
+    """The per-day interval index, built from the schedule on first use."""
+    index = user_data.get('schedule_index')
+    if index is None or 'positions' not in index:
+        index = user_data['schedule_index'] = build_schedule_index(user_data.setdefault('schedule', []))
+    return index
+
+def schedule_entry(user_data, entry_id):
+    """The schedule entry with this id, or None."""
+    position = get_schedule_index(user_data)['positions'].get(entry_id)
+    return user_data['schedule'][position] if position is not None else None
+
+def schedule_active_range(entry):
+    """(first, last) date the entry can occur on; open bounds are '' and '9999'."""
+    if entry.get('recurrence') == 'once':
+        return entry['date'], entry['date']
+    return entry.get('starts', ''), entry.get('until', '9999')
+
+def _overlapping_rows(index, key, start, end):
+    rows = index['days'].get(key, [])
+    i = bisect.bisect_left(rows, [start - index['longest'].get(key, 0)])
+    found = []
+    while i < len(rows) and rows[i][0] < end:
+        if rows[i][1] > start:
+            found.append(rows[i][2])
+        i += 1
+    return found
+
+def schedule_conflicts(user_data, entry):
+    """Ids of entries that overlap entry: same weekday for weekly sessions, plus one-offs on matching dates.
+    Entries whose 'starts'/'until' bounds never meet entry's dates do not conflict."""
+    index = get_schedule_index(user_data)
+    start, end = schedule_interval(entry)
+    if entry.get('recurrence') == 'once':
+        keys = [entry['date'], datetime.strptime(entry['date'], '%Y-%m-%d').strftime('%A')]
+    else:
+        today = datetime.now().strftime('%Y-%m-%d')
+        keys = [entry['day']] + [key for key in index['days'] if key[:1].isdigit() and key >= today
+                                 and datetime.strptime(key, '%Y-%m-%d').strftime('%A') == entry['day']]
+    first, last = schedule_active_range(entry)
+    conflicts = []
+    for key in keys:
+        for entry_id in _overlapping_rows(index, key, start, end):
+            other = schedule_entry(user_data, entry_id)
+            if other is None:
+                continue
+            other_first, other_last = schedule_active_range(other)
+            if other_first <= last and first <= other_last:
+                conflicts.append(entry_id)
+    return conflicts
+
+def add_schedule_entry(user_data, entry, allow_conflicts=False):
+    """Insert entry into the schedule and index. Returns the conflicting ids; nothing is added on conflict
+    unless allow_conflicts. Does not save."""
+    entry.setdefault('id', new_id())
+    conflicts = schedule_conflicts(user_data, entry)
+    if conflicts and not allow_conflicts:
+        return conflicts
+    index = get_schedule_index(user_data)
+    user_data['schedule'].append(entry)
+    _index_schedule_entry(index, entry, len(user_data['schedule']) - 1)
+    return conflicts
+
+def remove_schedule_entry(user_data, entry_id):
+    index = get_schedule_index(user_data)
+    i = index['positions'].pop(entry_id, None)
+    if i is None:
+        return None
+    entry = user_data['schedule'].pop(i)
+    for later in user_data['schedule'][i:]:
+        index['positions'][later['id']] -= 1
+    rows = index['days'].get(schedule_key(entry), [])
+    rows[:] = [row for row in rows if row[2] != entry_id]
+    return entry
+
+def schedule_entries_for(user_data, day, date_str=None):
+    """Weekly entries for day plus one-offs on date_str, in start order."""
+    index = get_schedule_index(user_data)
+    rows = index['days'].get(day, []) + (index['days'].get(date_str, []) if date_str else [])
+    entries = [user_data['schedule'][index['positions'][row[2]]] for row in sorted(rows) if row[2] in index['positions']]
+    if date_str:
+        return [entry for entry in entries if entry.get('starts', '') <= date_str <= entry.get('until', '9999')]
+    return entries
+
+def expand_schedule(user_data, start_date, end_date):
+    """Yield (date, entry) for every occurrence between the two dates (inclusive), one day at a time."""
+    day = datetime.strptime(start_date, '%Y-%m-%d')
+    last = datetime.strptime(end_date, '%Y-%m-%d')
+    while day <= last:
+        date_str = day.strftime('%Y-%m-%d')
+        for entry in schedule_entries_for(user_data, day.strftime('%A'), date_str):
+            yield date_str, entry
+        day += timedelta(days=1)
+
+def schedule_busy_by_day(user_data, today=None):
+    """(start, end) intervals per weekday over the coming week, for the training plan optimizer."""
+    today = today or datetime.now().date()
+    busy = {day: [] for day in PLAN_DAYS}
+    for date_str, entry in expand_schedule(user_data, today.isoformat(), (today + timedelta(days=6)).isoformat()):
+        if entry.get('source') != 'plan':
+            busy[entry['day']].append(schedule_interval(entry))
+    return busy
+
+def push_class_session(users_data, cls, entry):
+    """Add a copy of entry to every student in cls, skipping students it would clash with. Saves once.
+    Returns {'added': [usernames], 'conflicts': [usernames]}."""
+    result = {'added': [], 'conflicts': []}
+    for username in cls['students']:
+        student = users_data.get(username)
+        if student is None:
+            continue
+        session = dict(entry, id=f"class-{cls['id']}-{new_id()}", source=f"class:{cls['id']}")
+        if add_schedule_entry(student, session):
+            result['conflicts'].append(username)
+        else:
+            result['added'].append(username)
+    save_users(users_data)
+    return result
+
+# Calendar Import/Export (iCalendar .ics)
+# Export streams one VEVENT per schedule entry, with weekly entries as RRULE:FREQ=WEEKLY. Import reads
+# the file line by line and expands recurrences lazily up to ICS_IMPORT_HORIZON_DAYS. Timed events become
+# 'busy' entries, so conflict checks and plan generation see the real school timetable.
+ICS_IMPORT_HORIZON_DAYS = 56
+ICS_WEEKDAYS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+
+def _ics_escape(text):
+    return str(text).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def _ics_unescape(text):
+    return text.replace('\\n', '\n').replace('\\N', '\n').replace('\\,', ',').replace('\\;', ';').replace('\\\\', '\\')
+
+def _ics_fold(line):
+    """Split a content line into 75-character chunks joined by CRLF + space (RFC 5545 folding)."""
+    chunks = [line[:75]] + [' ' + line[i:i + 74] for i in range(75, len(line), 74)]
+    return '\r\n'.join(chunks) + '\r\n'
+
+def iter_schedule_ics(user_data, name="FitTrack Training"):
+    """Yield the schedule as iCalendar text, a few lines at a time."""
+    yield _ics_fold('BEGIN:VCALENDAR') + _ics_fold('VERSION:2.0') + _ics_fold('PRODID:-//FitTrack//Training Schedule//EN')
+    yield _ics_fold(f'X-WR-CALNAME:{_ics_escape(name)}')
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    today = datetime.now().date()
+    for entry in user_data.get('schedule', []):
+        if entry.get('busy'):
+            continue  # imported from the school calendar; it already lives there
+        start_min, end_min = schedule_interval(entry)
+        if entry.get('recurrence') == 'once':
+            day = datetime.strptime(entry['date'], '%Y-%m-%d').date()
+        else:
+            first = max(today, datetime.strptime(entry['starts'], '%Y-%m-%d').date()) if entry.get('starts') else today
+            day = first + timedelta(days=(PLAN_DAYS.index(entry['day']) - first.weekday()) % 7)
+        start = datetime.combine(day, datetime.min.time()) + timedelta(minutes=start_min)
+        lines = ['BEGIN:VEVENT', f"UID:{entry.get('id', new_id())}@fittrack", f'DTSTAMP:{stamp}',
+                 f"DTSTART:{start.strftime('%Y%m%dT%H%M%S')}",
+                 f"DTEND:{(start + timedelta(minutes=end_min - start_min)).strftime('%Y%m%dT%H%M%S')}",
+                 f"SUMMARY:{_ics_escape(entry['activity'])}"]
+        if entry.get('recurrence') != 'once':
+            rule = f"RRULE:FREQ=WEEKLY;BYDAY={ICS_WEEKDAYS[PLAN_DAYS.index(entry['day'])]}"
+            if entry.get('until'):
+                rule += f";UNTIL={entry['until'].replace('-', '')}T235959"
+            lines.append(rule)
+        lines.append('END:VEVENT')
+        yield ''.join(_ics_fold(line) for line in lines)
+    yield _ics_fold('END:VCALENDAR')
+
+def _ics_unfold(lines):
+    """Yield logical content lines from raw lines, joining folded continuations."""
+    current = None
+    for raw in lines:
+        raw = raw.rstrip('\r\n')
+        if raw[:1] in (' ', '\t') and current is not None:
+            current += raw[1:]
+            continue
+        if current is not None:
+            yield current
+        current = raw
+    if current:
+        yield current
+
+def _ics_datetime(value, params):
+    """(datetime in local time, all_day) for a DTSTART/DTEND value."""
+    if 'VALUE=DATE' in params or len(value) == 8:
+        return datetime.strptime(value[:8], '%Y%m%d'), True
+    parsed = datetime.strptime(value[:15], '%Y%m%dT%H%M%S')
+    if value.endswith('Z'):
+        parsed = parsed.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+    return parsed, False
+
+def _ics_duration(value):
+    """Minutes in an ISO 8601 duration like PT1H30M or P1D."""
+    total, number = 0, ''
+    for ch in value.lstrip('+P').replace('T', ''):
+        if ch.isdigit():
+            number += ch
+        elif number:
+            total += int(number) * {'W': 10080, 'D': 1440, 'H': 60, 'M': 1, 'S': 0}.get(ch, 0)
+            number = ''
+    return total
+
+def iter_ics_events(lines):
+    """Yield one dict per VEVENT (summary, start, end, all_day, uid, rrule) without reading the whole file."""
+    event = None
+    for line in _ics_unfold(lines):
+        if line == 'BEGIN:VEVENT':
+            event = {'rrule': None, 'summary': 'Event', 'duration': None, 'end': None}
+        elif line == 'END:VEVENT' and event is not None:
+            if 'start' in event:
+                if event['end'] is None:
+                    event['end'] = event['start'] + timedelta(minutes=event['duration'] if event['duration'] is not None
+                                                              else (1440 if event['all_day'] else 60))
+                yield event
+            event = None
+        elif event is not None and ':' in line:
+            head, value = line.split(':', 1)
+            name, _, params = head.partition(';')
+            name = name.upper()
+            if name == 'DTSTART':
+                event['start'], event['all_day'] = _ics_datetime(value, params)
+            elif name == 'DTEND':
+                event['end'] = _ics_datetime(value, params)[0]
+            elif name == 'DURATION':
+                event['duration'] = _ics_duration(value)
+            elif name == 'SUMMARY':
+                event['summary'] = _ics_unescape(value)
+            elif name == 'UID':
+                event['uid'] = value
+            elif name == 'RRULE':
+                event['rrule'] = dict(part.split('=', 1) for part in value.split(';') if '=' in part)
+
+def expand_ics_event(event, window_start, window_end):
+    """Yield the start datetimes of event that fall in [window_start, window_end), generating them lazily.
+    Handles DAILY and WEEKLY rules with INTERVAL, COUNT, UNTIL and BYDAY."""
+    rule = event['rrule']
+    if not rule:
+        if window_start <= event['start'] < window_end:
+            yield event['start']
+        return
+    freq = rule.get('FREQ')
+    if freq not in ('DAILY', 'WEEKLY'):
+        if window_start <= event['start'] < window_end:
+            yield event['start']
+        return
+    interval = int(rule.get('INTERVAL', 1))
+    count = int(rule['COUNT']) if 'COUNT' in rule else None
+    until = _ics_datetime(rule['UNTIL'], '')[0] if 'UNTIL' in rule else None
+    if until is not None and len(rule['UNTIL']) == 8:
+        until += timedelta(days=1) - timedelta(seconds=1)
+    weekdays = sorted(ICS_WEEKDAYS.index(day[-2:]) for day in rule['BYDAY'].split(',')) \
+        if freq == 'WEEKLY' and rule.get('BYDAY') else [event['start'].weekday()]
+    step = timedelta(days=interval) if freq == 'DAILY' else timedelta(weeks=interval)
+    period = event['start'] - timedelta(days=event['start'].weekday() if freq == 'WEEKLY' else 0)
+    emitted = 0
+    while period < window_end:
+        candidates = [period] if freq == 'DAILY' else [period + timedelta(days=d) for d in weekdays]
+        for occurrence in candidates:
+            if occurrence < event['start']:
+                continue
+            if (until is not None and occurrence > until) or (count is not None and emitted >= count):
+                return
+            emitted += 1
+            if occurrence >= window_start:
+                if occurrence >= window_end:
+                    return
+                yield occurrence
+        period += step
+
+def import_ics(user_data, lines, today=None, horizon_days=ICS_IMPORT_HORIZON_DAYS):
+    """Add the calendar's timed events as busy schedule entries. Plain weekly rules stay weekly entries;
+    everything else is expanded into one-offs within the horizon. Re-importing replaces events by UID.
+    Returns {'events', 'entries', 'skipped_all_day', 'clashes': [(event summary, training activity, date)]}. Does not save."""
+    today = today or datetime.now().date()
+    window_start = datetime.combine(today, datetime.min.time())
+    window_end = window_start + timedelta(days=horizon_days)
+    by_uid = {}
+    for entry in user_data.get('schedule', []):
+        if entry.get('uid'):
+            by_uid.setdefault(entry['uid'], []).append(entry['id'])
+    summary = {'events': 0, 'entries': 0, 'skipped_all_day': 0, 'clashes': []}
+    for event in iter_ics_events(lines):
+        summary['events'] += 1
+        if event['all_day']:
+            summary['skipped_all_day'] += 1
+            continue
+        uid = event.get('uid') or f"{event['summary']}|{event['start'].isoformat()}"
+        for entry_id in by_uid.pop(uid, []):
+            remove_schedule_entry(user_data, entry_id)
+        duration = max(int((event['end'] - event['start']).total_seconds() // 60), 1)
+        base = {'activity': event['summary'], 'time': event['start'].strftime('%H:%M:%S'), 'duration': duration,
+                'busy': True, 'source': 'ics', 'uid': uid}
+        rule = event['rrule'] or {}
+        if rule.get('FREQ') == 'WEEKLY' and rule.get('INTERVAL', '1') == '1' and 'COUNT' not in rule:
+            days = [d[-2:] for d in rule['BYDAY'].split(',')] if rule.get('BYDAY') else [ICS_WEEKDAYS[event['start'].weekday()]]
+            until = _ics_datetime(rule['UNTIL'], '')[0].strftime('%Y-%m-%d') if 'UNTIL' in rule else None
+            entries = [dict(base, day=PLAN_DAYS[ICS_WEEKDAYS.index(d)], starts=event['start'].strftime('%Y-%m-%d'),
+                            **({'until': until} if until else {})) for d in days if d in ICS_WEEKDAYS]
+        else:
+            entries = (dict(base, recurrence='once', day=occurrence.strftime('%A'), date=occurrence.strftime('%Y-%m-%d'))
+                       for occurrence in expand_ics_event(event, window_start, window_end))
+        for entry in entries:
+            clashes = add_schedule_entry(user_data, entry, allow_conflicts=True)
+            summary['entries'] += 1
+            clashing = (schedule_entry(user_data, c) for c in clashes)
+            summary['clashes'] += [(entry['activity'], other['activity'], entry.get('date') or entry['day'])
+                                   for other in clashing if other is not None and not other.get('busy')]
+    return summary
+
+def plan_schedule_entries(plan):
+    """Weekly schedule entries for the sessions in a training plan."""
+    entries = []
+    for day, sessions in plan['days'].items():
+        for session in sessions:
+            if session.get('session'):
+                start, end = session['time'].split('-')
+                entries.append({'day': day, 'activity': session['activity'], 'time': f"{start}:00",
+                                'duration': _minutes(end) - _minutes(start), 'source': 'plan'})
+    return entries
+
+def add_plan_to_schedule(user_data, plan):
+    """Replace earlier plan sessions with this plan's. Returns the sessions that clash with other entries. Does not save."""
+    for entry in [e for e in user_data.get('schedule', []) if e.get('source') == 'plan']:
+        remove_schedule_entry(user_data, entry['id'])
+    return [entry for entry in plan_schedule_entries(plan) if add_schedule_entry(user_data, entry, allow_conflicts=True)]
+
 def schedule_manager():
     st.header("Training Schedule")
 
     with st.form("schedule_form"):
-        day = st.selectbox("Day of Week",
-                          ["Monday", "Tuesday", "Wednesday", "Thursday",
-                           "Friday", "Saturday", "Sunday"])
+        repeat = st.radio("Repeats", ["Every week", "One-off"], horizontal=True)
+        col1, col2 = st.columns(2)
+        with col1:
+            day = st.selectbox("Day of Week",
+                              ["Monday", "Tuesday", "Wednesday", "Thursday",
+                               "Friday", "Saturday", "Sunday"])
+        with col2:
+            one_off_date = st.date_input("Date (one-off)", value=datetime.now().date())
         activity = st.text_input("Activity", placeholder="e.g., Morning run")
 
         col1, col2 = st.columns(2)
@@ -6490,20 +10087,28 @@ def schedule_manager():
         with col2:
             duration = st.number_input("Duration (minutes)", min_value=1, max_value=300, value=30)
 
+        allow_clash = st.checkbox("Add even if it clashes with another session")
         submitted = st.form_submit_button("Add to Schedule")
 
         if submitted:
             if activity:
                 user_data = get_user_data()
-                user_data['schedule'].append({
-                    'day': day,
+                entry = {
+                    'day': one_off_date.strftime('%A') if repeat == "One-off" else day,
                     'activity': activity,
                     'time': str(time),
                     'duration': duration
-                })
-                update_user_data(user_data)
-                st.success("Activity added to schedule!")
-                st.rerun()
+                }
+                if repeat == "One-off":
+                    entry.update({'recurrence': 'once', 'date': one_off_date.strftime('%Y-%m-%d')})
+                conflicts = add_schedule_entry(user_data, entry, allow_conflicts=allow_clash)
+                if conflicts and not allow_clash:
+                    clashing = [e for e in user_data['schedule'] if e.get('id') in conflicts]
+                    st.error("That clashes with: " + ", ".join(f"{e['activity']} ({e['time'][:5]})" for e in clashing))
+                else:
+                    update_user_data(user_data)
+                    st.success("Activity added to schedule!")
+                    st.rerun()
             else:
                 st.error("Please enter activity name")
 
@@ -6514,15 +10119,58 @@ def schedule_manager():
         days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
 
         for day in days:
-            day_activities = [s for s in user_data['schedule'] if s['day'] == day]
+            day_activities = schedule_entries_for(user_data, day)
             if day_activities:
                 st.markdown(f"### {day}")
                 for activity in day_activities:
-                    st.markdown(f'<div class="stat-card"><strong>{activity["activity"]}</strong><br>{activity["time"]} - {activity["duration"]} minutes</div>',
-                              unsafe_allow_html=True)
+                    _render_schedule_entry(user_data, activity)
+
+        today = datetime.now().date()
+        upcoming = [(date, entry) for date, entry in
+                    expand_schedule(user_data, today.isoformat(), (today + timedelta(days=13)).isoformat())
+                    if entry.get('recurrence') == 'once']
+        if upcoming:
+            st.markdown("### Upcoming One-off Sessions")
+            for date, activity in upcoming:
+                _render_schedule_entry(user_data, activity, date)
     else:
         st.info("No activities scheduled yet.")
 
+    st.subheader("Calendar (.ics)")
+    cal1, cal2 = st.columns(2)
+    with cal1:
+        st.write("**Export**")
+        st.caption("Add your training sessions to Google, Apple or Outlook Calendar.")
+        st.download_button("Download Training Calendar", data="".join(iter_schedule_ics(user_data)),
+                           file_name="fittrack_training.ics", mime="text/calendar")
+    with cal2:
+        st.write("**Import School Timetable**")
+        st.caption("Timed events are added as busy slots so clashes are flagged and plans avoid them.")
+        ics_file = st.file_uploader("Calendar file", type=['ics'], key="ics_upload")
+        if ics_file is not None and st.button("Import Calendar", key="ics_import"):
+            import io
+            result = import_ics(user_data, io.TextIOWrapper(ics_file, encoding='utf-8', errors='replace'))
+            update_user_data(user_data)
+            st.success(f"Imported {result['events']} event(s) as {result['entries']} schedule entr{'y' if result['entries'] == 1 else 'ies'}."
+                       + (f" Skipped {result['skipped_all_day']} all-day event(s)." if result['skipped_all_day'] else ""))
+            for event, training, when in result['clashes'][:10]:
+                st.warning(f"{event} clashes with {training} ({when})")
+
+def _render_schedule_entry(user_data, activity, date=None):
+    c1, c2 = st.columns([6, 1])
+    with c1:
+        when = f"{datetime.strptime(date, '%Y-%m-%d').strftime('%a %d %b')} · " if date else ""
+        source = {'ics': " · school calendar", 'plan': " · training plan"}.get(activity.get('source'), "")
+        if str(activity.get('source', '')).startswith('class:'):
+            source = " · class session"
+        st.markdown(f'<div class="stat-card"><strong>{activity["activity"]}</strong><br>{when}{activity["time"]} - {activity["duration"]} minutes{source}</div>',
+                  unsafe_allow_html=True)
+    with c2:
+        if st.button("Remove", key=f"remove_sched_{activity['id']}"):
+            remove_schedule_entry(user_data, activity['id'])
+            update_user_data(user_data)
+            st.rerun()
+
 # Main App
 def main_app():
     user_data = get_user_data()
@@ -6550,7 +10198,17 @@ def main_app():
 
     # Different interface for teachers vs students
     if is_teacher:
-        teacher_dashboard()
+        if ensure_school_admin(st.session_state.users_data, st.session_state.username):
+            save_users(st.session_state.users_data)
+        if user_data.get('school_admin'):
+            st.sidebar.title("Navigation")
+            teacher_page = st.sidebar.radio("Choose a view:", ["Teacher Dashboard", "School Analytics"])
+            if teacher_page == "School Analytics":
+                school_analytics()
+            else:
+                teacher_dashboard()
+        else:
+            teacher_dashboard()
     else:
         # Update login streak for students
         user_data = update_login_streak(user_data)
@@ -6588,6 +10246,8 @@ def main_app():
             schedule_manager()
 
 # Main execution
+migrate_app_groups()
+migrate_teacher_classes()
 if not st.session_state.logged_in:
     login_page()
 else:
@@ -0,0 +1,54 @@
+"""Time a roster CSV import for an n-student cohort.
+
+Usage: python tools/benchmark_roster_import.py [n]
+
+Loads the app module from the repo root and uses a throwaway in-memory store, so no real data is touched.
+"""
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fittrack_FRIENDS_GROUPS_FIXED.py')
+
+def load_app():
+    spec = importlib.util.spec_from_file_location('fittrack_app', APP_PATH)
+    app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app)
+    return app
+
+def benchmark_roster_import(app, n=400):
+    """Time parsing, importing and the single save for an n-student cohort."""
+    header = "email,name,gender,house\n"
+    body = "".join(f"student{i}@school.edu.sg,Student {i},{'mf'[i % 2]},{app.ROSTER_HOUSES[i % 5]}\n" for i in range(n))
+    cls = app.new_class('teacher', 'Benchmark cohort', 'BENCH1', capacity=n)
+    users_data = {'teacher': {'email': 'teacher@school.edu.sg', 'role': 'teacher', 'name': 'Teacher',
+                              'classes': {cls['id']: cls}, 'school': 'SST'}}
+
+    timings = {}
+    started = time.perf_counter()
+    rows, errors = app.parse_roster_csv(header + body)
+    timings['parse_s'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    result = app.import_roster(users_data, cls, rows, app.build_email_index(users_data))
+    timings['import_s'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+        json.dump(users_data, f, indent=2)
+    timings['save_s'] = time.perf_counter() - started
+
+    timings['students'] = len(result['created'])
+    timings['errors'] = len(errors)
+    return timings
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)  # the app creates its JSON files in the working directory on import
+        timings = benchmark_roster_import(load_app(), n)
+    for key, value in timings.items():
+        print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")